@@ -0,0 +1,90 @@
+"""
+File name: async_engines.py
+Author: Luigi Saetta
+Date created: 2024-03-10
+Date last modified: 2024-03-10
+Python Version: 3.9
+
+Description:
+    This module provides query and chat engines that, in the async path
+    (aquery, achat), await the node postprocessors exposing
+    apostprocess_nodes (ex: OCILLamaReranker), instead of calling them
+    synchronously and blocking the event loop
+
+Usage:
+    Import this module into other scripts to use its functions.
+    Example:
+        query_engine = AsyncRerankQueryEngine.from_args(
+            index.as_retriever(similarity_top_k=TOP_K),
+            service_context=service_context,
+            node_postprocessors=[reranker],
+        )
+
+License:
+    This code is released under the MIT License.
+
+Notes:
+    This is a part of a set of demo showing how to use Oracle Vector DB,
+    OCI GenAI service, Oracle GenAI Embeddings, to build a RAG solution,
+    where all he data (text + embeddings) are stored in Oracle DB 23c
+
+Warnings:
+    This module is in development, may change in future versions.
+"""
+
+import asyncio
+from typing import List, Tuple
+
+from llama_index.chat_engine import CondensePlusContextChatEngine
+from llama_index.query_engine import RetrieverQueryEngine
+from llama_index.schema import MetadataMode, NodeWithScore, QueryBundle
+
+
+async def apply_node_postprocessors_async(node_postprocessors, nodes, query_bundle):
+    """
+    Apply the postprocessors in sequence, awaiting the async ones
+    """
+    for node_postprocessor in node_postprocessors:
+        if hasattr(node_postprocessor, "apostprocess_nodes"):
+            nodes = await node_postprocessor.apostprocess_nodes(
+                nodes, query_bundle=query_bundle
+            )
+        else:
+            # ex: CohereRerank, sync only: in a thread, to not block the loop
+            nodes = await asyncio.to_thread(
+                node_postprocessor.postprocess_nodes, nodes, query_bundle=query_bundle
+            )
+
+    return nodes
+
+
+class AsyncRerankQueryEngine(RetrieverQueryEngine):
+    """
+    RetrieverQueryEngine with non blocking postprocessors in aquery
+    """
+
+    async def aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        nodes = await self._retriever.aretrieve(query_bundle)
+
+        return await apply_node_postprocessors_async(
+            self._node_postprocessors, nodes, query_bundle
+        )
+
+
+class AsyncRerankChatEngine(CondensePlusContextChatEngine):
+    """
+    CondensePlusContextChatEngine with non blocking postprocessors in achat.
+    The original _aretrieve_context doesn't apply them at all
+    """
+
+    async def _aretrieve_context(self, message: str) -> Tuple[str, List[NodeWithScore]]:
+        nodes = await self._retriever.aretrieve(message)
+
+        nodes = await apply_node_postprocessors_async(
+            self._node_postprocessors, nodes, QueryBundle(message)
+        )
+
+        context_str = "\n\n".join(
+            [n.node.get_content(metadata_mode=MetadataMode.LLM).strip() for n in nodes]
+        )
+        return context_str, nodes
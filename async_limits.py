@@ -0,0 +1,254 @@
+"""
+File name: async_limits.py
+Author: Luigi Saetta
+Date created: 2024-03-13
+Date last modified: 2024-03-13
+Python Version: 3.9
+
+Description:
+    This module provides the limits to the number of concurrent calls
+    to each backend (embeddings, Oracle DB, reranker, LLM) in the async path
+    of the engines (aquery, achat), to respect the quotas of the services
+    while serving many users from a single event loop.
+
+    - BackendLimits: one asyncio.Semaphore for each backend (and event loop)
+    - LimitedEmbeddings: LangChain embeddings with limited async calls
+    - LimitedLLM: llama-index LLM with limited async calls (LLMs without
+      a real async client, ex: LangChainLLM, are called in a worker thread)
+
+Usage:
+    Import this module into other scripts to use its functions.
+    Example:
+    async with backend_limits.limit("vector_db"):
+        ...
+
+    llm = LimitedLLM(llm, backend="llm")
+
+License:
+    This code is released under the MIT License.
+
+Notes:
+    This is a part of a set of demo showing how to use Oracle Vector DB,
+    OCI GenAI service, Oracle GenAI Embeddings, to build a RAG solution,
+    where all he data (text + embeddings) are stored in Oracle DB 23c
+
+Warnings:
+    This module is in development, may change in future versions.
+"""
+
+import asyncio
+import logging
+import threading
+import weakref
+from contextlib import asynccontextmanager
+from typing import Any, List, Sequence
+
+from langchain_core.embeddings import Embeddings
+
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.llms import LLM, ChatMessage, LangChainLLM
+from llama_index.llms.base import llm_chat_callback, llm_completion_callback
+
+from config import ASYNC_BACKEND_LIMITS
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+class BackendLimits:
+    def __init__(self, limits):
+        """
+        limits: backend name -> max num. of concurrent calls
+        (backends not in limits are not limited)
+        """
+        self.limits = dict(limits)
+
+        # a semaphore works only in the loop where it's used:
+        # event loop -> {backend: semaphore}
+        self._semaphores = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _get_semaphore(self, backend):
+        loop = asyncio.get_running_loop()
+
+        with self._lock:
+            semaphores = self._semaphores.setdefault(loop, {})
+
+            if backend not in semaphores:
+                semaphores[backend] = asyncio.Semaphore(self.limits[backend])
+
+            return semaphores[backend]
+
+    @asynccontextmanager
+    async def limit(self, backend):
+        if self.limits.get(backend) is None:
+            yield
+            return
+
+        async with self._get_semaphore(backend):
+            yield
+
+
+# the limits shared by all the engines in the process
+backend_limits = BackendLimits(ASYNC_BACKEND_LIMITS)
+
+
+class LimitedEmbeddings(Embeddings):
+    def __init__(self, embed_model, backend="embed"):
+        """
+        embed_model: the LangChain embeddings to wrap
+        """
+        self.embed_model = embed_model
+        self.backend = backend
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embed_model.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_model.embed_query(text)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        async with backend_limits.limit(self.backend):
+            return await asyncio.to_thread(self.embed_model.embed_documents, texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        async with backend_limits.limit(self.backend):
+            return await asyncio.to_thread(self.embed_model.embed_query, text)
+
+    def get_stats(self):
+        # ex: if it wraps CachedEmbeddings
+        return self.embed_model.get_stats()
+
+
+# LLMs whose async methods only call the sync ones (in llama-index 0.9
+# LangChainLLM.achat, acomplete... are TODO): they would block the event loop
+SYNC_ONLY_LLMS = (LangChainLLM,)
+
+
+async def iterate_in_thread(make_gen):
+    """
+    async iteration of a sync generator, each step in a worker thread
+    make_gen: function returning the generator (the call can block too)
+    """
+    gen = await asyncio.to_thread(make_gen)
+    end = object()
+
+    while True:
+        item = await asyncio.to_thread(next, gen, end)
+
+        if item is end:
+            break
+
+        yield item
+
+
+class LimitedLLM(LLM):
+    """
+    Wraps a llama-index LLM (for LangChain LLMs use LangChainLLM):
+    the sync calls are passed through, the async ones wait for the semaphore.
+    If the LLM has no real async client, the async calls are done
+    with the sync ones in a worker thread.
+    The token counting is done by the callbacks of this wrapper
+    """
+
+    backend: str = "llm"
+    _llm: Any = PrivateAttr()
+    _native_async: bool = PrivateAttr()
+
+    def __init__(self, llm, backend="llm") -> None:
+        self._llm = llm
+        self._native_async = not isinstance(llm, SYNC_ONLY_LLMS)
+
+        super().__init__(backend=backend)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "LimitedLLM"
+
+    @property
+    def metadata(self):
+        return self._llm.metadata
+
+    @llm_chat_callback()
+    def chat(self, messages: Sequence[ChatMessage], **kwargs: Any):
+        return self._llm.chat(messages, **kwargs)
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        return self._llm.complete(prompt, formatted=formatted, **kwargs)
+
+    @llm_chat_callback()
+    def stream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any):
+        return self._llm.stream_chat(messages, **kwargs)
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        return self._llm.stream_complete(prompt, formatted=formatted, **kwargs)
+
+    @llm_chat_callback()
+    async def achat(self, messages: Sequence[ChatMessage], **kwargs: Any):
+        async with backend_limits.limit(self.backend):
+            if not self._native_async:
+                return await asyncio.to_thread(self._llm.chat, messages, **kwargs)
+
+            return await self._llm.achat(messages, **kwargs)
+
+    @llm_completion_callback()
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        async with backend_limits.limit(self.backend):
+            if not self._native_async:
+                return await asyncio.to_thread(
+                    self._llm.complete, prompt, formatted=formatted, **kwargs
+                )
+
+            return await self._llm.acomplete(prompt, formatted=formatted, **kwargs)
+
+    # for streaming the semaphore is held until the end of the stream
+    @llm_chat_callback()
+    async def astream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any):
+        async def gen():
+            async with backend_limits.limit(self.backend):
+                if self._native_async:
+                    stream = await self._llm.astream_chat(messages, **kwargs)
+                else:
+                    stream = iterate_in_thread(
+                        lambda: self._llm.stream_chat(messages, **kwargs)
+                    )
+
+                async for response in stream:
+                    yield response
+
+        return gen()
+
+    @llm_completion_callback()
+    async def astream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ):
+        async def gen():
+            async with backend_limits.limit(self.backend):
+                if self._native_async:
+                    stream = await self._llm.astream_complete(
+                        prompt, formatted=formatted, **kwargs
+                    )
+                else:
+                    stream = iterate_in_thread(
+                        lambda: self._llm.stream_complete(
+                            prompt, formatted=formatted, **kwargs
+                        )
+                    )
+
+                async for response in stream:
+                    yield response
+
+        return gen()
+
+
+def limited_llm(llm, backend="llm"):
+    """
+    llm: a llama-index or a LangChain LLM (ex: GenerativeAI)
+    """
+    if not isinstance(llm, LLM):
+        llm = LangChainLLM(llm=llm)
+
+    return LimitedLLM(llm, backend=backend)
@@ -0,0 +1,122 @@
+"""
+File name: benchmark_reranker_payload.py
+Author: Luigi Saetta
+Date created: 2024-03-10
+Date last modified: 2024-03-10
+Python Version: 3.9
+
+Description:
+    This module provides a micro-benchmark comparing the payload formats
+    supported by OCIBAAIReranker (cloudpickle, json, json_gzip):
+    size of the body and time to encode (client) and decode (deployment)
+
+Usage:
+    No OCI access is needed, everything runs locally
+    Example:
+        python benchmark_reranker_payload.py
+
+License:
+    This code is released under the MIT License.
+
+Notes:
+    This is a part of a set of demo showing how to use Oracle Vector DB,
+    OCI GenAI service, Oracle GenAI Embeddings, to build a RAG solution,
+    where all he data (text + embeddings) are stored in Oracle DB 23c
+
+Warnings:
+    This module is in development, may change in future versions.
+"""
+
+import base64
+import json
+import random
+import timeit
+
+import cloudpickle
+
+from oci_baai_reranker import (
+    OCIBAAIReranker,
+    PAYLOAD_FORMATS,
+    decode_compact_payload,
+)
+
+# same shape of a typical call: TOP_K texts of ~600 tokens
+N_TEXTS = 8
+WORDS_PER_TEXT = 450
+N_RUNS = 200
+
+QUERY = "What are the most common side effects of metformin in elderly patients?"
+
+
+def make_texts(n_texts, n_words):
+    random.seed(42)
+    vocabulary = [
+        "metformin",
+        "patients",
+        "treatment",
+        "glucose",
+        "the",
+        "of",
+        "in",
+        "risk",
+        "lactic",
+        "acidosis",
+        "renal",
+        "function",
+        "dose",
+        "study",
+        "reported",
+        "gastrointestinal",
+    ]
+    return [
+        " ".join(random.choice(vocabulary) for _ in range(n_words))
+        for _ in range(n_texts)
+    ]
+
+
+def decode_body(body):
+    """
+    What the deployment does with the body received
+    """
+    if "data_type" in body:
+        # original format
+        return cloudpickle.loads(base64.b64decode(body["data"]))
+
+    # compact format
+    return decode_compact_payload(body["data"])
+
+
+#
+# Main
+#
+texts = make_texts(N_TEXTS, WORDS_PER_TEXT)
+
+print("")
+print(f"Payload: {N_TEXTS} texts of {WORDS_PER_TEXT} words, {N_RUNS} runs")
+print("")
+print(f"{'format':<12} {'bytes':>10} {'encode (ms)':>12} {'decode (ms)':>12}")
+
+for payload_format in PAYLOAD_FORMATS:
+    # no auth is needed to build the body
+    reranker = OCIBAAIReranker(
+        auth=None, deployment_id="benchmark", payload_format=payload_format
+    )
+
+    body = reranker.build_request_body(QUERY, texts)
+    # this is what goes on the wire
+    n_bytes = len(json.dumps(body).encode("utf-8"))
+
+    t_encode = timeit.timeit(
+        lambda: json.dumps(reranker.build_request_body(QUERY, texts)), number=N_RUNS
+    )
+    t_decode = timeit.timeit(lambda: decode_body(body), number=N_RUNS)
+
+    # check that the deployment gets back the same couples
+    assert [list(x) for x in decode_body(body)] == [[QUERY, text] for text in texts]
+
+    print(
+        f"{payload_format:<12} {n_bytes:>10} "
+        f"{t_encode * 1000 / N_RUNS:>12.3f} {t_decode * 1000 / N_RUNS:>12.3f}"
+    )
+
+print("")
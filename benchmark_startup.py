@@ -0,0 +1,84 @@
+"""
+File name: benchmark_startup.py
+Author: Luigi Saetta
+Date created: 2024-03-12
+Date last modified: 2024-03-12
+Python Version: 3.9
+
+Description:
+    This module measures the cold import time of the modules used
+    by the Streamlit apps and the batch jobs. Every import is done
+    in a new Python interpreter, to measure a real cold start.
+    The time to create the engines is reported in the log by
+    create_query_engine and create_chat_engine
+
+Usage:
+    Example:
+        python benchmark_startup.py
+
+License:
+    This code is released under the MIT License.
+
+Notes:
+    This is a part of a set of demo showing how to use Oracle Vector DB,
+    OCI GenAI service, Oracle GenAI Embeddings, to build a RAG solution,
+    where all he data (text + embeddings) are stored in Oracle DB 23c
+
+Warnings:
+    This module is in development, may change in future versions.
+"""
+
+import sys
+import subprocess
+import statistics
+
+MODULES = ["oci_utils", "oracle_vector_db", "prepare_chain", "prepare_chain_4_chat"]
+
+N_RUNS = 3
+
+# the time is measured inside the child, to exclude the interpreter startup
+CODE = """
+import time
+tStart = time.time()
+import {module}
+print(time.time() - tStart)
+"""
+
+
+def import_time(module):
+    result = subprocess.run(
+        [sys.executable, "-c", CODE.format(module=module)],
+        capture_output=True,
+        text=True,
+    )
+
+    if result.returncode != 0:
+        print(f"Error importing {module}:")
+        print(result.stderr.strip().splitlines()[-1])
+        return None
+
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+#
+# Main
+#
+print("")
+print(f"Cold import time, median of {N_RUNS} runs:")
+print("")
+
+for module in MODULES:
+    times = []
+    for _ in range(N_RUNS):
+        elapsed = import_time(module)
+
+        if elapsed is None:
+            break
+        times.append(elapsed)
+
+    if len(times) < N_RUNS:
+        continue
+
+    print(f"{module:<25} {round(statistics.median(times), 2):>6} sec.")
+
+print("")
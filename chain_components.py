@@ -0,0 +1,244 @@
+"""
+File name: chain_components.py
+Author: Luigi Saetta
+Date created: 2024-03-13
+Date last modified: 2024-03-13
+Python Version: 3.9
+
+Description:
+    This module provides the factory methods of the components shared by
+    the query chain (prepare_chain.py) and the chat chain
+    (prepare_chain_4_chat.py): reranker and retriever.
+    As in the chains, all the parameters are taken from config.py and
+    the provider modules are imported only when selected.
+
+Usage:
+    Import this module into other scripts to use its functions.
+    Example:
+        reranker = create_reranker(auth=api_keys_config)
+
+License:
+    This code is released under the MIT License.
+
+Notes:
+    This is a part of a set of demo showing how to use Oracle Vector DB,
+    OCI GenAI service, Oracle GenAI Embeddings, to build a RAG solution,
+    where all he data (text + embeddings) are stored in Oracle DB 23c
+
+Warnings:
+    This module is in development, may change in future versions.
+"""
+
+import logging
+
+from config_private import COHERE_API_KEY
+
+from config import (
+    GEN_MODEL,
+    TOP_K,
+    TOP_N,
+    RERANKER_MODEL,
+    RERANKER_ID,
+    RERANKER_PAYLOAD_FORMAT,
+    RERANK_BATCH_SIZE,
+    RERANK_MAX_WORKERS,
+    RERANK_TIMEOUT,
+    RERANK_HEDGE,
+    RERANK_HEDGE_DELAY,
+    RERANK_HEDGE_DEFAULT_DELAY,
+    RERANK_CB_FAILURE_THRESHOLD,
+    RERANK_CB_RESET_TIMEOUT,
+    LOCAL_RERANKER_MODEL,
+    LOCAL_RERANKER_BATCH_SIZE,
+    LOCAL_RERANKER_THREADS,
+    LOCAL_RERANKER_QUANTIZE,
+    LOCAL_RERANKER_ONNX_PATH,
+    ADD_RERANK_CACHE,
+    RERANK_CACHE_MAX_SIZE,
+    RERANK_CACHE_TTL,
+    RERANK_CACHE_PATH,
+    RERANK_CACHE_SAVE_DELAY,
+    ADD_RERANK_BYPASS,
+    RERANK_BYPASS_MARGIN,
+    RERANK_BYPASS_MAX_ENTROPY,
+    RERANK_BYPASS_TEMPERATURE,
+    ADD_MULTI_QUERY,
+    MULTI_QUERY_NUM_QUERIES,
+    DB_POOL_MAX,
+)
+
+from component_registry import registry
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+def streaming_supported():
+    """
+    True if the LLM selected in config can stream the completion
+    """
+    if GEN_MODEL == "MISTRAL":
+        return True
+
+    # OCI models: llama-index LangChainLLM streams only if the
+    # LangChain LLM has the streaming flag
+    from ads.llm import GenerativeAI
+
+    return "streaming" in GenerativeAI.__fields__
+
+
+def wrap_cross_encoder(cross_encoder, model, cache_namespace, verbose=False):
+    """
+    wraps a cross-encoder (OCI BAAI or local) as llama-index postprocessor,
+    adding the score cache and the bypass policy
+    """
+    from oci_llama_reranker import OCILLamaReranker
+    from rerank_cache import RerankScoreCache
+    from rerank_bypass import RerankBypassPolicy
+
+    # cache and policy are shared by all the engines in the process
+    score_cache = None
+
+    if ADD_RERANK_CACHE:
+        score_cache = registry.get(
+            "rerank_cache",
+            lambda: RerankScoreCache(
+                max_size=RERANK_CACHE_MAX_SIZE,
+                ttl=RERANK_CACHE_TTL,
+                persist_path=RERANK_CACHE_PATH,
+                namespace=cache_namespace,
+                save_delay=RERANK_CACHE_SAVE_DELAY,
+            ),
+            key=(cache_namespace, RERANK_CACHE_MAX_SIZE, RERANK_CACHE_TTL),
+        )
+
+    bypass_policy = None
+
+    if ADD_RERANK_BYPASS and ADD_MULTI_QUERY:
+        # margin and temperature are for the DOT similarities, the multi query
+        # retriever returns RRF scores (max ~ num. lists / 61)
+        logging.warning("Rerank bypass disabled: not supported with multi query...")
+
+    elif ADD_RERANK_BYPASS:
+        bypass_policy = registry.get(
+            "rerank_bypass",
+            lambda: RerankBypassPolicy(
+                margin=RERANK_BYPASS_MARGIN,
+                max_entropy=RERANK_BYPASS_MAX_ENTROPY,
+                temperature=RERANK_BYPASS_TEMPERATURE,
+            ),
+            key=(
+                RERANK_BYPASS_MARGIN,
+                RERANK_BYPASS_MAX_ENTROPY,
+                RERANK_BYPASS_TEMPERATURE,
+            ),
+        )
+
+    # the wrapper is light and gets the callback manager of the engine,
+    # so it is not shared
+    return OCILLamaReranker(
+        model=model,
+        oci_reranker=cross_encoder,
+        top_n=TOP_N,
+        score_cache=score_cache,
+        bypass_policy=bypass_policy,
+        # the multi query retriever returns RRF scores
+        scores_are_distances=not ADD_MULTI_QUERY,
+        verbose=verbose,
+    )
+
+
+def create_reranker(auth=None, verbose=False):
+    model_list = ["COHERE", "OCI_BAAI", "LOCAL"]
+
+    if RERANKER_MODEL not in model_list:
+        raise ValueError(
+            f"The value {RERANKER_MODEL} is not supported. Choose a value in {model_list} for the Reranker model."
+        )
+
+    reranker = None
+
+    if RERANKER_MODEL == "COHERE":
+        from llama_index.postprocessor.cohere_rerank import CohereRerank
+
+        reranker = CohereRerank(api_key=COHERE_API_KEY, top_n=TOP_N)
+
+    # reranker model deployed as MD in OCI DS
+    if RERANKER_MODEL == "OCI_BAAI":
+        from oci_baai_reranker import OCIBAAIReranker
+        from resilience import CircuitBreaker
+
+        # the client (with its circuit breaker) is shared in the process
+        baai_reranker = registry.get(
+            "cross_encoder",
+            lambda: OCIBAAIReranker(
+                auth=auth,
+                deployment_id=RERANKER_ID,
+                region="eu-frankfurt-1",
+                payload_format=RERANKER_PAYLOAD_FORMAT,
+                batch_size=RERANK_BATCH_SIZE,
+                max_workers=RERANK_MAX_WORKERS,
+                timeout=RERANK_TIMEOUT,
+                hedge=RERANK_HEDGE,
+                hedge_delay=RERANK_HEDGE_DELAY,
+                default_hedge_delay=RERANK_HEDGE_DEFAULT_DELAY,
+                circuit_breaker=CircuitBreaker(
+                    failure_threshold=RERANK_CB_FAILURE_THRESHOLD,
+                    reset_timeout=RERANK_CB_RESET_TIMEOUT,
+                    name="reranker",
+                ),
+            ),
+            key=("OCI_BAAI", RERANKER_ID, RERANKER_PAYLOAD_FORMAT, RERANK_BATCH_SIZE),
+        )
+
+        reranker = wrap_cross_encoder(
+            baai_reranker,
+            model="oci_baai_reranker",
+            cache_namespace=RERANKER_ID,
+            verbose=verbose,
+        )
+
+    # cross-encoder running locally, on CPU
+    if RERANKER_MODEL == "LOCAL":
+        # imported here: it loads torch and transformers
+        from local_reranker import LocalCrossEncoderReranker
+
+        # the model is loaded only once in the process
+        local_reranker = registry.get(
+            "cross_encoder",
+            lambda: LocalCrossEncoderReranker(
+                model_name=LOCAL_RERANKER_MODEL,
+                batch_size=LOCAL_RERANKER_BATCH_SIZE,
+                num_threads=LOCAL_RERANKER_THREADS,
+                quantize=LOCAL_RERANKER_QUANTIZE,
+                onnx_path=LOCAL_RERANKER_ONNX_PATH,
+            ),
+            key=("LOCAL", LOCAL_RERANKER_MODEL, LOCAL_RERANKER_QUANTIZE),
+        )
+
+        reranker = wrap_cross_encoder(
+            local_reranker,
+            model="local_cross_encoder",
+            cache_namespace=LOCAL_RERANKER_MODEL,
+            verbose=verbose,
+        )
+
+    return reranker
+
+
+def create_retriever(index, v_store, service_context, verbose=False):
+    if ADD_MULTI_QUERY:
+        from multi_query_retriever import MultiQueryRetriever
+
+        # sub-queries searched concurrently and fused with RRF
+        return MultiQueryRetriever(
+            vector_store=v_store,
+            service_context=service_context,
+            similarity_top_k=TOP_K,
+            num_queries=MULTI_QUERY_NUM_QUERIES,
+            max_workers=DB_POOL_MAX,
+            verbose=verbose,
+        )
+
+    return index.as_retriever(similarity_top_k=TOP_K)
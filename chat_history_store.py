@@ -0,0 +1,205 @@
+"""
+File name: chat_history_store.py
+Author: Luigi Saetta
+Date created: 2024-03-13
+Date last modified: 2024-03-13
+Python Version: 3.9
+
+Description:
+    This module provides a store for the history of the chat sessions,
+    in the Oracle table CHAT_HISTORY (see create_tables.sql), so that
+    a conversation survives a restart of the UI.
+    - the messages are written in background, in batches (executemany),
+      the conversation doesn't wait for the DB
+    - when a session is resumed, only the last turns are loaded
+    - an answer is saved without the references: they are kept apart
+      (SOURCES, the metadata of the chunks) and added only for display
+    The connections are taken from the shared DB pool.
+
+Usage:
+    Import this module into other scripts to use its functions.
+    Example:
+    history_store = OracleChatHistoryStore()
+
+    history_store.append(session_id, [user_message, assistant_message])
+    messages = history_store.load(session_id, last_n_turns=10)
+
+License:
+    This code is released under the MIT License.
+
+Notes:
+    This is a part of a set of demo showing how to use Oracle Vector DB,
+    OCI GenAI service, Oracle GenAI Embeddings, to build a RAG solution,
+    where all he data (text + embeddings) are stored in Oracle DB 23c
+
+Warnings:
+    This module is in development, may change in future versions.
+"""
+
+import json
+import queue
+import logging
+import threading
+from typing import List
+
+import oracledb
+from llama_index.llms import ChatMessage, MessageRole
+
+from oracle_vector_db import get_db_pool
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+# key in ChatMessage.additional_kwargs for the metadata of the chunks
+# used for an answer (the references)
+SOURCES_KEY = "sources"
+
+
+class OracleChatHistoryStore:
+    def __init__(self, max_batch_size=100):
+        """
+        max_batch_size: max num. of messages in an insert
+        """
+        self.max_batch_size = max_batch_size
+
+        # (session_id, role, content)
+        self._queue = queue.Queue()
+        # only one writer at a time: the order of the messages is kept
+        self._write_lock = threading.Lock()
+        # set when there are messages to write
+        self._pending = threading.Event()
+
+        self.n_written = 0
+        self.n_errors = 0
+
+        # daemon: doesn't prevent the exit of the process
+        self._writer = threading.Thread(target=self._run, daemon=True)
+        self._writer.start()
+
+    def append(self, session_id, messages: List[ChatMessage]):
+        """
+        queue the messages to be written (returns immediately)
+        """
+        for message in messages:
+            # metadata of the chunks used for the answer (see SOURCES_KEY)
+            sources = message.additional_kwargs.get(SOURCES_KEY)
+
+            self._queue.put(
+                (
+                    session_id,
+                    message.role.value,
+                    str(message.content),
+                    json.dumps(sources) if sources is not None else None,
+                )
+            )
+
+        self._pending.set()
+
+    def _drain(self, rows):
+        while len(rows) < self.max_batch_size:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return rows
+
+    def _write(self, rows):
+        try:
+            with get_db_pool().acquire() as connection:
+                with connection.cursor() as cursor:
+                    cursor.setinputsizes(
+                        None, None, oracledb.DB_TYPE_CLOB, oracledb.DB_TYPE_CLOB
+                    )
+                    cursor.executemany(
+                        """insert into CHAT_HISTORY (SESSION_ID, ROLE, CONTENT, SOURCES)
+                        values (:1, :2, :3, :4)""",
+                        rows,
+                    )
+                connection.commit()
+
+            self.n_written += len(rows)
+        except Exception as e:
+            logging.error("Error saving the chat history...")
+            logging.error(e)
+            self.n_errors += 1
+
+    def _run(self):
+        while True:
+            self._pending.wait()
+            self._pending.clear()
+
+            # the messages arriving in the meantime go in the same batch
+            self.flush()
+
+    def flush(self):
+        """
+        writes the queued messages now
+        """
+        with self._write_lock:
+            while True:
+                rows = self._drain([])
+
+                if len(rows) == 0:
+                    break
+
+                self._write(rows)
+
+    def load(self, session_id, last_n_turns=10) -> List[ChatMessage]:
+        """
+        the last turns (user + assistant messages) of the session, in order
+        the sources of the answers are in additional_kwargs[SOURCES_KEY]
+        """
+        # the messages still in the queue are part of the history
+        self.flush()
+
+        with get_db_pool().acquire() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """select ROLE, CONTENT, SOURCES from CHAT_HISTORY
+                    where SESSION_ID = :1
+                    order by ID desc
+                    FETCH FIRST :2 ROWS ONLY""",
+                    [session_id, 2 * last_n_turns],
+                )
+
+                # CONTENT and SOURCES are clobs
+                rows = [
+                    (role, content.read(), sources.read() if sources else None)
+                    for role, content, sources in cursor.fetchall()
+                ]
+
+        messages = [
+            ChatMessage(
+                role=MessageRole(role),
+                content=content,
+                additional_kwargs=(
+                    {SOURCES_KEY: json.loads(sources)} if sources is not None else {}
+                ),
+            )
+            for role, content, sources in reversed(rows)
+        ]
+
+        # the history can't start with an answer
+        while len(messages) > 0 and messages[0].role != MessageRole.USER:
+            messages.pop(0)
+
+        return messages
+
+    def delete(self, session_id):
+        self.flush()
+
+        with get_db_pool().acquire() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "delete from CHAT_HISTORY where SESSION_ID = :1", [session_id]
+                )
+            connection.commit()
+
+    def get_stats(self):
+        return {
+            "n_written": self.n_written,
+            "n_errors": self.n_errors,
+            "n_queued": self._queue.qsize(),
+        }
@@ -0,0 +1,150 @@
+"""
+File name: chat_sessions.py
+Author: Luigi Saetta
+Date created: 2024-03-13
+Date last modified: 2024-03-13
+Python Version: 3.9
+
+Description:
+    This module provides a manager of the chat engines, one for each user
+    session: every session has its own memory and token counter, while
+    the heavy components (LLM client, embeddings, tokenizer, reranker model)
+    are shared through the component registry, so an engine is light.
+    To bound the memory used, the sessions idle for more than idle_timeout
+    are removed and, if there are more than max_sessions,
+    the least recently used ones are removed.
+
+Usage:
+    Import this module into other scripts to use its functions.
+    Example:
+    manager = ChatSessionManager(
+        factory=lambda: prepare_chain_4_chat.create_chat_engine(),
+        max_sessions=50,
+        idle_timeout=1800,
+    )
+
+    chat_engine, token_counter = manager.get(session_id)
+
+License:
+    This code is released under the MIT License.
+
+Notes:
+    This is a part of a set of demo showing how to use Oracle Vector DB,
+    OCI GenAI service, Oracle GenAI Embeddings, to build a RAG solution,
+    where all he data (text + embeddings) are stored in Oracle DB 23c
+
+Warnings:
+    This module is in development, may change in future versions.
+"""
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+class ChatSessionManager:
+    def __init__(self, factory, max_sessions=50, idle_timeout=1800):
+        """
+        factory: returns (chat_engine, token_counter) for a new session
+        max_sessions: max num. of sessions kept
+        idle_timeout: in sec., None: sessions are removed only by LRU
+        """
+        self.factory = factory
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+
+        # session_id -> (chat_engine, token_counter, last used), LRU order
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.n_created = 0
+        self.n_evicted = 0
+
+    def _evict(self):
+        if self.idle_timeout is not None:
+            now = time.time()
+
+            idle = [
+                session_id
+                for session_id, (_, _, last_used) in self._sessions.items()
+                if now - last_used > self.idle_timeout
+            ]
+
+            for session_id in idle:
+                del self._sessions[session_id]
+
+            self.n_evicted += len(idle)
+
+        while len(self._sessions) > self.max_sessions:
+            # the least recently used
+            session_id, _ = self._sessions.popitem(last=False)
+            self.n_evicted += 1
+
+            logging.info(f"Chat session {session_id} evicted...")
+
+    def get(self, session_id):
+        """
+        Returns (chat_engine, token_counter) of the session,
+        creating them if the session is new (or was evicted)
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+
+            if session is not None:
+                chat_engine, token_counter, _ = session
+                self._sessions[session_id] = (chat_engine, token_counter, time.time())
+                self._sessions.move_to_end(session_id)
+
+                return chat_engine, token_counter
+
+        # built outside the lock: the creation doesn't block other sessions
+        chat_engine, token_counter = self.factory()
+
+        with self._lock:
+            # the session could have been created in the meantime
+            if session_id in self._sessions:
+                chat_engine, token_counter, _ = self._sessions[session_id]
+            else:
+                self.n_created += 1
+
+            self._sessions[session_id] = (chat_engine, token_counter, time.time())
+            self._sessions.move_to_end(session_id)
+
+            self._evict()
+
+        return chat_engine, token_counter
+
+    def reset(self, session_id):
+        """
+        clear the memory of the session
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+
+        if session is not None:
+            session[0].reset()
+
+    def remove(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def __contains__(self, session_id):
+        with self._lock:
+            return session_id in self._sessions
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "n_sessions": len(self._sessions),
+                "n_created": self.n_created,
+                "n_evicted": self.n_evicted,
+            }
@@ -0,0 +1,165 @@
+"""
+File name: component_registry.py
+Author: Luigi Saetta
+Date created: 2024-03-13
+Date last modified: 2024-03-13
+Python Version: 3.9
+
+Description:
+    This module provides a process-wide registry of the expensive components
+    of the chain (OCI auth, tokenizer, embedding and LLM clients, rerankers).
+    Each component is built once per process, for a given configuration (key),
+    and shared by the query engine, the chat engines and the batch scripts:
+    creating a new engine for a session then costs milliseconds.
+
+Usage:
+    Import this module into other scripts to use its functions.
+    Example:
+        from component_registry import registry, get_auth
+
+        api_keys_config = get_auth()
+        llm = registry.get("llm", lambda: create_llm(auth=api_keys_config), key=GEN_MODEL)
+
+        # to rebuild the components (ex: after a change of the OCI keys)
+        registry.refresh()
+
+        # at the shutdown of an async service
+        await registry.aclose()
+
+License:
+    This code is released under the MIT License.
+
+Notes:
+    This is a part of a set of demo showing how to use Oracle Vector DB,
+    OCI GenAI service, Oracle GenAI Embeddings, to build a RAG solution,
+    where all he data (text + embeddings) are stored in Oracle DB 23c
+
+Warnings:
+    This module is in development, may change in future versions.
+"""
+
+import time
+import logging
+import threading
+
+from config import TOKENIZER
+from oci_utils import load_oci_config
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+class ComponentRegistry:
+    def __init__(self):
+        # (name, key) -> component
+        self._components = {}
+        self._lock = threading.Lock()
+        # one lock for each (name, key): a component is built only once,
+        # even if two engines are created at the same time
+        self._build_locks = {}
+
+    def get(self, name, factory, key=None):
+        """
+        Returns the component, calling factory() only the first time
+        name: the kind of component (ex: "llm")
+        key: the configuration of the component, must be hashable
+        """
+        full_key = (name, key)
+
+        with self._lock:
+            if full_key in self._components:
+                return self._components[full_key]
+
+            build_lock = self._build_locks.setdefault(full_key, threading.Lock())
+
+        with build_lock:
+            # could have been built while we were waiting
+            with self._lock:
+                if full_key in self._components:
+                    return self._components[full_key]
+
+            tStart = time.time()
+            component = factory()
+            tEla = time.time() - tStart
+
+            logging.info(f"Registry: created {name} in {round(tEla, 2)} sec.")
+
+            with self._lock:
+                self._components[full_key] = component
+
+        return component
+
+    def refresh(self, name=None):
+        """
+        Remove the components (all or only those with the given name),
+        they'll be built again at the next get
+        """
+        with self._lock:
+            keys = [k for k in self._components if name is None or k[0] == name]
+
+            for k in keys:
+                del self._components[k]
+
+        logging.info(f"Registry: removed {len(keys)} components...")
+
+    async def aclose(self):
+        """
+        Closes the components with an async aclose (ex: the aiohttp sessions
+        of OCIBAAIReranker), to be called at the shutdown of the service
+        """
+        with self._lock:
+            components = list(self._components.values())
+
+        for component in components:
+            if hasattr(component, "aclose"):
+                try:
+                    await component.aclose()
+                except Exception as e:
+                    logging.error(f"Registry: error closing {component}...")
+                    logging.error(e)
+
+    def names(self):
+        with self._lock:
+            return [name for name, _ in self._components]
+
+
+# the process-wide registry
+registry = ComponentRegistry()
+
+
+def engine_copy(component):
+    """
+    Shallow copy of a shared pydantic component (ex: the LLM) that an engine
+    is going to modify (callback manager, streaming callbacks).
+    update= is needed: copy() alone drops the fields excluded
+    from serialization, like callback_manager
+    """
+    return component.copy(update=component.__dict__)
+
+
+def create_auth():
+    # load security info needed for OCI
+    import ads
+
+    oci_config = load_oci_config()
+
+    # need to do this way
+    api_keys_config = ads.auth.api_keys(oci_config)
+
+    return api_keys_config
+
+
+def create_tokenizer():
+    # used to count the total # of tokens
+    from tokenizers import Tokenizer
+
+    return Tokenizer.from_pretrained(TOKENIZER)
+
+
+def get_auth():
+    return registry.get("oci_auth", create_auth, key=("~/.oci/config", "DEFAULT"))
+
+
+def get_tokenizer():
+    return registry.get("tokenizer", create_tokenizer, key=TOKENIZER)
@@ -74,35 +74,179 @@ MAX_TOKENS = 1024
 # added 29/02
 TEMPERATURE = 0.1
 
-# if we want to add a reranker (Cohere or BAAI for now)
+# if we want to add a reranker (Cohere, BAAI in OCI or BAAI local for now)
 ADD_RERANKER = True
 RERANKER_MODEL = "COHERE"
 # RERANKER_MODEL = "OCI_BAAI"
+# RERANKER_MODEL = "LOCAL"
 RERANKER_ID = "ocid1.datasciencemodeldeployment.oc1.eu-frankfurt-1.amaaaaaangencdyaulxbosgii6yajt2jdsrrvfbequkxt3mepz675uk3ui3q"
+# payload sent to the OCI_BAAI deployment: cloudpickle, json, json_gzip
+# json and json_gzip need a deployment made with the updated deploy_reranker.ipynb
+RERANKER_PAYLOAD_FORMAT = "cloudpickle"
+# split the candidates in micro-batches scored concurrently
+# useful with a large TOP_K, None: a single request
+RERANK_BATCH_SIZE = None
+RERANK_MAX_WORKERS = 4
+# latency budget (sec.) for a call to the OCI_BAAI deployment, None: no limit
+# (sync calls: applied to connect and to each read, not to the whole call)
+RERANK_TIMEOUT = 5
+# send a duplicate request if the first is slower than the delay (sec.)
+# None: use the p95 of the observed latencies
+RERANK_HEDGE = False
+RERANK_HEDGE_DELAY = None
+# delay (sec.) until there are enough latencies for the p95
+# used only if RERANK_TIMEOUT is None (otherwise half of it)
+RERANK_HEDGE_DEFAULT_DELAY = 1.0
+# after N consecutive failures stop calling the deployment for RESET sec.
+# meanwhile the chain uses the vector order for top_n
+RERANK_CB_FAILURE_THRESHOLD = 5
+RERANK_CB_RESET_TIMEOUT = 30
+
+# for the LOCAL reranker (cross-encoder on CPU)
+LOCAL_RERANKER_MODEL = "BAAI/bge-reranker-large"
+LOCAL_RERANKER_BATCH_SIZE = 8
+# None: torch default
+LOCAL_RERANKER_THREADS = None
+# int8 dynamic quantization
+LOCAL_RERANKER_QUANTIZE = False
+# if set, use onnxruntime (the model is exported here the first time)
+LOCAL_RERANKER_ONNX_PATH = None
+# cache of the scores computed by the OCI_BAAI reranker
+ADD_RERANK_CACHE = False
+RERANK_CACHE_MAX_SIZE = 5000
+# in sec., None: never expires
+RERANK_CACHE_TTL = 3600
+# json file to persist the cache, None: only in memory
+RERANK_CACHE_PATH = None
+# in sec., the new scores are saved in background at most once in this interval
+RERANK_CACHE_SAVE_DELAY = 10
+# skip the OCI_BAAI rerank when the vector scores are already decisive
+# (thresholds on the DOT similarities: ignored if ADD_MULTI_QUERY)
+ADD_RERANK_BYPASS = False
+# min. gap between the similarity of the first and second hit, None: disabled
+RERANK_BYPASS_MARGIN = 0.1
+# max normalized entropy (0..1) of the similarities, None: disabled
+RERANK_BYPASS_MAX_ENTROPY = None
+RERANK_BYPASS_TEMPERATURE = 0.05
+
+# generate sub-queries of the question and fuse the results (RRF)
+ADD_MULTI_QUERY = False
+MULTI_QUERY_NUM_QUERIES = 3
+
+# fit the context (TOP_N chunks) in the window of the LLM,
+# keeping the sentences most relevant to the question
+ADD_CONTEXT_COMPRESSION = False
+LLM_CONTEXT_WINDOW = 4096
+# tokens left for the prompt template and the question
+CONTEXT_PROMPT_RESERVE = 600
+
+# cache of the embeddings of the questions
+ADD_EMBED_CACHE = False
+EMBED_CACHE_MAX_SIZE = 2000
+# SQLite file used as second tier, None: only in memory
+EMBED_CACHE_PATH = None
+
+# the questions arriving in a window of EMBED_BATCH_WAIT sec.
+# are embedded in a single call (the cache is checked before).
+# Useful with many concurrent users (rag_service), not in the single-user UIs
+ADD_EMBED_BATCHING = False
+EMBED_BATCH_MAX_SIZE = 16
+EMBED_BATCH_WAIT = 0.01
+# in sec., max wait of a question for its vector
+EMBED_BATCH_TIMEOUT = 30
+
+# semantic cache of the answers of the query engine (table ANSWER_CACHE)
+ADD_SEMANTIC_CACHE = False
+# min. similarity between the new and the cached question
+SEMANTIC_CACHE_THRESHOLD = 0.95
+# in sec., None: never expires
+SEMANTIC_CACHE_TTL = 86400
 
 # for chat engine
 CHAT_MODE = "condense_plus_context"
 MEMORY_TOKEN_LIMIT = 2800
+# the older turns are summarized (in background) by the LLM,
+# the last MEMORY_RECENT_TOKEN_LIMIT tokens are kept verbatim
+CHAT_SUMMARY_MEMORY = False
+MEMORY_RECENT_TOKEN_LIMIT = 1000
+# each UI session has its own chat engine (and memory)
+CHAT_MAX_SESSIONS = 50
+# in sec., idle sessions are removed
+CHAT_SESSION_IDLE_TIMEOUT = 1800
+# history of the sessions saved in DB (table CHAT_HISTORY),
+# a session is resumed with its last CHAT_HISTORY_LOAD_TURNS turns
+# the key of the history is in the URL (?session=...): anyone with the link
+# can read and clear the conversation, don't share it
+# (the demo has no user authentication)
+ADD_CHAT_HISTORY_STORE = False
+CHAT_HISTORY_LOAD_TURNS = 10
+# retrieval on the raw message in parallel with the condensation
+# of the question (only condense_plus_context)
+CHAT_SPECULATIVE_RETRIEVAL = False
+# min. similarity between message and condensed question to use it
+SPECULATIVE_SIMILARITY_THRESHOLD = 0.9
+
+# pool of DB connections (shared by the engines in the process)
+DB_POOL_MIN = 1
+DB_POOL_MAX = 8
+DB_POOL_INCREMENT = 1
+
+# max concurrent calls for each backend in the async engines (None: no limit)
+# vector_db should not exceed DB_POOL_MAX
+ASYNC_BACKEND_LIMITS = {"embed": 8, "vector_db": 8, "rerank": 4, "llm": 4}
 
 # bits used to store embeddings
 # possible values: 32 or 64
 # must be aligned with the create_tables.sql used
+# (VEC columns of VECTORS and ANSWER_CACHE: FLOAT64 or FLOAT32)
 EMBEDDINGS_BITS = 64
 
 # ID generation: LLINDEX, HASH, BOOK_PAGE_NUM
 # define the method to generate ID
 ID_GEN_METHOD = "HASH"
 
+# at startup, warm the DB pool and the remote services (embeddings, reranker)
+ADD_WARM_UP = False
+
+# headless service (rag_service.py)
+SERVICE_HOST = "0.0.0.0"
+SERVICE_PORT = 8000
+
+# in the UI, panel with time and tokens of each request, by stage
+SHOW_DIAGNOSTICS = False
+
+# Prometheus metrics (see pipeline_metrics.py), rag_service exposes /metrics
+# port of the metrics server for the UIs (None: not started)
+METRICS_PORT = None
+# where create_save_embeddings.py dumps the metrics of the load
+INGEST_METRICS_PATH = "ingest_metrics.prom"
+
 # Tracing
 ADD_PHX_TRACING = False
 PHX_PORT = "7777"
 PHX_HOST = "0.0.0.0"
+# if True, the Phoenix app is launched in the process (PHX_HOST, PHX_PORT),
+# False if Phoenix is already running elsewhere (then set PHX_ENDPOINT)
+PHX_LAUNCH_APP = True
+# where the spans are sent (the Phoenix collector)
+PHX_ENDPOINT = f"http://127.0.0.1:{PHX_PORT}/v1/traces"
+# fraction of the requests traced (head sampling): 1.0 all, in production lower
+PHX_SAMPLING_RATE = 1.0
+# spans are exported in background, in batches; if the queue is full
+# the spans are dropped
+PHX_MAX_QUEUE_SIZE = 2048
+PHX_EXPORT_BATCH_SIZE = 512
+PHX_SCHEDULE_DELAY_MS = 5000
 
 # UI
 ADD_REFERENCES = True
+# show the answer while it is generated (if supported by the LLM)
+STREAM_RESPONSE = False
 
 # add eventually translation in Italian
 ADD_OCI_TRANSLATOR = False
 # it will translate if the request asks for
 # for example: "...rispondi in italiano"
 WORD_TO_TRIGGER_TRANS = "italian"
+# translations kept in memory (repeated answers)
+TRANSLATION_CACHE_MAX_SIZE = 1000
@@ -0,0 +1,193 @@
+"""
+File name: context_compressor.py
+Author: Luigi Saetta
+Date created: 2024-03-13
+Date last modified: 2024-03-13
+Python Version: 3.9
+
+Description:
+    This module provides a node postprocessor that fits the context
+    (the text of the TOP_N chunks) in a budget of tokens, before the LLM call.
+    If the chunks don't fit, every chunk gets a share of the budget and is
+    reduced to its sentences most relevant to the query (overlap of terms),
+    kept in the original order. Without it the prompt is truncated
+    at the end by the service (truncate="END"), losing context blindly.
+
+Usage:
+    Import this module into other scripts to use its functions.
+    Example:
+    compressor = ContextCompressor(
+        tokenizer=cohere_tokenizer,
+        token_budget=compute_token_budget(LLM_CONTEXT_WINDOW, MAX_TOKENS, CONTEXT_PROMPT_RESERVE),
+    )
+
+    node_postprocessors = [reranker, compressor]
+
+License:
+    This code is released under the MIT License.
+
+Notes:
+    This is a part of a set of demo showing how to use Oracle Vector DB,
+    OCI GenAI service, Oracle GenAI Embeddings, to build a RAG solution,
+    where all he data (text + embeddings) are stored in Oracle DB 23c
+
+Warnings:
+    This module is in development, may change in future versions.
+"""
+
+import re
+import logging
+from typing import Any, List, Optional
+
+from llama_index.postprocessor.types import BaseNodePostprocessor
+from llama_index.schema import NodeWithScore, QueryBundle
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+# not useful to measure the relevance of a sentence
+STOP_WORDS = {
+    "the", "and", "for", "are", "what", "which", "how", "with", "that",
+    "this", "can", "you", "from", "does", "not", "there", "about", "into",
+}  # fmt: skip
+
+
+def compute_token_budget(context_window, max_tokens, reserve):
+    """
+    tokens available for the context:
+    window of the model - tokens for the answer - prompt (template, question)
+    """
+    return max(0, context_window - max_tokens - reserve)
+
+
+def split_sentences(text):
+    sentences = re.split(r"(?<=[.!?])\s+|\n\s*\n", text)
+
+    return [s.strip() for s in sentences if len(s.strip()) > 0]
+
+
+def query_terms(query):
+    return {
+        w
+        for w in re.findall(r"\w+", query.lower())
+        if len(w) > 2 and w not in STOP_WORDS
+    }
+
+
+class ContextCompressor(BaseNodePostprocessor):
+    # a tokenizers.Tokenizer (the Cohere one, used for token counting)
+    tokenizer: Any = None
+    token_budget: int = 2000
+    # stats
+    n_queries: int = 0
+    n_compressed: int = 0
+    tokens_in: int = 0
+    tokens_out: int = 0
+
+    def __init__(self, tokenizer: Any = None, token_budget: int = 2000) -> None:
+        super().__init__(token_budget=token_budget)
+
+        self.tokenizer = tokenizer
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ContextCompressor"
+
+    def _count_tokens(self, texts):
+        encodings = self.tokenizer.encode_batch(texts, add_special_tokens=False)
+
+        return encodings, [len(enc.ids) for enc in encodings]
+
+    def _compress_text(self, text, terms, share):
+        """
+        keeps the sentences with more query terms, in the original order,
+        until the share of tokens is filled
+        """
+        sentences = split_sentences(text)
+
+        if len(sentences) == 0 or share <= 0:
+            return "", 0
+
+        encodings, lengths = self._count_tokens(sentences)
+
+        scores = [len(terms & query_terms(s)) for s in sentences]
+        # most relevant first, at parity the first in the text
+        ranking = sorted(range(len(sentences)), key=lambda i: (-scores[i], i))
+
+        chosen, used = [], 0
+        for i in ranking:
+            if used + lengths[i] <= share:
+                chosen.append(i)
+                used += lengths[i]
+
+        if len(chosen) == 0:
+            # even the best sentence is too long: cut it to the share
+            best = ranking[0]
+            end = encodings[best].offsets[share - 1][1]
+
+            return sentences[best][:end], share
+
+        return " ".join(sentences[i] for i in sorted(chosen)), used
+
+    def _postprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        if len(nodes) == 0:
+            return nodes
+
+        texts = [node.node.get_content() for node in nodes]
+        _, lengths = self._count_tokens(texts)
+
+        tot_in = sum(lengths)
+        self.n_queries += 1
+        self.tokens_in += tot_in
+
+        if tot_in <= self.token_budget:
+            self.tokens_out += tot_in
+            return nodes
+
+        terms = query_terms(query_bundle.query_str) if query_bundle else set()
+
+        new_nodes = []
+        remaining = self.token_budget
+
+        # nodes are in order of relevance: the tokens not used by a node
+        # are available for the following ones
+        for i, (node, text, length) in enumerate(zip(nodes, texts, lengths)):
+            share = remaining // (len(nodes) - i)
+
+            if length <= share:
+                new_text, used = text, length
+            else:
+                new_text, used = self._compress_text(text, terms, share)
+
+            remaining -= used
+
+            # a copy: the original nodes could be shared (ex: cache)
+            new_nodes.append(
+                NodeWithScore(
+                    node=node.node.copy(update={"text": new_text}), score=node.score
+                )
+            )
+
+        tot_out = self.token_budget - remaining
+        self.n_compressed += 1
+        self.tokens_out += tot_out
+
+        logging.info(
+            f"Context compressed: {tot_in} -> {tot_out} tokens, saved {tot_in - tot_out}..."
+        )
+
+        return new_nodes
+
+    def get_metrics(self):
+        return {
+            "n_queries": self.n_queries,
+            "n_compressed": self.n_compressed,
+            "tokens_in": self.tokens_in,
+            "tokens_out": self.tokens_out,
+            "tokens_saved": self.tokens_in - self.tokens_out,
+        }
@@ -42,14 +42,13 @@ from llama_index import SimpleDirectoryReader
 from llama_index.node_parser import SentenceSplitter
 
 import oracledb
-import ads
 
-from tokenizers import Tokenizer
 
 # This is the wrapper for GenAI Embeddings
 from ads.llm import GenerativeAIEmbeddings
 
-from oci_utils import load_oci_config
+from component_registry import registry, get_auth, get_tokenizer
+from pipeline_metrics import observe_embeddings, write_metrics
 
 # this way we don't show & share
 from config_private import (
@@ -67,12 +66,12 @@ from config_private import (
 from config import (
     INPUT_FILES,
     EMBED_MODEL,
-    TOKENIZER,
     EMBEDDINGS_BITS,
     ID_GEN_METHOD,
     ENABLE_CHUNKING,
     MAX_CHUNK_SIZE,
     CHUNK_OVERLAP,
+    INGEST_METRICS_PATH,
 )
 
 # to create embeddings in batch
@@ -201,14 +200,19 @@ def check_tokenization_length(tokenizer, batch):
 
 
 # take the list of txts and return a list of embeddings vector
-def compute_embeddings(embed_model, nodes_text):
-    cohere_tokenizer = Tokenizer.from_pretrained(TOKENIZER)
+def compute_embeddings(embed_model, nodes_text, tokenizer=None):
     embeddings = []
     for i in tqdm(range(0, len(nodes_text), BATCH_SIZE)):
         batch = nodes_text[i : i + BATCH_SIZE]
 
         # here we compute embeddings for a batch
+        tStartBatch = time.time()
         embeddings_batch = embed_model.embed_documents(batch)
+
+        # calls, texts and tokens, see pipeline_metrics
+        observe_embeddings(
+            "ingest", batch, time.time() - tStartBatch, tokenizer=tokenizer
+        )
         # add to the final list
         embeddings.extend(embeddings_batch)
 
@@ -309,23 +313,28 @@ for book_name in INPUT_FILES:
     print(book_name)
 print("")
 
-oci_config = load_oci_config()
-
-# need to do this way
-api_keys_config = ads.auth.api_keys(oci_config)
+# shared with the chat engines, if in the same process
+api_keys_config = get_auth()
 
 # the embedding client
-embed_model = GenerativeAIEmbeddings(
-    compartment_id=COMPARTMENT_OCID,
-    model=EMBED_MODEL,
-    auth=api_keys_config,
-    # LS (05/02/2024) modified to avoid chunking and eerrors if tokens > 512
-    # its is a choice to simplify
-    truncate="END",
-    # Optionally you can specify keyword arguments for the OCI client, e.g. service_endpoint.
-    client_kwargs={"service_endpoint": ENDPOINT},
+embed_model = registry.get(
+    "embed_model",
+    lambda: GenerativeAIEmbeddings(
+        compartment_id=COMPARTMENT_OCID,
+        model=EMBED_MODEL,
+        auth=api_keys_config,
+        # LS (05/02/2024) modified to avoid chunking and eerrors if tokens > 512
+        # its is a choice to simplify
+        truncate="END",
+        # Optionally you can specify keyword arguments for the OCI client, e.g. service_endpoint.
+        client_kwargs={"service_endpoint": ENDPOINT},
+    ),
+    key=("OCI", EMBED_MODEL, "END"),
 )
 
+# to count the tokens embedded
+cohere_tokenizer = get_tokenizer()
+
 # connect to db
 logging.info("Connecting to Oracle DB...")
 
@@ -351,7 +360,9 @@ with oracledb.connect(user=DB_USER, password=DB_PWD, dsn=DSN) as connection:
         # process in batch (max 96 for batch, chosen BATCH_SIZE, see above)
         logging.info("Computing embeddings...")
 
-        embeddings = compute_embeddings(embed_model, nodes_text)
+        embeddings = compute_embeddings(
+            embed_model, nodes_text, tokenizer=cohere_tokenizer.encode
+        )
 
         # determine book_id and save in table BOOKS
         logging.info("Registering book...")
@@ -377,6 +388,9 @@ with oracledb.connect(user=DB_USER, password=DB_PWD, dsn=DSN) as connection:
 
 tEla = time.time() - tStart
 
+# embedding calls, tokens and latency of the load
+write_metrics(INGEST_METRICS_PATH)
+
 print("")
 print("Processing done !!!")
 print(
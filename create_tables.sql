@@ -1,6 +1,8 @@
 drop table chunks;
 drop table vectors;
 drop table BOOKS;
+drop table ANSWER_CACHE;
+drop table CHAT_HISTORY;
   
 create table BOOKS
 ("ID" NUMBER NOT NULL,
@@ -21,11 +23,39 @@ CONSTRAINT fk_book
 );
 
 
+-- the format of the vectors (FLOAT64 or FLOAT32) must be aligned
+-- with EMBEDDINGS_BITS in config.py (64 or 32): change it here, in VECTORS
+-- and in ANSWER_CACHE, if the setting is changed
 create table VECTORS
 ("ID" VARCHAR2(64) NOT NULL,
 "VEC" VECTOR(1024, FLOAT64),
 PRIMARY KEY ("ID")
 );
 
+-- semantic cache of the answers (see semantic_cache.py)
+create table ANSWER_CACHE
+("ID" VARCHAR2(64) NOT NULL,
+"QUESTION" CLOB,
+"ANSWER" CLOB,
+"NODE_IDS" VARCHAR2(4000),
+"FINGERPRINT" VARCHAR2(64),
+-- flags of the question that shape the answer (ex: translation requested)
+"VARIANT" VARCHAR2(64) DEFAULT 'default' NOT NULL,
+"VEC" VECTOR(1024, FLOAT64),
+"CREATED_AT" TIMESTAMP,
+PRIMARY KEY ("ID")
+);
 
+-- history of the chat sessions (see chat_history_store.py)
+create table CHAT_HISTORY
+("ID" NUMBER GENERATED ALWAYS AS IDENTITY,
+"SESSION_ID" VARCHAR2(64) NOT NULL,
+"ROLE" VARCHAR2(16) NOT NULL,
+"CONTENT" CLOB,
+-- json, metadata of the chunks used for an answer (the references)
+"SOURCES" CLOB,
+"CREATED_AT" TIMESTAMP DEFAULT SYSTIMESTAMP,
+PRIMARY KEY ("ID")
+);
 
+create index CHAT_HISTORY_SESSION_IDX on CHAT_HISTORY ("SESSION_ID", "ID");
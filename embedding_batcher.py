@@ -0,0 +1,162 @@
+"""
+File name: embedding_batcher.py
+Author: Luigi Saetta
+Date created: 2024-03-13
+Date last modified: 2024-03-13
+Python Version: 3.9
+
+Description:
+    This module provides a wrapper for the LangChain embeddings that coalesces
+    the questions arriving at the same time (ex: many requests to rag_service)
+    in a single embed_documents call: the first question opens a small time
+    window, the questions arriving in the window are embedded together.
+    One call to the embeddings service instead of one for each request.
+    When max_calls calls are in progress, the next batch is not closed:
+    the questions arriving meanwhile are merged in it.
+
+Usage:
+    Import this module into other scripts to use its functions.
+    Example:
+    embed_model = BatchingEmbeddings(
+        GenerativeAIEmbeddings(...), max_batch_size=16, max_wait=0.01
+    )
+
+License:
+    This code is released under the MIT License.
+
+Notes:
+    This is a part of a set of demo showing how to use Oracle Vector DB,
+    OCI GenAI service, Oracle GenAI Embeddings, to build a RAG solution,
+    where all he data (text + embeddings) are stored in Oracle DB 23c
+
+Warnings:
+    This module is in development, may change in future versions.
+"""
+
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+class BatchingEmbeddings(Embeddings):
+    def __init__(
+        self,
+        embed_model,
+        max_batch_size=16,
+        max_wait=0.01,
+        max_calls=4,
+        timeout=30,
+    ):
+        """
+        embed_model: the LangChain embeddings to wrap
+        max_batch_size: max num. of texts in a call (within the service limit)
+        max_wait: in sec., the window to collect the questions
+        max_calls: max num. of calls in progress at the same time
+        timeout: in sec., max wait of a question for its vector
+        """
+        self.embed_model = embed_model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.timeout = timeout
+
+        # (text, future)
+        self._queue = queue.Queue()
+
+        # a new batch is collected while the previous one is embedded,
+        # but only if a call can start: otherwise the questions accumulate
+        self._slots = threading.BoundedSemaphore(max_calls)
+        self._executor = ThreadPoolExecutor(max_workers=max_calls)
+
+        self._lock = threading.Lock()
+        self.n_calls = 0
+        self.n_texts = 0
+
+        # daemon: doesn't prevent the exit of the process
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def _collect(self):
+        # blocks until the first question arrives
+        batch = [self._queue.get()]
+        deadline = time.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+
+            if timeout <= 0:
+                break
+
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _embed_batch(self, batch):
+        texts = [text for text, _ in batch]
+
+        try:
+            vectors = self.embed_model.embed_documents(texts)
+
+            if len(vectors) != len(texts):
+                raise ValueError(
+                    f"Embeddings: {len(vectors)} vectors for {len(texts)} texts"
+                )
+
+            with self._lock:
+                self.n_calls += 1
+                self.n_texts += len(texts)
+
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+        except Exception as e:
+            # every caller gets the error
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+        finally:
+            # no caller must wait forever
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError("Embedding not computed"))
+
+            self._slots.release()
+
+    def _run(self):
+        while True:
+            # waits for a free call before closing the next batch
+            self._slots.acquire()
+
+            self._executor.submit(self._embed_batch, self._collect())
+
+    def embed_query(self, text: str) -> List[float]:
+        future = Future()
+        self._queue.put((text, future))
+
+        return future.result(timeout=self.timeout)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        # already a batch: no need to wait
+        return self.embed_model.embed_documents(texts)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "n_calls": self.n_calls,
+                "n_texts": self.n_texts,
+                "avg_batch_size": (
+                    round(self.n_texts / self.n_calls, 2) if self.n_calls > 0 else 0.0
+                ),
+            }
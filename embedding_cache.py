@@ -0,0 +1,221 @@
+"""
+File name: embedding_cache.py
+Author: Luigi Saetta
+Date created: 2024-03-13
+Date last modified: 2024-03-13
+Python Version: 3.9
+
+Description:
+    This module provides a caching wrapper for the LangChain embeddings
+    (ex: GenerativeAIEmbeddings). The same question (retries, reruns of the UI,
+    evaluation) is embedded only once: vectors are kept in a bounded LRU
+    in memory and, optionally, in a SQLite file, a second tier that survives
+    restarts. Keys are: model name + hash of the normalized text.
+    Only the calls to the wrapped model (the misses) are recorded in the
+    embedding metrics, with stage query (see pipeline_metrics).
+
+Usage:
+    Import this module into other scripts to use its functions.
+    Example:
+    embed_model = CachedEmbeddings(
+        GenerativeAIEmbeddings(...), model_name=EMBED_MODEL, max_size=2000
+    )
+
+    embed_model.get_stats()
+
+License:
+    This code is released under the MIT License.
+
+Notes:
+    This is a part of a set of demo showing how to use Oracle Vector DB,
+    OCI GenAI service, Oracle GenAI Embeddings, to build a RAG solution,
+    where all he data (text + embeddings) are stored in Oracle DB 23c
+
+Warnings:
+    This module is in development, may change in future versions.
+"""
+
+import time
+import array
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+from oci_utils import hash_text
+from pipeline_metrics import CACHE_HITS, CACHE_MISSES, observe_embeddings
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+def normalize_text(text):
+    # only whitespaces: the model is case sensitive
+    return " ".join(text.split())
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(
+        self,
+        embed_model,
+        model_name,
+        max_size=2000,
+        persist_path=None,
+        tokenizer=None,
+    ):
+        """
+        embed_model: the LangChain embeddings to wrap
+        model_name: added to the keys, to avoid using vectors of another model
+        max_size: max num. of vectors kept in memory
+        persist_path: if set, a SQLite file used as second tier
+        tokenizer: function str -> list of tokens, for the metrics of the
+            calls to the model. If None tokens are not counted
+        """
+        self.embed_model = embed_model
+        self.model_name = model_name
+        self.max_size = max_size
+        self.persist_path = persist_path
+        self.tokenizer = tokenizer
+
+        # key -> vector
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+
+        self._db = None
+
+        if persist_path is not None:
+            # the wrapper is shared between threads (Streamlit sessions)
+            self._db = sqlite3.connect(persist_path, check_same_thread=False)
+            self._db.execute(
+                "create table if not exists EMBEDDINGS (KEY text primary key, VEC blob)"
+            )
+            self._db.commit()
+
+    def make_key(self, text):
+        return f"{self.model_name}:{hash_text(normalize_text(text))}"
+
+    def _get_persistent(self, key):
+        row = self._db.execute(
+            "select VEC from EMBEDDINGS where KEY = ?", (key,)
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        return array.array("d", row[0]).tolist()
+
+    def _get(self, key):
+        with self._lock:
+            vector = self._cache.get(key)
+
+            if vector is not None:
+                # mark as recently used
+                self._cache.move_to_end(key)
+                self.memory_hits += 1
+                CACHE_HITS.labels(cache="embedding").inc()
+                return vector
+
+            if self._db is not None:
+                vector = self._get_persistent(key)
+
+                if vector is not None:
+                    self.persistent_hits += 1
+                    CACHE_HITS.labels(cache="embedding").inc()
+                    self._put_memory(key, vector)
+                    return vector
+
+            self.misses += 1
+            CACHE_MISSES.labels(cache="embedding").inc()
+
+            return None
+
+    def _put_memory(self, key, vector):
+        self._cache[key] = vector
+        self._cache.move_to_end(key)
+
+        while len(self._cache) > self.max_size:
+            # evict the least recently used
+            self._cache.popitem(last=False)
+
+    def _put(self, key, vector):
+        with self._lock:
+            self._put_memory(key, vector)
+
+            if self._db is not None:
+                self._db.execute(
+                    "insert or replace into EMBEDDINGS values (?, ?)",
+                    (key, array.array("d", vector).tobytes()),
+                )
+                self._db.commit()
+
+    def _observe(self, texts, tStart):
+        # a call to the model: the hits are not counted here
+        observe_embeddings(
+            "query", texts, time.time() - tStart, tokenizer=self.tokenizer
+        )
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self.make_key(text)
+
+        vector = self._get(key)
+
+        if vector is None:
+            tStart = time.time()
+            vector = self.embed_model.embed_query(text)
+            self._observe([text], tStart)
+
+            self._put(key, vector)
+
+        return vector
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self.make_key(text) for text in texts]
+        vectors = [self._get(key) for key in keys]
+
+        # only the texts not in cache, in a single call
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+
+        if len(missing) > 0:
+            missing_texts = [texts[i] for i in missing]
+
+            tStart = time.time()
+            new_vectors = self.embed_model.embed_documents(missing_texts)
+            self._observe(missing_texts, tStart)
+
+            for i, vector in zip(missing, new_vectors):
+                vectors[i] = vector
+                self._put(keys[i], vector)
+
+        return vectors
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+            if self._db is not None:
+                self._db.execute("delete from EMBEDDINGS")
+                self._db.commit()
+
+    @property
+    def hit_rate(self):
+        hits = self.memory_hits + self.persistent_hits
+        tot = hits + self.misses
+
+        return hits / tot if tot > 0 else 0.0
+
+    def get_stats(self):
+        return {
+            "memory_hits": self.memory_hits,
+            "persistent_hits": self.persistent_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hit_rate, 3),
+            "size": len(self._cache),
+        }
@@ -0,0 +1,233 @@
+"""
+File name: local_reranker.py
+Author: Luigi Saetta
+Date created: 2024-03-12
+Date last modified: 2024-03-12
+Python Version: 3.9
+
+Description:
+    This module provides a reranker running locally, on CPU,
+    a cross-encoder (by default the same BAAI/bge-reranker-large
+    deployed in OCI Data Science). It has the same rerank(query, texts, top_n)
+    contract as OCIBAAIReranker, so it can be wrapped by OCILLamaReranker
+    and used to run and benchmark the pipeline offline.
+
+    Options:
+    - batched inference
+    - num. of threads used by torch/onnxruntime
+    - int8 dynamic quantization
+    - onnxruntime (the model is exported to ONNX the first time)
+
+Usage:
+    Import this module into other scripts to use its functions.
+    Example:
+    local_reranker = LocalCrossEncoderReranker(
+        model_name="BAAI/bge-reranker-large", batch_size=8, num_threads=4
+    )
+
+    reranker = OCILLamaReranker(oci_reranker=local_reranker, top_n=TOP_N)
+
+License:
+    This code is released under the MIT License.
+
+Notes:
+    This is a part of a set of demo showing how to use Oracle Vector DB,
+    OCI GenAI service, Oracle GenAI Embeddings, to build a RAG solution,
+    where all he data (text + embeddings) are stored in Oracle DB 23c
+
+Warnings:
+    This module is in development, may change in future versions.
+"""
+
+import os
+import time
+import heapq
+import logging
+
+import torch
+from transformers import AutoTokenizer, AutoModelForSequenceClassification
+
+from pipeline_metrics import (
+    RERANK_BATCH_SIZE,
+    RERANK_CALL_SECONDS,
+    RERANK_CALL_FAILURES,
+)
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+# label of the Prometheus metrics
+METRICS_BACKEND = "local"
+
+
+class LocalCrossEncoderReranker:
+    def __init__(
+        self,
+        model_name="BAAI/bge-reranker-large",
+        batch_size=8,
+        max_length=512,
+        num_threads=None,
+        quantize=False,
+        onnx_path=None,
+    ):
+        """
+        model_name: the cross-encoder, from HF Hub or a local dir
+        batch_size: num. of couples scored in a single forward pass
+        max_length: max num. of tokens of a (query, text) couple
+        num_threads: threads used for inference (None: library default)
+        quantize: if True, int8 dynamic quantization of the Linear layers
+        onnx_path: if set, inference is done with onnxruntime using this file
+            (exported from the model if it doesn't exist)
+        """
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_length = max_length
+
+        tStart = time.time()
+
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModelForSequenceClassification.from_pretrained(model_name)
+        self.model.eval()
+
+        self.ort_session = None
+
+        if onnx_path is not None:
+            self.ort_session = self._load_onnx(onnx_path, num_threads, quantize)
+        elif quantize:
+            self.model = torch.quantization.quantize_dynamic(
+                self.model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+
+        tEla = time.time() - tStart
+
+        logging.info("Created local reranker...")
+        logging.info(f"Model: {model_name}...")
+        logging.info(
+            f"Batch size: {batch_size}, threads: {num_threads}, int8: {quantize}, onnx: {onnx_path is not None}..."
+        )
+        logging.info(f"Loaded in {round(tEla, 1)} sec.")
+        logging.info("")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "LocalCrossEncoderReranker"
+
+    def _export_onnx(self, onnx_path):
+        logging.info(f"Exporting {self.model_name} to ONNX in {onnx_path}...")
+
+        dummy = self.tokenizer(
+            [["query", "text"]], padding=True, truncation=True, return_tensors="pt"
+        )
+        input_names = list(dummy.keys())
+
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+        dynamic_axes["logits"] = {0: "batch"}
+
+        torch.onnx.export(
+            self.model,
+            tuple(dummy[name] for name in input_names),
+            onnx_path,
+            input_names=input_names,
+            output_names=["logits"],
+            dynamic_axes=dynamic_axes,
+            opset_version=14,
+        )
+
+    def _load_onnx(self, onnx_path, num_threads, quantize):
+        # imported here: needed only with onnx
+        import onnxruntime as ort
+
+        if not os.path.exists(onnx_path):
+            self._export_onnx(onnx_path)
+
+        if quantize:
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+
+            quantized_path = onnx_path.replace(".onnx", "") + "_int8.onnx"
+
+            if not os.path.exists(quantized_path):
+                quantize_dynamic(onnx_path, quantized_path, weight_type=QuantType.QInt8)
+
+            onnx_path = quantized_path
+
+        options = ort.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+
+        return ort.InferenceSession(
+            onnx_path, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+
+    def compute_score(self, x):
+        """
+        Same interface of BAAI compute_score
+        x: a list of couple of strings to be compared
+        example: [["input1", "input2"]]
+        """
+        scores = []
+
+        for i in range(0, len(x), self.batch_size):
+            batch = x[i : i + self.batch_size]
+
+            if self.ort_session is not None:
+                inputs = self.tokenizer(
+                    batch,
+                    padding=True,
+                    truncation=True,
+                    max_length=self.max_length,
+                    return_tensors="np",
+                )
+                input_names = [inp.name for inp in self.ort_session.get_inputs()]
+                logits = self.ort_session.run(
+                    ["logits"], {name: inputs[name] for name in input_names}
+                )[0]
+                scores.extend(logits.reshape(-1).tolist())
+            else:
+                inputs = self.tokenizer(
+                    batch,
+                    padding=True,
+                    truncation=True,
+                    max_length=self.max_length,
+                    return_tensors="pt",
+                )
+                with torch.inference_mode():
+                    logits = self.model(**inputs, return_dict=True).logits
+
+                scores.extend(logits.view(-1).float().tolist())
+
+        return scores
+
+    def rerank(self, query, texts, top_n=2, fallback_scores=None):
+        """
+        Same contract as OCIBAAIReranker.rerank
+        - query
+        - texts: List[str] are compared and reranked with query
+        """
+        RERANK_BATCH_SIZE.labels(backend=METRICS_BACKEND).observe(len(texts))
+
+        try:
+            with RERANK_CALL_SECONDS.labels(backend=METRICS_BACKEND).time():
+                scores = self.compute_score([[query, text] for text in texts])
+
+            data = [
+                {"text": text, "index": index, "relevance_score": score}
+                for index, (text, score) in enumerate(zip(texts, scores))
+            ]
+
+            # only top_n, in decreasing score
+            sorted_data = heapq.nlargest(
+                top_n, data, key=lambda x: x["relevance_score"]
+            )
+
+        except Exception as e:
+            logging.error("Error in LocalCrossEncoderReranker rerank...")
+            logging.error(e)
+            RERANK_CALL_FAILURES.labels(backend=METRICS_BACKEND).inc()
+
+            return []
+
+        return sorted_data
@@ -0,0 +1,284 @@
+"""
+File name: multi_query_retriever.py
+Author: Luigi Saetta
+Date created: 2024-03-13
+Date last modified: 2024-03-13
+Python Version: 3.9
+
+Description:
+    This module provides a retriever for compound questions: the LLM generates
+    some sub-queries (or paraphrases) of the question, they're embedded
+    in a single batched call and the vector searches run concurrently
+    (the connections come from the DB pool). The lists of results are fused
+    with Reciprocal Rank Fusion (RRF), before the reranker.
+
+    To contain the latency, the search for the original question runs
+    while the LLM generates the sub-queries.
+
+    The scores of the nodes returned are RRF scores (higher is better),
+    not distances.
+
+Usage:
+    Import this module into other scripts to use its functions.
+    Example:
+    retriever = MultiQueryRetriever(
+        vector_store=v_store,
+        service_context=service_context,
+        similarity_top_k=TOP_K,
+        num_queries=3,
+    )
+
+License:
+    This code is released under the MIT License.
+
+Notes:
+    This is a part of a set of demo showing how to use Oracle Vector DB,
+    OCI GenAI service, Oracle GenAI Embeddings, to build a RAG solution,
+    where all he data (text + embeddings) are stored in Oracle DB 23c
+
+Warnings:
+    This module is in development, may change in future versions.
+"""
+
+import re
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from llama_index.core.base_retriever import BaseRetriever
+from llama_index.prompts import PromptTemplate
+from llama_index.schema import NodeWithScore, QueryBundle
+from llama_index.vector_stores.types import VectorStoreQuery
+
+from request_metrics import submit_with_context
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+MULTI_QUERY_PROMPT = PromptTemplate(
+    "You help to search a knowledge base.\n"
+    "Write {num_queries} search queries that together cover all the information "
+    "needed to answer the question below: split a compound question in its parts, "
+    "otherwise write paraphrases.\n"
+    "Write one query per line, without numbers or other text.\n"
+    "Question: {query}\n"
+    "Queries:\n"
+)
+
+
+def parse_queries(text, num_queries):
+    queries = []
+
+    for line in text.split("\n"):
+        # remove numbering and bullets, if the LLM added them
+        query = re.sub(r"^\s*(?:[-*]|\d+[.)])\s*", "", line).strip()
+
+        if len(query) > 0 and query not in queries:
+            queries.append(query)
+
+    return queries[:num_queries]
+
+
+def reciprocal_rank_fusion(results_lists, k=60, top_k=None):
+    """
+    results_lists: list of lists of NodeWithScore, each in rank order
+    returns a single list ordered by sum(1 / (k + rank))
+    """
+    fused_scores = {}
+    nodes = {}
+
+    for results in results_lists:
+        for rank, node in enumerate(results):
+            node_id = node.node.node_id
+
+            fused_scores[node_id] = fused_scores.get(node_id, 0.0) + 1.0 / (
+                k + rank + 1
+            )
+            nodes.setdefault(node_id, node.node)
+
+    ranked_ids = sorted(fused_scores, key=lambda x: fused_scores[x], reverse=True)
+
+    if top_k is not None:
+        ranked_ids = ranked_ids[:top_k]
+
+    return [
+        NodeWithScore(node=nodes[node_id], score=fused_scores[node_id])
+        for node_id in ranked_ids
+    ]
+
+
+class MultiQueryRetriever(BaseRetriever):
+    def __init__(
+        self,
+        vector_store,
+        service_context,
+        similarity_top_k=8,
+        num_queries=3,
+        rrf_k=60,
+        max_workers=4,
+        verbose=False,
+    ):
+        """
+        vector_store: OracleVectorStore
+        similarity_top_k: results for each query and after fusion
+        num_queries: num. of sub-queries generated (in addition to the question)
+        rrf_k: constant of RRF, reduces the weight of the first positions
+        max_workers: concurrent vector searches (within the DB pool size)
+        """
+        self._vector_store = vector_store
+        self._service_context = service_context
+        self.similarity_top_k = similarity_top_k
+        self.num_queries = num_queries
+        self.rrf_k = rrf_k
+        self.verbose = verbose
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        super().__init__(callback_manager=service_context.callback_manager)
+
+    def get_service_context(self):
+        return self._service_context
+
+    def _vector_query(self, embedding):
+        return VectorStoreQuery(
+            query_embedding=embedding, similarity_top_k=self.similarity_top_k
+        )
+
+    def _to_nodes(self, result):
+        # oracle_query returns None on error: the other queries are still good
+        if result is None:
+            return []
+
+        return [
+            NodeWithScore(node=node, score=score)
+            for node, score in zip(result.nodes, result.similarities)
+        ]
+
+    def _search(self, embedding):
+        return self._to_nodes(self._vector_store.query(self._vector_query(embedding)))
+
+    async def _asearch(self, embedding):
+        # aquery limits the concurrent searches (ASYNC_BACKEND_LIMITS)
+        result = await self._vector_store.aquery(self._vector_query(embedding))
+
+        return self._to_nodes(result)
+
+    def _search_query(self, query):
+        embedding = self._service_context.embed_model.get_query_embedding(query)
+
+        return self._search(embedding)
+
+    def _generate_queries(self, query):
+        response = self._service_context.llm.predict(
+            MULTI_QUERY_PROMPT, num_queries=self.num_queries, query=query
+        )
+
+        return parse_queries(response, self.num_queries)
+
+    async def _agenerate_queries(self, query):
+        # imported here, only the async engines need it
+        from async_limits import SYNC_ONLY_LLMS
+
+        llm = self._service_context.llm
+
+        if isinstance(llm, SYNC_ONLY_LLMS):
+            # apredict would block the event loop
+            response = await asyncio.to_thread(
+                llm.predict,
+                MULTI_QUERY_PROMPT,
+                num_queries=self.num_queries,
+                query=query,
+            )
+        else:
+            response = await llm.apredict(
+                MULTI_QUERY_PROMPT, num_queries=self.num_queries, query=query
+            )
+
+        return parse_queries(response, self.num_queries)
+
+    def _fuse(self, results_lists, queries, tStart):
+        nodes = reciprocal_rank_fusion(
+            results_lists, k=self.rrf_k, top_k=self.similarity_top_k
+        )
+
+        if self.verbose:
+            logging.info(f"Multi query: {queries}")
+            logging.info(
+                f"Fused {sum(len(r) for r in results_lists)} results in {len(nodes)} nodes, "
+                f"in {round(time.time() - tStart, 2)} sec."
+            )
+
+        return nodes
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        tStart = time.time()
+
+        # the search for the question runs during the generation
+        # (in the context of the request, for the metrics)
+        if query_bundle.embedding is not None:
+            original = submit_with_context(
+                self._executor, self._search, query_bundle.embedding
+            )
+        else:
+            original = submit_with_context(
+                self._executor, self._search_query, query_bundle.query_str
+            )
+
+        try:
+            queries = self._generate_queries(query_bundle.query_str)
+        except Exception as e:
+            logging.error("Error generating the queries, using only the question...")
+            logging.error(e)
+            queries = []
+
+        results_lists = []
+
+        if len(queries) > 0:
+            # a single call for all the embeddings
+            embeddings = self._service_context.embed_model.get_text_embedding_batch(
+                queries
+            )
+            futures = [
+                submit_with_context(self._executor, self._search, embedding)
+                for embedding in embeddings
+            ]
+            results_lists = [future.result() for future in futures]
+
+        return self._fuse([original.result()] + results_lists, queries, tStart)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        tStart = time.time()
+
+        embed_model = self._service_context.embed_model
+
+        async def search_original():
+            embedding = query_bundle.embedding
+
+            if embedding is None:
+                embedding = await embed_model.aget_query_embedding(
+                    query_bundle.query_str
+                )
+
+            return await self._asearch(embedding)
+
+        original = asyncio.create_task(search_original())
+
+        try:
+            queries = await self._agenerate_queries(query_bundle.query_str)
+        except Exception as e:
+            logging.error("Error generating the queries, using only the question...")
+            logging.error(e)
+            queries = []
+
+        results_lists = []
+
+        if len(queries) > 0:
+            embeddings = await embed_model.aget_text_embedding_batch(queries)
+            results_lists = await asyncio.gather(
+                *[self._asearch(e) for e in embeddings]
+            )
+
+        return self._fuse([await original] + list(results_lists), queries, tStart)
@@ -2,7 +2,7 @@
 File name: oci_baai_reranker.py
 Author: Luigi Saetta
 Date created: 2023-12-30
-Date last modified: 2024-01-02
+Date last modified: 2024-03-10
 Python Version: 3.9
 
 Description:
@@ -37,23 +37,141 @@ Warnings:
 import cloudpickle
 import requests
 import base64
+import gzip
+import json
+import heapq
+import time
+import asyncio
 import logging
+import threading
+import aiohttp
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+
+from resilience import LatencyTracker
+from pipeline_metrics import (
+    RERANK_BATCH_SIZE,
+    RERANK_CALL_SECONDS,
+    RERANK_CALL_FAILURES,
+)
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
+#
+# formats for the payload sent to the Model Deployment
+# cloudpickle: the original one, list of [query, text] pickled and base64 encoded
+# json: compact, the query is sent once with the list of texts
+# json_gzip: as json, but gzip compressed and base64 encoded
+#
+PAYLOAD_FORMATS = ["cloudpickle", "json", "json_gzip"]
+
+# label of the Prometheus metrics
+METRICS_BACKEND = "oci_baai"
+
+# tag used in the compact payload, the deployed model uses it to
+# recognize the format
+COMPACT_FORMAT_TAG = "rerank-v1"
+
+
+def decode_compact_payload(x):
+    """
+    Decode, on the server side, a compact payload into the list of
+    [query, text] couples expected by BAAI compute_score
+
+    The same logic is in the Reranker.predict wrapper in deploy_reranker.ipynb,
+    here it is used for tests and benchmarks
+    """
+    msg = x[0]
+
+    if msg["format"] == COMPACT_FORMAT_TAG + "+gzip":
+        msg = json.loads(gzip.decompress(base64.b64decode(msg["payload"])))
+
+    return [[msg["query"], text] for text in msg["texts"]]
+
+
+def score_order_key(item):
+    """
+    Key to order the results of rerank: texts scored by the reranker
+    come first, then the ones with a fallback score (in vector order)
+    """
+    return (not item.get("fallback", False), item["relevance_score"])
+
 
 class OCIBAAIReranker:
-    def __init__(self, auth, deployment_id, region="eu-frankfurt-1"):
+    def __init__(
+        self,
+        auth,
+        deployment_id,
+        region="eu-frankfurt-1",
+        payload_format="cloudpickle",
+        batch_size=None,
+        max_workers=4,
+        timeout=None,
+        hedge=False,
+        hedge_delay=None,
+        default_hedge_delay=1.0,
+        circuit_breaker=None,
+    ):
         """
         auth: to manage OCI auth
         deployment_id: the ocid of the model deployment
         region: the OCI region where the deployment is
-        top_n: how many to return
+        payload_format: one of PAYLOAD_FORMATS. The compact formats (json, json_gzip)
+            require a deployment using the updated Reranker wrapper
+        batch_size: if set, texts are split in micro-batches of this size,
+            scored concurrently (None: a single request)
+        max_workers: max num. of micro-batches in flight
+        timeout: latency budget (sec.) for a call to the deployment (None: no limit).
+            In rerank (requests) it applies to the connect and to each read
+            separately, not to the whole call; in arerank (aiohttp) it is total
+        hedge: if True, a duplicate request is sent if the first one is slower
+            than hedge_delay, the first answer wins
+        hedge_delay: in sec., if None the p95 of the observed latencies is used
+        default_hedge_delay: in sec., used until there are enough latencies
+            for the p95, if there is no timeout (otherwise half of it)
+        circuit_breaker: optional resilience.CircuitBreaker, when open the
+            deployment is not called and rerank returns []
         """
+        if payload_format not in PAYLOAD_FORMATS:
+            raise ValueError(
+                f"The value {payload_format} is not supported. Choose a value in {PAYLOAD_FORMATS} for the payload format."
+            )
+
         self.auth = auth
         self.deployment_id = deployment_id
+        self.payload_format = payload_format
+        self.batch_size = batch_size
+
+        self.timeout = timeout
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self.default_hedge_delay = default_hedge_delay
+        self.circuit_breaker = circuit_breaker
+
+        self._executor = None
+        if batch_size is not None:
+            self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        # to run primary and hedged requests
+        self._hedge_executor = None
+        if hedge:
+            self._hedge_executor = ThreadPoolExecutor(max_workers=2 * max_workers)
+
+        self.latency_tracker = LatencyTracker()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "n_calls": 0,
+            "n_failures": 0,
+            "n_timeouts": 0,
+            "n_hedged": 0,
+            "n_hedge_wins": 0,
+        }
+
+        # for arerank: loop -> aiohttp session, created when first used,
+        # closed by aclose
+        self._async_sessions = {}
+        self._sessions_lock = threading.Lock()
 
         # build the endpoint
         BASE_URL = f"https://modeldeployment.{region}.oci.customer-oci.com/"
@@ -62,6 +180,11 @@ class OCIBAAIReranker:
         logging.info("Created OCI reranker client...")
         logging.info(f"Region: {region}...")
         logging.info(f"Deployment id: {deployment_id}...")
+        logging.info(f"Payload format: {payload_format}...")
+        if batch_size is not None:
+            logging.info(f"Micro-batch size: {batch_size}, workers: {max_workers}...")
+        if timeout is not None:
+            logging.info(f"Latency budget: {timeout} sec., hedged requests: {hedge}...")
         logging.info("")
 
     def _build_body(cls, input_list):
@@ -76,6 +199,38 @@ class OCIBAAIReranker:
 
         return body
 
+    def _build_compact_body(self, query, texts):
+        """
+        This method builds the body in the compact format:
+        the query is sent only once, followed by the list of texts.
+        The message is wrapped in a list so that the deployment passes it
+        unchanged to the predict method
+        """
+        msg = {"format": COMPACT_FORMAT_TAG, "query": query, "texts": texts}
+
+        if self.payload_format == "json_gzip":
+            compressed = gzip.compress(
+                json.dumps(msg, separators=(",", ":")).encode("utf-8")
+            )
+            msg = {
+                "format": COMPACT_FORMAT_TAG + "+gzip",
+                "payload": base64.b64encode(compressed).decode("utf-8"),
+            }
+
+        return {"data": [msg]}
+
+    def build_request_body(self, query, texts):
+        """
+        Returns the body for the POST call, in the configured payload format
+        """
+        if self.payload_format == "cloudpickle":
+            # BAAI reranker expects input in this way
+            # x is a list of list, like [['what is panda?', 'The giant panda is a bear.'],
+            #  ['what is panda?', 'It is an animal living in China']]
+            return self._build_body([[query, text] for text in texts])
+
+        return self._build_compact_body(query, texts)
+
     @classmethod
     def class_name(cls) -> str:
         return "OCIBAAIReranker"
@@ -90,9 +245,20 @@ class OCIBAAIReranker:
         # prepares the body for the Model Deployment invocation
         body = self._build_body(x)
 
+        return self._invoke(body)
+
+    def _invoke(self, body, timeout=None):
+        """
+        Makes the https POST call to the Model Deployment
+        """
         try:
             # here we invoke the deployment
-            response = requests.post(self.endpoint, json=body, auth=self.auth["signer"])
+            response = requests.post(
+                self.endpoint,
+                json=body,
+                auth=self.auth["signer"],
+                timeout=timeout if timeout is not None else self.timeout,
+            )
 
             # check if HTTP status is OK
             if response.status_code == 200:
@@ -108,47 +274,426 @@ class OCIBAAIReranker:
             logging.error("Error in OCIBAAIReranker compute_score...")
             logging.error(e)
 
+            if isinstance(e, requests.exceptions.Timeout):
+                self._inc_stat("n_timeouts")
+
+            return []
+
+        return response
+
+    @staticmethod
+    def _get_predictions(response):
+        # for a single couple the model returns a float, not a list
+        predictions = response["prediction"]
+
+        if not isinstance(predictions, list):
+            predictions = [predictions]
+
+        return predictions
+
+    def _sign_request(self, body):
+        """
+        The OCI signer works on requests objects: the request is prepared
+        and signed here, then headers and body are sent with aiohttp
+        """
+        prepared = requests.Request(
+            "POST", self.endpoint, json=body, auth=self.auth["signer"]
+        ).prepare()
+
+        return dict(prepared.headers), prepared.body
+
+    async def _get_async_session(self):
+        """
+        a session is bound to the event loop where it has been created:
+        one for each loop
+        """
+        loop = asyncio.get_running_loop()
+
+        with self._sessions_lock:
+            # a loop ended without aclose: its session can't be used anymore
+            for old_loop in [x for x in self._async_sessions if x.is_closed()]:
+                del self._async_sessions[old_loop]
+
+            if loop not in self._async_sessions:
+                self._async_sessions[loop] = aiohttp.ClientSession()
+
+            return self._async_sessions[loop]
+
+    async def _ainvoke(self, body, timeout=None):
+        """
+        Async version of _invoke, doesn't block the event loop
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        try:
+            headers, data = self._sign_request(body)
+
+            session = await self._get_async_session()
+
+            async with session.post(
+                self.endpoint,
+                data=data,
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=timeout),
+            ) as response:
+                # check if HTTP status is OK
+                if response.status == 200:
+                    return await response.json()
+
+                logging.error(
+                    f"Error in OCIBAAIReranker compute_score: {await response.text()}"
+                )
+                return []
+
+        except Exception as e:
+            logging.error("Error in OCIBAAIReranker compute_score...")
+            logging.error(e)
+
+            if isinstance(e, asyncio.TimeoutError):
+                self._inc_stat("n_timeouts")
+
             return []
 
+    def _inc_stat(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def _get_hedge_delay(self):
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+
+        # need some samples to have a meaningful p95
+        if len(self.latency_tracker) < 20:
+            # without a delay the first requests would never be hedged
+            if self.timeout is not None:
+                return self.timeout / 2
+
+            return self.default_hedge_delay
+
+        return self.latency_tracker.percentile(95)
+
+    def _remaining_budget(self, elapsed):
+        if self.timeout is None:
+            return None
+
+        return max(self.timeout - elapsed, 0.1)
+
+    def _before_call(self, n_texts):
+        if (
+            self.circuit_breaker is not None
+            and not self.circuit_breaker.allow_request()
+        ):
+            logging.warning("OCIBAAIReranker: circuit open, deployment not called...")
+            RERANK_CALL_FAILURES.labels(backend=METRICS_BACKEND).inc()
+            return False
+
+        self._inc_stat("n_calls")
+        RERANK_BATCH_SIZE.labels(backend=METRICS_BACKEND).observe(n_texts)
+        return True
+
+    def _after_call(self, response, elapsed):
+        if len(response) > 0:
+            self.latency_tracker.add(elapsed)
+            RERANK_CALL_SECONDS.labels(backend=METRICS_BACKEND).observe(elapsed)
+
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.record_success()
+        else:
+            self._inc_stat("n_failures")
+            RERANK_CALL_FAILURES.labels(backend=METRICS_BACKEND).inc()
+
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.record_failure()
+
         return response
 
-    def rerank(self, query, texts, top_n=2):
+    def _call(self, body, n_texts):
+        """
+        Invoke the deployment within the latency budget,
+        with the circuit breaker and (optionally) the hedged request
+        """
+        if not self._before_call(n_texts):
+            return []
+
+        t_start = time.time()
+
+        if self.hedge:
+            response = self._invoke_hedged(body)
+        else:
+            response = self._invoke(body)
+
+        return self._after_call(response, time.time() - t_start)
+
+    def _invoke_hedged(self, body):
+        delay = self._get_hedge_delay()
+        t_start = time.time()
+
+        primary = self._hedge_executor.submit(self._invoke, body)
+
+        try:
+            # if it fails before the delay, we don't hedge
+            return primary.result(timeout=delay)
+        except TimeoutError:
+            pass
+
+        self._inc_stat("n_hedged")
+        backup = self._hedge_executor.submit(
+            self._invoke, body, self._remaining_budget(time.time() - t_start)
+        )
+
+        # the first successful answer wins
+        for future in as_completed([primary, backup]):
+            response = future.result()
+
+            if len(response) > 0:
+                if future is backup:
+                    self._inc_stat("n_hedge_wins")
+                return response
+
+        return []
+
+    async def _acall(self, body, n_texts):
+        """
+        Async version of _call
+        """
+        if not self._before_call(n_texts):
+            return []
+
+        t_start = time.time()
+
+        if self.hedge:
+            response = await self._ainvoke_hedged(body)
+        else:
+            response = await self._ainvoke(body)
+
+        return self._after_call(response, time.time() - t_start)
+
+    async def _ainvoke_hedged(self, body):
+        delay = self._get_hedge_delay()
+        t_start = time.time()
+
+        primary = asyncio.ensure_future(self._ainvoke(body))
+
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if primary in done:
+            return primary.result()
+
+        self._inc_stat("n_hedged")
+        backup = asyncio.ensure_future(
+            self._ainvoke(body, self._remaining_budget(time.time() - t_start))
+        )
+
+        pending = {primary, backup}
+        while len(pending) > 0:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+
+            for future in done:
+                response = future.result()
+
+                if len(response) > 0:
+                    if future is backup:
+                        self._inc_stat("n_hedge_wins")
+
+                    for other in pending:
+                        other.cancel()
+                    return response
+
+        return []
+
+    def get_metrics(self):
+        """
+        Returns counters, latency percentiles and the state of the circuit breaker
+        """
+        with self._stats_lock:
+            metrics = dict(self._stats)
+
+        metrics["latency_p50"] = self.latency_tracker.percentile(50)
+        metrics["latency_p95"] = self.latency_tracker.percentile(95)
+
+        if self.circuit_breaker is not None:
+            metrics["circuit_breaker"] = self.circuit_breaker.get_stats()
+
+        return metrics
+
+    async def aclose(self):
+        """
+        closes the aiohttp sessions, to be called at shutdown
+        (ex: in the lifespan of rag_service). A new session is created
+        if arerank is called again
+        """
+        running_loop = asyncio.get_running_loop()
+
+        with self._sessions_lock:
+            sessions = self._async_sessions
+            self._async_sessions = {}
+
+        for loop, session in sessions.items():
+            if loop is running_loop:
+                await session.close()
+            elif not loop.is_closed():
+                # a session must be closed in its own loop
+                asyncio.run_coroutine_threadsafe(session.close(), loop)
+
+        logging.info(f"OCIBAAIReranker: closed {len(sessions)} sessions...")
+
+    def _build_results(self, texts, response, top_n):
+        """
+        return the texts in order of decreasing score
+        this block of code has been inspired by the code of the cohere_reranker
+        """
+        sorted_data = []
+        if len(response) > 0:
+            data = [
+                {"text": text, "index": index, "relevance_score": score}
+                for index, (text, score) in enumerate(
+                    zip(texts, self._get_predictions(response))
+                )
+            ]
+
+            # only top_n, in decreasing score
+            sorted_data = heapq.nlargest(
+                top_n, data, key=lambda x: x["relevance_score"]
+            )
+
+        return sorted_data
+
+    def _is_batched(self, texts):
+        return self.batch_size is not None and len(texts) > self.batch_size
+
+    def _slice_starts(self, texts):
+        return list(range(0, len(texts), self.batch_size))
+
+    def rerank(self, query, texts, top_n=2, fallback_scores=None):
         """
         Invoke the Model Deployment with the reranker
         - query
         - texts: List[str] are compared and reranked with query
+        - fallback_scores: used, in micro-batch mode, for the texts of a failed
+            micro-batch (higher is better). If None, the order of texts is used
         """
-        # BAAI reranker expects input in this way
-        # x is a list of list, like [['what is panda?', 'The giant panda is a bear.'],
-        #  ['what is panda?', 'It is an animal living in China']]
-        x = [[query, text] for text in texts]
+        if self._is_batched(texts):
+            starts = self._slice_starts(texts)
+
+            def score_slice(start):
+                slice_texts = texts[start : start + self.batch_size]
+
+                return self._call(
+                    self.build_request_body(query, slice_texts), len(slice_texts)
+                )
+
+            # micro-batches are scored concurrently
+            responses = list(self._executor.map(score_slice, starts))
+
+            return self._merge_batches(texts, starts, responses, top_n, fallback_scores)
 
         try:
             # here we invoke the deployment
-            response = self._compute_score(x)
+            response = self._call(self.build_request_body(query, texts), len(texts))
 
-            # return the texts in order of decreasing score
-            # this block of code has been inspired by the code of the cohere_reranker
-            sorted_data = []
-            if len(response) > 0:
-                data = [
-                    {"text": text, "index": index, "relevance_score": score}
-                    for index, (text, score) in enumerate(
-                        zip(texts, response["prediction"])
+            sorted_data = self._build_results(texts, response, top_n)
+
+        except Exception as e:
+            logging.error("Error in OCIBAAIReranker rerank...")
+            logging.error(e)
+
+            return []
+
+        return sorted_data
+
+    async def arerank(self, query, texts, top_n=2, fallback_scores=None):
+        """
+        Async version of rerank, same parameters and output
+        """
+        if self._is_batched(texts):
+            starts = self._slice_starts(texts)
+
+            responses = await asyncio.gather(
+                *[
+                    self._acall(
+                        self.build_request_body(
+                            query, texts[start : start + self.batch_size]
+                        ),
+                        len(texts[start : start + self.batch_size]),
                     )
+                    for start in starts
                 ]
+            )
 
-                # sort in decreasing score
-                sorted_data = sorted(
-                    data, key=lambda x: x["relevance_score"], reverse=True
-                )
-                # output only top_n
-                sorted_data = sorted_data[:top_n]
+            return self._merge_batches(texts, starts, responses, top_n, fallback_scores)
+
+        try:
+            # here we invoke the deployment
+            response = await self._acall(
+                self.build_request_body(query, texts), len(texts)
+            )
+
+            sorted_data = self._build_results(texts, response, top_n)
 
         except Exception as e:
-            logging.error("Error in OCIBAAIReranker rerank...")
+            logging.error("Error in OCIBAAIReranker arerank...")
             logging.error(e)
 
             return []
 
         return sorted_data
+
+    def _merge_batches(self, texts, starts, responses, top_n, fallback_scores=None):
+        """
+        Merge the results of the micro-batches.
+        If a micro-batch failed, its texts get the fallback scores
+        """
+        data = []
+        n_failed = 0
+
+        for start, response in zip(starts, responses):
+            slice_texts = texts[start : start + self.batch_size]
+
+            try:
+                predictions = self._get_predictions(response)
+                assert len(predictions) == len(slice_texts)
+            except Exception:
+                predictions = None
+
+            if predictions is None:
+                n_failed += 1
+
+            for offset, text in enumerate(slice_texts):
+                index = start + offset
+
+                if predictions is not None:
+                    data.append(
+                        {
+                            "text": text,
+                            "index": index,
+                            "relevance_score": predictions[offset],
+                        }
+                    )
+                else:
+                    score = (
+                        fallback_scores[index]
+                        if fallback_scores is not None
+                        else -index
+                    )
+                    data.append(
+                        {
+                            "text": text,
+                            "index": index,
+                            "relevance_score": score,
+                            "fallback": True,
+                        }
+                    )
+
+        if n_failed == len(starts):
+            # no micro-batch scored, same as a failed single request
+            return []
+
+        if n_failed > 0:
+            logging.warning(
+                f"OCIBAAIReranker: {n_failed}/{len(starts)} micro-batches failed, using fallback scores..."
+            )
+
+        # heap based selection of top_n, no need to sort everything
+        return heapq.nlargest(top_n, data, key=score_order_key)
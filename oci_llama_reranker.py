@@ -2,7 +2,7 @@
 File name: oci_llama_reranker.py
 Author: Luigi Saetta
 Date created: 2023-12-30
-Date last modified: 2024-01-02
+Date last modified: 2024-03-10
 Python Version: 3.9
 
 Description:
@@ -35,6 +35,7 @@ Warnings:
 """
 
 import time
+import asyncio
 from typing import Any, List, Optional
 
 from llama_index.bridge.pydantic import Field
@@ -43,6 +44,9 @@ from llama_index.postprocessor.types import BaseNodePostprocessor
 from llama_index.schema import NodeWithScore, QueryBundle
 import logging
 
+from oci_baai_reranker import score_order_key
+from pipeline_metrics import RERANK_SECONDS, RERANK_DEGRADED, RERANK_BYPASSED
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
@@ -54,27 +58,249 @@ class OCILLamaReranker(BaseNodePostprocessor):
     model: str = "oci_baai_reranker"
     top_n: int = 2
     oci_reranker: Any = None
+    # optional RerankScoreCache
+    score_cache: Any = None
+    # optional RerankBypassPolicy
+    bypass_policy: Any = None
+    # OracleVectorStore returns DOT distances (lower is better),
+    # the multi query retriever RRF scores (higher is better)
+    scores_are_distances: bool = True
     verbose: bool = False
+    # num. of times the reranker was not available
+    n_degraded: int = 0
 
     def __init__(
         self,
         model: str = "oci_baai_reranker",
         top_n: int = 2,
         oci_reranker: Any = None,
+        score_cache: Any = None,
+        bypass_policy: Any = None,
+        scores_are_distances: bool = True,
         verbose: bool = False,
     ) -> None:
         # this one to store model and top_n
         super().__init__(top_n=top_n, model=model)
 
         self.oci_reranker = oci_reranker
+        self.score_cache = score_cache
+        self.bypass_policy = bypass_policy
+        self.scores_are_distances = scores_are_distances
         self.verbose = verbose
 
     @classmethod
     def class_name(cls) -> str:
         return "OCILLamaReranker"
 
-    def _rerank(self, query, texts, top_n=2):
-        return self.oci_reranker.rerank(query, texts, top_n)
+    def _fallback_scores(self, nodes):
+        """
+        the vector similarities (higher is better), used for the texts of
+        a failed micro-batch
+        """
+        scores = [node.score if node.score is not None else 0.0 for node in nodes]
+
+        if self.scores_are_distances:
+            return [-score for score in scores]
+
+        return scores
+
+    def _rerank(self, query, texts, top_n=2, fallback_scores=None):
+        if self.score_cache is not None:
+            return self._rerank_with_cache(query, texts, top_n, fallback_scores)
+
+        return self.oci_reranker.rerank(query, texts, top_n, fallback_scores)
+
+    async def _arerank(self, query, texts, top_n=2, fallback_scores=None):
+        if self.score_cache is not None:
+            return await self._arerank_with_cache(query, texts, top_n, fallback_scores)
+
+        return await self._remote_arerank(query, texts, top_n, fallback_scores)
+
+    async def _remote_arerank(self, query, texts, top_n, fallback_scores=None):
+        # imported here, only the async path needs it
+        from async_limits import backend_limits
+
+        # limit the concurrent calls to the deployment
+        async with backend_limits.limit("rerank"):
+            if hasattr(self.oci_reranker, "arerank"):
+                return await self.oci_reranker.arerank(
+                    query, texts, top_n, fallback_scores
+                )
+
+            # the reranker has no async client, at least don't block the loop
+            return await asyncio.to_thread(
+                self.oci_reranker.rerank, query, texts, top_n, fallback_scores
+            )
+
+    def _lookup_cache(self, query, texts):
+        keys = [self.score_cache.make_key(query, text) for text in texts]
+        scores = [self.score_cache.get(key) for key in keys]
+
+        # positions of the texts to be scored remotely
+        missing = [i for i, score in enumerate(scores) if score is None]
+
+        return keys, scores, missing
+
+    def _missing_fallback(self, fallback_scores, missing):
+        if fallback_scores is None:
+            return None
+
+        return [fallback_scores[i] for i in missing]
+
+    def _rerank_with_cache(self, query, texts, top_n=2, fallback_scores=None):
+        """
+        Only the texts without a cached score are sent to the reranker,
+        cached scores are merged back before the selection of top_n
+        """
+        keys, scores, missing = self._lookup_cache(query, texts)
+
+        results = None
+        if len(missing) > 0:
+            # we need the scores of all of them, not only the top_n
+            results = self.oci_reranker.rerank(
+                query,
+                [texts[i] for i in missing],
+                len(missing),
+                self._missing_fallback(fallback_scores, missing),
+            )
+
+        return self._merge_with_cache(texts, keys, scores, missing, results, top_n)
+
+    async def _arerank_with_cache(self, query, texts, top_n=2, fallback_scores=None):
+        keys, scores, missing = self._lookup_cache(query, texts)
+
+        results = None
+        if len(missing) > 0:
+            results = await self._remote_arerank(
+                query,
+                [texts[i] for i in missing],
+                len(missing),
+                self._missing_fallback(fallback_scores, missing),
+            )
+
+        return self._merge_with_cache(texts, keys, scores, missing, results, top_n)
+
+    def _merge_with_cache(self, texts, keys, scores, missing, results, top_n):
+        fallback = [False] * len(texts)
+
+        if len(missing) > 0:
+            if len(results) == 0:
+                # error in the reranker, same behaviour as without cache
+                return []
+
+            for result in results:
+                index = missing[result["index"]]
+                scores[index] = result["relevance_score"]
+
+                if result.get("fallback", False):
+                    # not a reranker score, must not be cached
+                    fallback[index] = True
+                else:
+                    self.score_cache.put(keys[index], scores[index])
+
+            # in background, not on the path of the request
+            self.score_cache.schedule_save()
+
+        if self.verbose:
+            logging.info(
+                f"Rerank cache: {len(texts) - len(missing)}/{len(texts)} scores reused, "
+                f"hit rate: {round(self.score_cache.hit_rate, 2)}"
+            )
+
+        data = [
+            {
+                "text": text,
+                "index": index,
+                "relevance_score": score,
+                "fallback": is_fallback,
+            }
+            for index, (text, score, is_fallback) in enumerate(
+                zip(texts, scores, fallback)
+            )
+        ]
+
+        # sort in decreasing score and output only top_n
+        return sorted(data, key=score_order_key, reverse=True)[:top_n]
+
+    def _check_bypass(self, nodes):
+        """
+        Returns the nodes to output (in vector order) if the rerank
+        cannot change the top_n, otherwise None
+        """
+        if self.bypass_policy is None:
+            return None
+
+        reason = self.bypass_policy.should_bypass(nodes, self.top_n)
+
+        if reason is None:
+            return None
+
+        self.bypass_policy.record_bypass(reason)
+        RERANK_BYPASSED.labels(reranker=self.model, reason=reason).inc()
+
+        if self.verbose:
+            logging.info(f"Rerank skipped ({reason}), stats: {self.get_bypass_stats()}")
+
+        return nodes[: self.top_n]
+
+    def _record_rerank(self, elapsed):
+        RERANK_SECONDS.labels(reranker=self.model).observe(elapsed)
+
+        if self.bypass_policy is not None:
+            self.bypass_policy.record_rerank(elapsed)
+
+    def get_metrics(self):
+        """
+        Metrics of the reranker: degraded calls, bypass, cache and,
+        if available, the metrics of the remote client
+        """
+        metrics = {"n_degraded": self.n_degraded}
+
+        if hasattr(self.oci_reranker, "get_metrics"):
+            metrics["client"] = self.oci_reranker.get_metrics()
+        if self.bypass_policy is not None:
+            metrics["bypass"] = self.get_bypass_stats()
+        if self.score_cache is not None:
+            metrics["cache_hit_rate"] = self.score_cache.hit_rate
+
+        return metrics
+
+    def get_bypass_stats(self):
+        if self.bypass_policy is None:
+            return None
+
+        return self.bypass_policy.get_stats()
+
+    def _start_event(self, nodes, query_bundle):
+        return self.callback_manager.event(
+            CBEventType.RERANKING,
+            payload={
+                EventPayload.NODES: nodes,
+                EventPayload.MODEL_NAME: self.model,
+                EventPayload.QUERY_STR: query_bundle.query_str,
+                EventPayload.TOP_K: self.top_n,
+            },
+        )
+
+    def _build_nodes(self, nodes, results):
+        if len(results) == 0:
+            # reranker failed, timed out or circuit open: degrade to the
+            # vector order, better than answering without context
+            self.n_degraded += 1
+            RERANK_DEGRADED.labels(reranker=self.model).inc()
+            logging.warning("Reranker not available, using vector order for top_n...")
+
+            return nodes[: self.top_n]
+
+        # build the output list to be compatible with llama-index
+        new_nodes = []
+        for result in results:
+            new_node_with_score = NodeWithScore(
+                node=nodes[result["index"]].node, score=result["relevance_score"]
+            )
+            new_nodes.append(new_node_with_score)
+
+        return new_nodes
 
     def _postprocess_nodes(
         self,
@@ -89,32 +315,81 @@ class OCILLamaReranker(BaseNodePostprocessor):
         if len(nodes) == 0:
             return []
 
-        with self.callback_manager.event(
-            CBEventType.RERANKING,
-            payload={
-                EventPayload.NODES: nodes,
-                EventPayload.MODEL_NAME: self.model,
-                EventPayload.QUERY_STR: query_bundle.query_str,
-                EventPayload.TOP_K: self.top_n,
-            },
-        ) as event:
+        bypass_nodes = self._check_bypass(nodes)
+        if bypass_nodes is not None:
+            return bypass_nodes
+
+        with self._start_event(nodes, query_bundle) as event:
             # extract texts from node list
             texts = [node.node.get_content() for node in nodes]
 
             results = self._rerank(
-                query=query_bundle.query_str, texts=texts, top_n=self.top_n
+                query=query_bundle.query_str,
+                texts=texts,
+                top_n=self.top_n,
+                fallback_scores=self._fallback_scores(nodes),
             )
 
-            # build the output list to be compatible with llama-index
-            new_nodes = []
-            for result in results:
-                new_node_with_score = NodeWithScore(
-                    node=nodes[result["index"]].node, score=result["relevance_score"]
-                )
-                new_nodes.append(new_node_with_score)
+            new_nodes = self._build_nodes(nodes, results)
             event.on_end(payload={EventPayload.NODES: new_nodes})
 
         tEla = time.time() - tStart
+        self._record_rerank(tEla)
+
+        if self.verbose:
+            logging.info(f"...elapsed time: {round(tEla, 2)} sec.")
+        return new_nodes
+
+    async def apostprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+        query_str: Optional[str] = None,
+    ) -> List[NodeWithScore]:
+        """
+        Async version of postprocess_nodes: while waiting for the reranker
+        the event loop can serve other queries
+        """
+        if query_str is not None and query_bundle is not None:
+            raise ValueError("Cannot specify both query_str and query_bundle")
+        elif query_str is not None:
+            query_bundle = QueryBundle(query_str)
+
+        return await self._apostprocess_nodes(nodes, query_bundle)
+
+    async def _apostprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        tStart = time.time()
+        logging.info("Reranking (async)...")
+
+        if query_bundle is None:
+            raise ValueError("Missing query bundle in extra info.")
+        if len(nodes) == 0:
+            return []
+
+        bypass_nodes = self._check_bypass(nodes)
+        if bypass_nodes is not None:
+            return bypass_nodes
+
+        with self._start_event(nodes, query_bundle) as event:
+            texts = [node.node.get_content() for node in nodes]
+
+            results = await self._arerank(
+                query=query_bundle.query_str,
+                texts=texts,
+                top_n=self.top_n,
+                fallback_scores=self._fallback_scores(nodes),
+            )
+
+            new_nodes = self._build_nodes(nodes, results)
+            event.on_end(payload={EventPayload.NODES: new_nodes})
+
+        tEla = time.time() - tStart
+        self._record_rerank(tEla)
+
         if self.verbose:
             logging.info(f"...elapsed time: {round(tEla, 2)} sec.")
         return new_nodes
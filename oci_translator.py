@@ -1,23 +1,133 @@
-#
-# Translator from English to Italian
-#
+"""
+File name: oci_translator.py
+Author: Luigi Saetta
+Date created: 2024-01-10
+Date last modified: 2024-03-13
+Python Version: 3.9
+
+Description:
+    Translator from English to Italian, based on OCI AI Language.
+
+    translate_texts() translates many texts with the minimum num. of calls:
+    - texts already translated are taken from an LRU cache (key: text hash)
+    - texts longer than the service limit are split and joined back
+    - the texts are packed in batches within the limits of a call,
+      batches are translated in parallel
+    submit() does the same in background, returning a Future.
+
+Usage:
+    Import this module into other scripts to use its functions.
+    Example:
+    oci_trans = OCITranslator(oci_config=oci_config)
+
+    translated = oci_trans.translate_texts([answer])
+
+License:
+    This code is released under the MIT License.
+
+Notes:
+    This is a part of a set of demo showing how to use Oracle Vector DB,
+    OCI GenAI service, Oracle GenAI Embeddings, to build a RAG solution,
+    where all he data (text + embeddings) are stored in Oracle DB 23c
+
+Warnings:
+    This module is in development, may change in future versions.
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
 from oci.ai_language import AIServiceLanguageClient
 from oci.ai_language.models import TextDocument
 from oci.ai_language.models import BatchLanguageTranslationDetails
 
-from typing import List
-
 from config_private import COMPARTMENT_OCID
+from oci_utils import hash_text
+from pipeline_metrics import CACHE_HITS, CACHE_MISSES
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+# limits of batch_language_translation
+MAX_DOC_CHARS = 5000
+MAX_BATCH_DOCS = 100
+MAX_BATCH_CHARS = 20000
+
+
+def split_text(text, max_chars=MAX_DOC_CHARS):
+    """
+    splits text in pieces of max_chars at most, preferably at a new line
+    or a space. Returns the pieces and the separators to join them back
+    """
+    pieces, separators = [], []
+
+    while len(text) > max_chars:
+        cut = text.rfind("\n", 0, max_chars)
+
+        if cut <= 0:
+            cut = text.rfind(" ", 0, max_chars)
+
+        if cut <= 0:
+            # no place to cut: hard cut
+            pieces.append(text[:max_chars])
+            separators.append("")
+            text = text[max_chars:]
+        else:
+            pieces.append(text[:cut])
+            separators.append(text[cut])
+            text = text[cut + 1 :]
+
+    pieces.append(text)
+
+    return pieces, separators
+
+
+def join_pieces(pieces, separators):
+    text = pieces[0]
+
+    for separator, piece in zip(separators, pieces[1:]):
+        text += separator + piece
+
+    return text
 
 
 class OCITranslator:
-    def __init__(self, oci_config, source_language="en", target_language="it"):
+    def __init__(
+        self,
+        oci_config,
+        source_language="en",
+        target_language="it",
+        cache_max_size=1000,
+        max_workers=4,
+    ):
         # define the client
         self.ai_client = AIServiceLanguageClient(oci_config)
         self.source_language = source_language
         self.target_language = target_language
 
+        # hash of the text -> translation
+        self.cache_max_size = cache_max_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+        # to translate the batches in parallel
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        # for submit(): a separate pool, it waits for the batches
+        self._submit_executor = ThreadPoolExecutor(max_workers=2)
+
+        self.n_calls = 0
+        self.n_hits = 0
+        self.n_misses = 0
+
     def translate(self, texts: List[str]):
+        """
+        a single call to the service, returns the translated documents
+        (texts must be within the limits of the service)
+        """
         # key is fake
         txt_docs = [
             TextDocument(text=text, key=f"key{i}", language_code=self.source_language)
@@ -35,4 +145,120 @@ class OCITranslator:
             batch_lan_transl_details
         ).data
 
+        with self._lock:
+            self.n_calls += 1
+
         return txt_docs_transl
+
+    def _make_key(self, text):
+        return f"{self.source_language}:{self.target_language}:{hash_text(text)}"
+
+    def _get(self, key):
+        with self._lock:
+            translation = self._cache.get(key)
+
+            if translation is None:
+                self.n_misses += 1
+                CACHE_MISSES.labels(cache="translation").inc()
+                return None
+
+            self._cache.move_to_end(key)
+            self.n_hits += 1
+            CACHE_HITS.labels(cache="translation").inc()
+
+            return translation
+
+    def _put(self, key, translation):
+        with self._lock:
+            self._cache[key] = translation
+            self._cache.move_to_end(key)
+
+            while len(self._cache) > self.cache_max_size:
+                self._cache.popitem(last=False)
+
+    def _make_batches(self, pieces):
+        batches, batch, batch_chars = [], [], 0
+
+        for piece in pieces:
+            if len(batch) > 0 and (
+                len(batch) >= MAX_BATCH_DOCS
+                or batch_chars + len(piece) > MAX_BATCH_CHARS
+            ):
+                batches.append(batch)
+                batch, batch_chars = [], 0
+
+            batch.append(piece)
+            batch_chars += len(piece)
+
+        if len(batch) > 0:
+            batches.append(batch)
+
+        return batches
+
+    def _translate_batch(self, batch):
+        documents = self.translate(batch).documents
+
+        # the order of the documents is given by the keys
+        by_key = {doc.key: doc.translated_text for doc in documents}
+
+        return [by_key[f"key{i}"] for i in range(len(batch))]
+
+    def translate_texts(self, texts: List[str]) -> List[str]:
+        """
+        returns the translations of texts, in the same order
+        """
+        keys = [self._make_key(text) for text in texts]
+        results = [self._get(key) for key in keys]
+
+        # texts not in cache, split within the limit of a document
+        missing = [i for i, result in enumerate(results) if result is None]
+        splits = [split_text(texts[i]) for i in missing]
+
+        pieces = [piece for split_pieces, _ in splits for piece in split_pieces]
+
+        if len(pieces) > 0:
+            batches = self._make_batches(pieces)
+
+            if len(batches) == 1:
+                translated = self._translate_batch(batches[0])
+            else:
+                logging.info(
+                    f"Translating {len(pieces)} texts in {len(batches)} calls..."
+                )
+
+                translated = [
+                    text
+                    for batch_result in self._executor.map(
+                        self._translate_batch, batches
+                    )
+                    for text in batch_result
+                ]
+
+            # join back the pieces of each text
+            pos = 0
+            for i, (split_pieces, separators) in zip(missing, splits):
+                n_pieces = len(split_pieces)
+
+                results[i] = join_pieces(translated[pos : pos + n_pieces], separators)
+                pos += n_pieces
+
+                self._put(keys[i], results[i])
+
+        return results
+
+    def submit(self, texts: List[str]):
+        """
+        translate_texts in background: returns a Future
+        """
+        return self._submit_executor.submit(self.translate_texts, texts)
+
+    def get_stats(self):
+        with self._lock:
+            tot = self.n_hits + self.n_misses
+
+            return {
+                "n_calls": self.n_calls,
+                "n_hits": self.n_hits,
+                "n_misses": self.n_misses,
+                "hit_rate": round(self.n_hits / tot, 3) if tot > 0 else 0.0,
+            }
@@ -25,8 +25,8 @@ Warnings:
     This module is in development, may change in future versions.
 """
 
+import hashlib
 import logging
-import oci
 from config import (
     EMBED_MODEL_TYPE,
     EMBED_MODEL,
@@ -48,6 +48,9 @@ logging.basicConfig(
 
 
 def load_oci_config():
+    # imported here, the oci SDK is slow to import
+    import oci
+
     # read OCI config to connect to OCI with API key
 
     # are you using default profile?
@@ -85,3 +88,10 @@ def pretty_print_docs(docs):
 
 def format_docs(docs):
     return "\n\n".join(doc.page_content for doc in docs)
+
+
+def hash_text(text):
+    """
+    the key of a text in the caches (rerank scores, embeddings, translations)
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
@@ -2,7 +2,7 @@
 File name: oracle_bot.py
 Author: Luigi Saetta
 Date created: 2023-12-17
-Date last modified: 2023-12-29
+Date last modified: 2024-03-13
 Python Version: 3.9
 
 Description:
@@ -26,18 +26,27 @@ Warnings:
 import logging
 import time
 import streamlit as st
+from llama_index.response.schema import StreamingResponse
 
 # to use the create_query_engine
 import prepare_chain
 
-import ads
 from oci_utils import load_oci_config
-from oci_translator import OCITranslator
+from request_metrics import track_request, measure_stage, attach_metrics
 
 #
 # Configs
 #
-from config import ADD_REFERENCES, ADD_OCI_TRANSLATOR, GEN_MODEL, WORD_TO_TRIGGER_TRANS
+from config import (
+    ADD_REFERENCES,
+    ADD_OCI_TRANSLATOR,
+    GEN_MODEL,
+    WORD_TO_TRIGGER_TRANS,
+    STREAM_RESPONSE,
+    ADD_WARM_UP,
+    SHOW_DIAGNOSTICS,
+    TRANSLATION_CACHE_MAX_SIZE,
+)
 
 
 def reset_conversation():
@@ -48,7 +57,9 @@ def reset_conversation():
 # cause we need here to use @cache
 @st.cache_resource
 def create_query_engine(verbose=False):
-    query_engine, token_counter = prepare_chain.create_query_engine(verbose=verbose)
+    query_engine, token_counter = prepare_chain.create_query_engine(
+        verbose=verbose, streaming=STREAM_RESPONSE, warm_up=ADD_WARM_UP
+    )
 
     # token_counter keeps track of the num. of tokens
     return query_engine, token_counter
@@ -56,26 +67,67 @@ def create_query_engine(verbose=False):
 
 @st.cache_resource
 def create_translator():
+    # imported here, only if translation is enabled
+    from oci_translator import OCITranslator
+
     oci_config = load_oci_config()
 
-    oci_trans = OCITranslator(oci_config=oci_config)
+    oci_trans = OCITranslator(
+        oci_config=oci_config, cache_max_size=TRANSLATION_CACHE_MAX_SIZE
+    )
 
     return oci_trans
 
 
-# to format output with references
-def format_output(response):
-    output = response.response
+# the references to append to the answer
+def format_references(source_nodes):
+    output = ""
 
-    if ADD_REFERENCES and len(response.source_nodes) > 0:
+    if ADD_REFERENCES and len(source_nodes) > 0:
         output += "\n\n Ref.:\n\n"
 
-        for node in response.source_nodes:
+        for node in source_nodes:
             output += str(node.metadata).replace("{", "").replace("}", "") + "  \n"
 
     return output
 
 
+# to format output with references
+def format_output(response):
+    return response.response + format_references(response.source_nodes)
+
+
+# render the tokens as they arrive, then the references
+def stream_output(response):
+    placeholder = st.empty()
+    output = ""
+
+    for token in response.response_gen:
+        output += token
+        placeholder.markdown(output + "▌")
+
+    output += format_references(response.source_nodes)
+    placeholder.markdown(output)
+
+    return output
+
+
+# time of each stage and tokens of the last request
+def show_diagnostics(metrics):
+    with st.expander("Diagnostics"):
+        st.table(
+            {
+                "stage": list(metrics["stages"].keys()),
+                "time (sec.)": list(metrics["stages"].values()),
+            }
+        )
+        st.markdown(
+            f"Total: {metrics['total']} sec., "
+            f"prompt tokens: {metrics['prompt_tokens']}, "
+            f"completion tokens: {metrics['completion_tokens']}"
+        )
+
+
 #
 # Main
 #
@@ -90,6 +142,8 @@ st.title("OCI Bot powered by Generative AI")
 # Added reset button
 st.button("Clear Chat History", on_click=reset_conversation)
 
+diagnostics = st.sidebar.checkbox("Show diagnostics", value=SHOW_DIAGNOSTICS)
+
 # Initialize chat history
 if "messages" not in st.session_state:
     reset_conversation()
@@ -128,29 +182,61 @@ if question := st.chat_input("Hello, how can I help you?"):
     try:
         logging.info("Calling RAG chain..")
 
-        with st.spinner("Waiting..."):
-            tStart = time.time()
-
-            # Here we call the entire chain !!!
-            response = query_engine.query(question)
-
-            # should we translate?
-            if ADD_OCI_TRANSLATOR and GEN_MODEL == "OCI":
-                # check if the question ask to translate in italian
-                if WORD_TO_TRIGGER_TRANS.lower() in question.lower():
-                    logging.info("Translating in it...")
-                    # remember you have to pass a batch!
-                    response.response = (
-                        oci_trans.translate([response.response])
-                        .documents[0]
-                        .translated_text
+        # time and tokens of this request, by stage
+        with track_request() as metrics:
+            with st.spinner("Waiting..."):
+                tStart = time.time()
+
+                # Here we call the entire chain !!!
+                # if streaming, it returns when the LLM starts generating
+                response = query_engine.query(question)
+
+                # should we translate?
+                if ADD_OCI_TRANSLATOR and GEN_MODEL == "OCI":
+                    # check if the question ask to translate in italian
+                    if WORD_TO_TRIGGER_TRANS.lower() in question.lower():
+                        logging.info("Translating in it...")
+
+                        # the translation needs the whole text
+                        if isinstance(response, StreamingResponse):
+                            response = response.get_response()
+
+                        # batched and cached (repeated answers are not translated again)
+                        with measure_stage("translation"):
+                            response.response = oci_trans.translate_texts(
+                                [response.response]
+                            )[0]
+
+            # Display assistant response in chat message container
+            with st.chat_message("assistant"):
+                if isinstance(response, StreamingResponse):
+                    logging.info(
+                        f"Time to first token: {round(time.time() - tStart, 1)} sec."
                     )
 
-            tEla = time.time() - tStart
-            logging.info(f"Elapsed time: {round(tEla, 1)} sec.")
+                    output = stream_output(response)
+                elif ADD_REFERENCES:
+                    # add reerences
+                    output = format_output(response)
+
+                    st.markdown(output)
+                else:
+                    output = response
+
+                    st.markdown(output)
+
+        tEla = time.time() - tStart
+        logging.info(f"Elapsed time: {round(tEla, 1)} sec.")
+
+        # complete only now, at the end of the stream
+        attach_metrics(response, metrics)
+        metrics.report()
+
+        if diagnostics:
+            show_diagnostics(response.request_metrics)
 
         # display num. of input/output token
-        # count are incrementals
+        # count are incrementals (all the questions)
         str_token1 = f"LLM Prompt Tokens: {token_counter.prompt_llm_token_count}"
         str_token2 = (
             f"LLM Completion Tokens: {token_counter.completion_llm_token_count}"
@@ -159,16 +245,6 @@ if question := st.chat_input("Hello, how can I help you?"):
         logging.info(str_token1)
         logging.info(str_token2)
 
-        # Display assistant response in chat message container
-        with st.chat_message("assistant"):
-            if ADD_REFERENCES:
-                # add reerences
-                output = format_output(response)
-            else:
-                output = response
-
-            st.markdown(output)
-
         # Add assistant response to chat history
         st.session_state.messages.append({"role": "assistant", "content": output})
 
@@ -2,7 +2,7 @@
 File name: oracle_chat_with_memory.py
 Author: Luigi Saetta
 Date created: 2023-01-04
-Date last modified: 2024-03-03
+Date last modified: 2024-03-13
 Python Version: 3.9
 
 Description:
@@ -21,64 +21,148 @@ Notes:
 
 Warnings:
     This module is in development, may change in future versions.
+    With ADD_CHAT_HISTORY_STORE the key of the history is in the URL
+    (?session=...): anyone with the link can read and clear the conversation.
 """
 
 import logging
 import time
+import uuid
 import streamlit as st
 
 # to use the create_query_engine
 import prepare_chain_4_chat
-
-import ads
-from oci_utils import load_oci_config
+from chat_sessions import ChatSessionManager
+from chat_history_store import OracleChatHistoryStore, SOURCES_KEY
+from request_metrics import track_request, attach_metrics
+from llama_index.llms import ChatMessage, MessageRole
 
 #
 # Configs
 #
-from config import ADD_REFERENCES
+from config import (
+    ADD_REFERENCES,
+    STREAM_RESPONSE,
+    ADD_WARM_UP,
+    CHAT_MAX_SESSIONS,
+    CHAT_SESSION_IDLE_TIMEOUT,
+    SHOW_DIAGNOSTICS,
+    ADD_CHAT_HISTORY_STORE,
+    CHAT_HISTORY_LOAD_TURNS,
+)
 
 
 # when push the button
 def reset_conversation():
     st.session_state.messages = []
 
-    # stored in the session to enable reset
-    st.session_state.chat_engine, st.session_state.token_counter = create_chat_engine(
-        verbose=False
-    )
-    # clear message chat history
-    st.session_state.chat_engine.reset()
+    # clear the memory of this session only
+    get_session_manager().reset(st.session_state.session_id)
+    st.session_state.resume_history = None
+
+    if ADD_CHAT_HISTORY_STORE:
+        get_history_store().delete(st.session_state.session_id)
 
     # reset # questions counter
     st.session_state.question_count = 0
 
 
-# defined here to avoid import of streamlit in other module
-# cause we need here to use @cache
-@st.cache_resource
 def create_chat_engine(verbose=False):
     chat_engine, token_counter = prepare_chain_4_chat.create_chat_engine(
-        verbose=verbose
+        verbose=verbose, warm_up=ADD_WARM_UP
     )
 
     # token_counter keeps track of the num. of tokens
     return chat_engine, token_counter
 
 
-# to format output with references
-def format_output(response):
-    output = response.response
+# defined here to avoid import of streamlit in other module
+# cause we need here to use @cache
+# the manager is shared, every session gets its own chat engine (and memory)
+@st.cache_resource
+def get_session_manager():
+    return ChatSessionManager(
+        factory=lambda: create_chat_engine(verbose=False),
+        max_sessions=CHAT_MAX_SESSIONS,
+        idle_timeout=CHAT_SESSION_IDLE_TIMEOUT,
+    )
 
-    if ADD_REFERENCES and len(response.source_nodes) > 0:
+
+# the history of the sessions, saved in DB
+@st.cache_resource
+def get_history_store():
+    return OracleChatHistoryStore()
+
+
+# the last turns of the session, to resume the conversation
+def load_history():
+    return get_history_store().load(
+        st.session_state.session_id, last_n_turns=CHAT_HISTORY_LOAD_TURNS
+    )
+
+
+# the history for the chat engine: only the text, without the sources
+def engine_history(history):
+    return [
+        ChatMessage(role=message.role, content=message.content) for message in history
+    ]
+
+
+# the references to append to the answer
+# sources: the metadata of the chunks used
+def format_references(sources):
+    output = ""
+
+    if ADD_REFERENCES and len(sources) > 0:
         output += "\n\n Ref.:\n\n"
 
-        for node in response.source_nodes:
-            output += str(node.metadata).replace("{", "").replace("}", "") + "  \n"
+        for metadata in sources:
+            output += str(metadata).replace("{", "").replace("}", "") + "  \n"
 
     return output
 
 
+def get_sources(response):
+    return [node.metadata for node in response.source_nodes]
+
+
+# to format output with references
+def format_output(response):
+    return response.response + format_references(get_sources(response))
+
+
+# render the tokens as they arrive, then the references
+# returns the answer and the text displayed
+def stream_output(response):
+    placeholder = st.empty()
+    answer = ""
+
+    for token in response.response_gen:
+        answer += token
+        placeholder.markdown(answer + "▌")
+
+    output = answer + format_references(get_sources(response))
+    placeholder.markdown(output)
+
+    return answer, output
+
+
+# time of each stage and tokens of the last request
+def show_diagnostics(metrics):
+    with st.expander("Diagnostics"):
+        st.table(
+            {
+                "stage": list(metrics["stages"].keys()),
+                "time (sec.)": list(metrics["stages"].values()),
+            }
+        )
+        st.markdown(
+            f"Total: {metrics['total']} sec., "
+            f"prompt tokens: {metrics['prompt_tokens']}, "
+            f"completion tokens: {metrics['completion_tokens']}"
+        )
+
+
 #
 # Main
 #
@@ -96,21 +180,73 @@ st.title("OCI Assistant powered by Generative AI and Oracle Vector DB")
 # Added reset button
 st.button("Clear Chat History", on_click=reset_conversation)
 
+diagnostics = st.sidebar.checkbox("Show diagnostics", value=SHOW_DIAGNOSTICS)
+
+# identifies the chat engine of this browser session
+if "session_id" not in st.session_state:
+    # with the history store the id is kept in the URL:
+    # after a restart (or a reload) the conversation is resumed.
+    # The id is the key of the history: the link gives access to it
+    if ADD_CHAT_HISTORY_STORE and "session" in st.query_params:
+        st.session_state.session_id = st.query_params["session"]
+    else:
+        st.session_state.session_id = str(uuid.uuid4())
+
+    if ADD_CHAT_HISTORY_STORE:
+        st.query_params["session"] = st.session_state.session_id
+
 # Initialize chat history
 if "messages" not in st.session_state:
-    reset_conversation()
+    st.session_state.messages = []
+    st.session_state.question_count = 0
+    # history to give to the chat engine with the next question
+    st.session_state.resume_history = None
+
+    if ADD_CHAT_HISTORY_STORE:
+        history = load_history()
+
+        if len(history) > 0:
+            logging.info(f"Resuming chat session, {len(history)} messages...")
+
+            # the references are rebuilt from the sources, only for display
+            st.session_state.messages = [
+                {
+                    "role": message.role.value,
+                    "content": message.content
+                    + format_references(message.additional_kwargs.get(SOURCES_KEY, [])),
+                }
+                for message in history
+            ]
+            st.session_state.resume_history = engine_history(history)
+
+session_manager = get_session_manager()
+
+# the session was evicted (idle or LRU): its memory is gone
+if (
+    st.session_state.session_id not in session_manager
+    and len(st.session_state.messages) > 0
+    and st.session_state.resume_history is None
+):
+    if ADD_CHAT_HISTORY_STORE:
+        logging.info("Chat session expired, resuming from the history...")
+
+        st.session_state.resume_history = engine_history(load_history())
+    else:
+        logging.info("Chat session expired, starting a new conversation...")
+
+        st.session_state.messages = []
+        st.session_state.question_count = 0
 
 # init RAG
 with st.spinner("Initializing RAG chain..."):
     # I have added the token counter to count token
-    # I've done this way because I marked the function with @cache
-    # but there was a problem with the counter. It works if it is created in the other module
-    # and returned here where I print the results for each query
+    # each session has its own chat engine and token counter
 
-    # here we create the query engine
-    st.session_state.chat_engine, st.session_state.token_counter = create_chat_engine(
-        verbose=False
-    )
+    # here we get the chat engine of this session
+    chat_engine, token_counter = session_manager.get(st.session_state.session_id)
+
+# stream the answer, if the LLM supports it
+streaming = STREAM_RESPONSE and prepare_chain_4_chat.streaming_supported()
 
 
 # Display chat messages from history on app rerun
@@ -130,13 +266,44 @@ if question := st.chat_input("Hello, how can I help you?"):
     try:
         logging.info("Calling RAG chain..")
 
-        with st.spinner("Waiting..."):
-            time_start = time.time()
-
-            # Here we call the entire chain !!!
-            response = st.session_state.chat_engine.chat(question)
-
-            time_elapsed = time.time() - time_start
+        # None, unless the session has been resumed
+        chat_history = st.session_state.resume_history
+        st.session_state.resume_history = None
+
+        # time and tokens of this request, by stage
+        with track_request() as metrics:
+            with st.spinner("Waiting..."):
+                time_start = time.time()
+
+                # Here we call the entire chain !!!
+                if streaming:
+                    # returns when the LLM starts generating
+                    response = chat_engine.stream_chat(
+                        question, chat_history=chat_history
+                    )
+                else:
+                    response = chat_engine.chat(question, chat_history=chat_history)
+
+            # Display assistant response in chat message container
+            with st.chat_message("assistant"):
+                if streaming:
+                    logging.info(
+                        f"Time to first token: {round(time.time() - time_start, 1)} sec."
+                    )
+
+                    answer, output = stream_output(response)
+                elif ADD_REFERENCES:
+                    # add references
+                    answer = response.response
+                    output = format_output(response)
+
+                    st.markdown(output)
+                else:
+                    answer = output = response.response
+
+                    st.markdown(output)
+
+        time_elapsed = time.time() - time_start
 
         # count the number of questions done
         st.session_state.question_count += 1
@@ -144,27 +311,41 @@ if question := st.chat_input("Hello, how can I help you?"):
         logging.info(f"Question n. {st.session_state.question_count}")
         logging.info(f"Elapsed time: {round(time_elapsed, 1)} sec.")
 
+        # complete only now, at the end of the stream
+        attach_metrics(response, metrics)
+        metrics.report()
+
+        if diagnostics:
+            show_diagnostics(response.request_metrics)
+
         # display num. of input/output token
-        # count are incrementals
-        str_token1 = f"LLM Prompt Tokens: {st.session_state.token_counter.prompt_llm_token_count}"
-        str_token2 = f"LLM Completion Tokens: {st.session_state.token_counter.completion_llm_token_count}"
+        # count are incrementals (all the questions of the session)
+        str_token1 = f"LLM Prompt Tokens: {token_counter.prompt_llm_token_count}"
+        str_token2 = (
+            f"LLM Completion Tokens: {token_counter.completion_llm_token_count}"
+        )
 
         logging.info(str_token1)
         logging.info(str_token2)
 
-        # Display assistant response in chat message container
-        with st.chat_message("assistant"):
-            if ADD_REFERENCES:
-                # add references
-                output = format_output(response)
-            else:
-                output = response
-
-            st.markdown(output)
-
         # Add assistant response to chat history
         st.session_state.messages.append({"role": "assistant", "content": output})
 
+        # saved in background: only the answer, the references are
+        # rebuilt from the sources (they must not go in the LLM memory)
+        if ADD_CHAT_HISTORY_STORE:
+            get_history_store().append(
+                st.session_state.session_id,
+                [
+                    ChatMessage(role=MessageRole.USER, content=question),
+                    ChatMessage(
+                        role=MessageRole.ASSISTANT,
+                        content=answer,
+                        additional_kwargs={SOURCES_KEY: get_sources(response)},
+                    ),
+                ],
+            )
+
     except Exception as e:
         logging.error("An error occurred: " + str(e))
         st.error("An error occurred: " + str(e))
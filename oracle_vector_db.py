@@ -2,7 +2,7 @@
 File name: oracle_vector_db.py
 Author: Luigi Saetta
 Date created: 2023-12-15
-Date last modified: 2024-03-02
+Date last modified: 2024-03-13
 Python Version: 3.9
 
 Description:
@@ -30,6 +30,8 @@ Warnings:
 """
 
 import time
+import asyncio
+import threading
 from tqdm import tqdm
 import array
 from typing import List, Any, Dict
@@ -46,6 +48,18 @@ import hashlib
 
 from llama_index.schema import TextNode, BaseNode
 
+from request_metrics import measure_stage
+from pipeline_metrics import (
+    VECTOR_QUERY_SECONDS,
+    VECTOR_QUERY_ERRORS,
+    VECTOR_ROWS_FETCHED,
+    CLOB_FETCH_SECONDS,
+    CLOB_FETCHED_BYTES,
+    POOL_BUSY_CONNECTIONS,
+    POOL_OPENED_CONNECTIONS,
+    POOL_MAX_CONNECTIONS,
+)
+
 import oracledb
 import logging
 
@@ -54,29 +68,20 @@ from config_private import DB_USER, DB_PWD, DB_HOST_IP, DB_SERVICE
 
 # But for now we don't need to compute the id.. it is set in the driving
 # code when the doc list is created
-from config import ID_GEN_METHOD, EMBEDDINGS_BITS, ADD_PHX_TRACING
-
-# Phoenix tracing
-if ADD_PHX_TRACING:
-    from opentelemetry import trace as trace_api
-    from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
-    from opentelemetry.sdk import trace as trace_sdk
-    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
-    from openinference.semconv.trace import SpanAttributes
-    from opentelemetry.trace import Status, StatusCode, SpanKind
+from config import (
+    ID_GEN_METHOD,
+    EMBEDDINGS_BITS,
+    ADD_PHX_TRACING,
+    DB_POOL_MIN,
+    DB_POOL_MAX,
+    DB_POOL_INCREMENT,
+)
 
-#
-# to add Phoenix tracing
-#
-tracer = None
+# Phoenix tracing (batching exporter and sampling, see tracing.py)
+from tracing import optional_span
 
 if ADD_PHX_TRACING:
-    endpoint = "http://127.0.0.1:7777/v1/traces"
-    tracer_provider = trace_sdk.TracerProvider()
-    trace_api.set_tracer_provider(tracer_provider)
-    tracer_provider.add_span_processor(SimpleSpanProcessor(OTLPSpanExporter(endpoint)))
-    tracer = trace_api.get_tracer(__name__)
-    OPENINFERENCE_SPAN_KIND = "openinference.span.kind"
+    from openinference.semconv.trace import SpanAttributes
 
 
 # Configure logging
@@ -90,21 +95,67 @@ logging.basicConfig(
 #
 
 
+# a pool of connections shared in the process: opening a connection
+# for every query costs more than the query
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+
+def get_db_pool():
+    global _db_pool
+
+    with _db_pool_lock:
+        if _db_pool is None:
+            logging.info("Creating the DB connection pool...")
+
+            _db_pool = oracledb.create_pool(
+                user=DB_USER,
+                password=DB_PWD,
+                dsn=f"{DB_HOST_IP}/{DB_SERVICE}",
+                min=DB_POOL_MIN,
+                max=DB_POOL_MAX,
+                increment=DB_POOL_INCREMENT,
+            )
+
+    return _db_pool
+
+
+def _pool_attr(name):
+    # the pool could not be created yet
+    pool = _db_pool
+
+    return getattr(pool, name) if pool is not None else 0
+
+
+# the utilization of the pool is read at scrape time
+POOL_BUSY_CONNECTIONS.set_function(lambda: _pool_attr("busy"))
+POOL_OPENED_CONNECTIONS.set_function(lambda: _pool_attr("opened"))
+POOL_MAX_CONNECTIONS.set_function(lambda: _pool_attr("max"))
+
+
+def ping_db():
+    """
+    Checks that the DB is reachable
+    (the first call opens the pool and its connections)
+    """
+    with get_db_pool().acquire() as connection:
+        connection.ping()
+
+
 # added to handle the tracing in oracle_query
 @contextmanager
 def optional_tracing(span_name):
+    attributes = None
+
     if ADD_PHX_TRACING:
-        with tracer.start_as_current_span(name=span_name) as span:
-            # to set the span kind (avoid unknown)
-            span.set_attribute(OPENINFERENCE_SPAN_KIND, "Retriever")
-            span.set_attribute(SpanAttributes.TOOL_NAME, "oracle_vector_store")
-            span.set_attribute(SpanAttributes.TOOL_DESCRIPTION, "Oracle DB 23c free")
-            span.set_status(Status(StatusCode.OK))
+        attributes = {
+            SpanAttributes.TOOL_NAME: "oracle_vector_store",
+            SpanAttributes.TOOL_DESCRIPTION: "Oracle DB 23c free",
+        }
 
-            yield span
-    else:
-        # provide a neutral context if no context is required
-        yield None
+    # the SQL execute and the CLOB reads are child spans (see measure_stage)
+    with optional_span(span_name, kind="Retriever", attributes=attributes) as span:
+        yield span
 
 
 def oracle_query(embed_query: List[float], top_k: int = 2, verbose=False):
@@ -113,6 +164,7 @@ def oracle_query(embed_query: List[float], top_k: int = 2, verbose=False):
 
     History:
         23/12/2023: modified to return some metadata (book_name, page_num)
+        13/03/2024: connections taken from the pool
     Args:
         embed_query (List[float]): A list of floats representing the query vector embedding.
         top_k (int, optional): The number of closest vectors to retrieve. Defaults to 2.
@@ -123,11 +175,9 @@ def oracle_query(embed_query: List[float], top_k: int = 2, verbose=False):
     """
     start_time = time.time()
 
-    # build the DSN from data taken from config.py
-    DSN = f"{DB_HOST_IP}/{DB_SERVICE}"
-
     try:
-        with oracledb.connect(user=DB_USER, password=DB_PWD, dsn=DSN) as connection:
+        # the connection is given back to the pool at the end
+        with get_db_pool().acquire() as connection:
             with connection.cursor() as cursor:
                 # 'f' single precision 'd' double precision
                 array_type = "d" if EMBEDDINGS_BITS == 64 else "f"
@@ -146,29 +196,35 @@ def oracle_query(embed_query: List[float], top_k: int = 2, verbose=False):
                 if verbose:
                     logging.info(f"SQL Query: {select}")
 
-                cursor.execute(select, [array_query])
-                rows = cursor.fetchall()
+                with measure_stage("vector_search"), VECTOR_QUERY_SECONDS.time():
+                    cursor.execute(select, [array_query])
+                    rows = cursor.fetchall()
+
+                VECTOR_ROWS_FETCHED.inc(len(rows))
 
                 result_nodes, node_ids, similarities = [], [], []
 
                 # prepare output
-                for row in rows:
-                    # row[1] is a clob
-                    full_clob_data = row[1].read()
-
-                    # 29/12: added book_name to metadata
-                    result_nodes.append(
-                        TextNode(
-                            id_=row[0],
-                            text=full_clob_data,
-                            metadata={"file_name": row[4], "page_label": row[2]},
+                with measure_stage("clob_fetch"), CLOB_FETCH_SECONDS.time():
+                    for row in rows:
+                        # row[1] is a clob
+                        full_clob_data = row[1].read()
+                        CLOB_FETCHED_BYTES.inc(len(full_clob_data.encode("utf-8")))
+
+                        # 29/12: added book_name to metadata
+                        result_nodes.append(
+                            TextNode(
+                                id_=row[0],
+                                text=full_clob_data,
+                                metadata={"file_name": row[4], "page_label": row[2]},
+                            )
                         )
-                    )
-                    node_ids.append(row[0])
-                    similarities.append(row[3])
+                        node_ids.append(row[0])
+                        similarities.append(row[3])
 
     except Exception as e:
         logging.error(f"Error occurred in oracle_query: {e}")
+        VECTOR_QUERY_ERRORS.inc()
         return None
 
     q_result = VectorStoreQueryResult(
@@ -292,6 +348,22 @@ class OracleVectorStore(VectorStore):
                 verbose=self.verbose,
             )
 
+    async def aquery(
+        self,
+        query: VectorStoreQuery,
+        **kwargs: Any,
+    ) -> VectorStoreQueryResult:
+        """
+        Get nodes for response, without blocking the event loop.
+        The num. of concurrent queries is limited (ASYNC_BACKEND_LIMITS)
+        """
+        # imported here, only the async engines need it
+        from async_limits import backend_limits
+
+        async with backend_limits.limit("vector_db"):
+            # the connection comes from the pool, in a worker thread
+            return await asyncio.to_thread(self.query, query, **kwargs)
+
     def persist(self, persist_path=None, fs=None) -> None:
         """
         Persist VectorStore to Oracle DB
@@ -0,0 +1,284 @@
+"""
+File name: pipeline_metrics.py
+Author: Luigi Saetta
+Date created: 2024-03-13
+Date last modified: 2024-03-13
+Python Version: 3.9
+
+Description:
+    This module provides the Prometheus metrics of the pipeline (histograms,
+    counters and gauges), cumulative for the process:
+    - vector search: query latency, rows fetched, CLOB fetch time and bytes
+    - rerank: batch size, latency and failures of the backend calls,
+      latency, bypass and degraded reranks of the postprocessor
+    - embeddings: calls, texts, tokens and latency (queries and ingest);
+      with the embedding cache, stage query counts only the calls to the
+      model (the misses), stage query_request all the requests of the engines
+    - LLM: calls, prompt and completion tokens, latency
+    - caches: hits and misses (embeddings, rerank scores, answers, translations)
+    - DB pool: busy, opened and max connections (read at scrape time)
+
+    request_metrics gives the metrics of a single request, these ones the
+    aggregates over all the requests (percentiles, rates, error rates).
+    The llama-index events (embedding, LLM) are recorded by MetricsHandler,
+    added to the callback manager of the engines.
+
+    The metrics are exposed:
+    - by rag_service.py, in GET /metrics
+    - by an HTTP server on METRICS_PORT (for the Streamlit UIs), if set
+    - as a text dump: metrics_text() or write_metrics(path)
+
+Usage:
+    Import this module into other scripts to use its functions.
+    Example:
+    RERANK_BATCH_SIZE.labels(backend="oci_baai").observe(len(texts))
+
+    print(metrics_text())
+
+License:
+    This code is released under the MIT License.
+
+Notes:
+    This is a part of a set of demo showing how to use Oracle Vector DB,
+    OCI GenAI service, Oracle GenAI Embeddings, to build a RAG solution,
+    where all he data (text + embeddings) are stored in Oracle DB 23c
+
+Warnings:
+    This module is in development, may change in future versions.
+"""
+
+import time
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+
+from prometheus_client import (
+    REGISTRY,
+    CONTENT_TYPE_LATEST,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    start_http_server,
+    write_to_textfile,
+)
+
+from llama_index.callbacks.base_handler import BaseCallbackHandler
+from llama_index.callbacks.schema import CBEventType, EventPayload
+from llama_index.callbacks.token_counting import get_llm_token_counts
+from llama_index.utilities.token_counting import TokenCounter
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+# in sec., the LLM calls are much slower than the other stages
+LLM_BUCKETS = (0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+#
+# vector search (oracle_vector_db)
+#
+VECTOR_QUERY_SECONDS = Histogram(
+    "rag_vector_query_seconds", "Time of the vector search (execute + fetch)"
+)
+VECTOR_QUERY_ERRORS = Counter(
+    "rag_vector_query_errors_total", "Vector searches terminated with an error"
+)
+VECTOR_ROWS_FETCHED = Counter(
+    "rag_vector_rows_fetched_total", "Rows returned by the vector searches"
+)
+CLOB_FETCH_SECONDS = Histogram(
+    "rag_clob_fetch_seconds", "Time to read the CLOBs of a vector search"
+)
+CLOB_FETCHED_BYTES = Counter(
+    "rag_clob_fetched_bytes_total", "Bytes (utf-8) of the CLOBs read"
+)
+
+#
+# rerank: backend calls (OCI deployment, local model) and postprocessor
+#
+RERANK_BATCH_SIZE = Histogram(
+    "rag_rerank_batch_size",
+    "Num. of texts in a call to the reranker",
+    ["backend"],
+    buckets=SIZE_BUCKETS,
+)
+RERANK_CALL_SECONDS = Histogram(
+    "rag_rerank_call_seconds", "Time of a call to the reranker", ["backend"]
+)
+RERANK_CALL_FAILURES = Counter(
+    "rag_rerank_call_failures_total",
+    "Calls to the reranker failed (error, timeout, circuit open)",
+    ["backend"],
+)
+RERANK_SECONDS = Histogram(
+    "rag_rerank_seconds", "Time of the rerank step (cache included)", ["reranker"]
+)
+RERANK_DEGRADED = Counter(
+    "rag_rerank_degraded_total",
+    "Reranks not available, vector order used",
+    ["reranker"],
+)
+RERANK_BYPASSED = Counter(
+    "rag_rerank_bypassed_total", "Reranks skipped by the policy", ["reranker", "reason"]
+)
+
+#
+# embeddings (stage: query, query_request or ingest) and LLM
+#
+EMBEDDING_CALLS = Counter(
+    "rag_embedding_calls_total", "Calls to the embedding model", ["stage"]
+)
+EMBEDDING_TEXTS = Counter("rag_embedding_texts_total", "Texts embedded", ["stage"])
+EMBEDDING_TOKENS = Counter(
+    "rag_embedding_tokens_total", "Tokens of the texts embedded", ["stage"]
+)
+EMBEDDING_SECONDS = Histogram(
+    "rag_embedding_seconds", "Time of a call to the embedding model", ["stage"]
+)
+LLM_CALLS = Counter("rag_llm_calls_total", "Calls to the LLM")
+LLM_TOKENS = Counter("rag_llm_tokens_total", "Tokens used by the LLM", ["type"])
+LLM_SECONDS = Histogram(
+    "rag_llm_seconds", "Time of a call to the LLM", buckets=LLM_BUCKETS
+)
+
+#
+# caches (hit rate = hits / (hits + misses))
+#
+CACHE_HITS = Counter("rag_cache_hits_total", "Cache hits", ["cache"])
+CACHE_MISSES = Counter("rag_cache_misses_total", "Cache misses", ["cache"])
+
+#
+# DB pool (see oracle_vector_db.get_db_pool)
+#
+POOL_BUSY_CONNECTIONS = Gauge("rag_db_pool_busy", "Connections of the pool in use")
+POOL_OPENED_CONNECTIONS = Gauge("rag_db_pool_opened", "Connections of the pool opened")
+POOL_MAX_CONNECTIONS = Gauge("rag_db_pool_max", "Max connections of the pool")
+
+_server_started = False
+_server_lock = threading.Lock()
+
+
+def metrics_text():
+    """
+    all the metrics, in the Prometheus text format
+    """
+    return generate_latest(REGISTRY).decode("utf-8")
+
+
+def write_metrics(path):
+    """
+    dumps the metrics in a file (format of the node exporter textfile collector)
+    """
+    write_to_textfile(path, REGISTRY)
+
+    logging.info(f"Metrics saved in {path}...")
+
+
+def start_metrics_server(port):
+    """
+    exposes /metrics on port (only the first call starts the server)
+    """
+    global _server_started
+
+    with _server_lock:
+        if not _server_started:
+            start_http_server(port)
+            _server_started = True
+
+            logging.info(f"Metrics exposed on port {port}...")
+
+
+def observe_embeddings(stage, texts, elapsed, tokenizer=None):
+    """
+    records a call to the embedding model
+    tokenizer: function str -> list of tokens, if None tokens are not counted
+    """
+    EMBEDDING_CALLS.labels(stage=stage).inc()
+    EMBEDDING_TEXTS.labels(stage=stage).inc(len(texts))
+    EMBEDDING_SECONDS.labels(stage=stage).observe(elapsed)
+
+    if tokenizer is not None:
+        n_tokens = sum(len(tokenizer(text)) for text in texts)
+        EMBEDDING_TOKENS.labels(stage=stage).inc(n_tokens)
+
+
+class MetricsHandler(BaseCallbackHandler):
+    """
+    Records the llama-index events of the engines:
+    embeddings of the queries and LLM calls
+    """
+
+    def __init__(self, tokenizer=None, embedding_stage="query"):
+        """
+        tokenizer: function str -> list of tokens, as for TokenCountingHandler
+        embedding_stage: label of the embedding events. The events are raised
+            before the embedding cache is consulted: if the cache is used,
+            query_request (the calls to the model are counted by the cache)
+        """
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+
+        self._tokenizer = tokenizer
+        self._embedding_stage = embedding_stage
+        self._token_counter = TokenCounter(tokenizer=tokenizer)
+        # event_id -> start time
+        self._starts = {}
+        self._lock = threading.Lock()
+
+    def on_event_start(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        parent_id: str = "",
+        **kwargs: Any,
+    ) -> str:
+        if event_type in (CBEventType.EMBEDDING, CBEventType.LLM):
+            # the end could be called in another thread (ex: streaming)
+            with self._lock:
+                self._starts[event_id] = time.time()
+
+        return event_id
+
+    def on_event_end(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        **kwargs: Any,
+    ) -> None:
+        with self._lock:
+            tStart = self._starts.pop(event_id, None)
+
+        if tStart is None:
+            return
+
+        elapsed = time.time() - tStart
+
+        if event_type == CBEventType.EMBEDDING:
+            texts = (payload or {}).get(EventPayload.CHUNKS, [])
+
+            observe_embeddings(
+                self._embedding_stage, texts, elapsed, tokenizer=self._tokenizer
+            )
+
+        elif event_type == CBEventType.LLM:
+            LLM_CALLS.inc()
+            LLM_SECONDS.observe(elapsed)
+
+            if payload is not None:
+                counts = get_llm_token_counts(self._token_counter, payload)
+
+                LLM_TOKENS.labels(type="prompt").inc(counts.prompt_token_count)
+                LLM_TOKENS.labels(type="completion").inc(counts.completion_token_count)
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        pass
+
+    def end_trace(
+        self,
+        trace_id: Optional[str] = None,
+        trace_map: Optional[Dict[str, List[str]]] = None,
+    ) -> None:
+        pass
@@ -28,38 +28,53 @@ Warnings:
 """
 
 import logging
+import asyncio
 
 from llama_index import VectorStoreIndex, ServiceContext
 from llama_index.callbacks import CallbackManager
-from tokenizers import Tokenizer
 from llama_index.callbacks import TokenCountingHandler
-from llama_index.postprocessor.cohere_rerank import CohereRerank
-from llama_index.llms import MistralAI
 
-import ads
-from ads.llm import GenerativeAIEmbeddings, GenerativeAI
-
-# COHERE_KEY is used for reranker
 # MISTRAL_KEY for LLM
-from config_private import COMPARTMENT_OCID, ENDPOINT, MISTRAL_API_KEY, COHERE_API_KEY
+from config_private import COMPARTMENT_OCID, ENDPOINT, MISTRAL_API_KEY
 
 from config import (
     EMBED_MODEL_TYPE,
     EMBED_MODEL,
-    TOKENIZER,
     GEN_MODEL,
     MAX_TOKENS,
-    TOP_K,
     ADD_RERANKER,
-    RERANKER_MODEL,
-    RERANKER_ID,
-    TOP_N,
+    ADD_CONTEXT_COMPRESSION,
+    LLM_CONTEXT_WINDOW,
+    CONTEXT_PROMPT_RESERVE,
+    ADD_PHX_TRACING,
+    METRICS_PORT,
+    ADD_EMBED_CACHE,
+    EMBED_CACHE_MAX_SIZE,
+    EMBED_CACHE_PATH,
+    ADD_EMBED_BATCHING,
+    EMBED_BATCH_MAX_SIZE,
+    EMBED_BATCH_WAIT,
+    EMBED_BATCH_TIMEOUT,
+    ADD_SEMANTIC_CACHE,
+    SEMANTIC_CACHE_THRESHOLD,
+    SEMANTIC_CACHE_TTL,
 )
 
-from oci_utils import load_oci_config, print_configuration
+from oci_utils import print_configuration
 from oracle_vector_db import OracleVectorStore
-from oci_baai_reranker import OCIBAAIReranker
-from oci_llama_reranker import OCILLamaReranker
+from timing import StageTimer
+from request_metrics import RequestMetricsHandler
+from pipeline_metrics import MetricsHandler, start_metrics_server
+from tracing import TracingHandler, get_tracer
+from component_registry import registry, engine_copy, get_auth, get_tokenizer
+
+# reranker and retriever are the same in the two chains
+from chain_components import (
+    streaming_supported,
+    create_reranker,
+    create_retriever,
+)
+from async_engines import AsyncRerankQueryEngine
 
 # Configure logging
 logging.basicConfig(
@@ -70,6 +85,8 @@ logging.basicConfig(
 # This module now expse directly the factory methods for all the single components (llm, etc)
 # the philosophy of the factory methods  is that they're taking all the infos from the config
 # module... so as few parameter as possible
+# Provider modules (ads, MistralAI, Cohere, the OCI rerankers...) are imported
+# inside the factory methods, only when selected in config.py: faster startup
 #
 
 
@@ -81,6 +98,8 @@ def create_llm(auth=None):
     llm = None
 
     if GEN_MODEL == "OCI":
+        from ads.llm import GenerativeAI
+
         llm = GenerativeAI(
             auth=auth,
             compartment_id=COMPARTMENT_OCID,
@@ -90,6 +109,8 @@ def create_llm(auth=None):
             client_kwargs={"service_endpoint": ENDPOINT},
         )
     if GEN_MODEL == "MISTRAL":
+        from llama_index.llms import MistralAI
+
         llm = MistralAI(
             api_key=MISTRAL_API_KEY,
             model="mistral-small",
@@ -100,28 +121,22 @@ def create_llm(auth=None):
     return llm
 
 
-def create_reranker(auth=None, verbose=False):
-    reranker = None
-
-    if RERANKER_MODEL == "COHERE":
-        reranker = CohereRerank(api_key=COHERE_API_KEY, top_n=TOP_N)
-
-    if RERANKER_MODEL == "OCI_BAAI":
-        baai_reranker = OCIBAAIReranker(
-            auth=auth, deployment_id=RERANKER_ID, region="eu-frankfurt-1"
-        )
+def create_context_compressor(tokenizer):
+    from context_compressor import ContextCompressor, compute_token_budget
 
-        reranker = OCILLamaReranker(
-            oci_reranker=baai_reranker, top_n=TOP_N, verbose=verbose
-        )
+    token_budget = compute_token_budget(
+        LLM_CONTEXT_WINDOW, MAX_TOKENS, CONTEXT_PROMPT_RESERVE
+    )
 
-    return reranker
+    return ContextCompressor(tokenizer=tokenizer, token_budget=token_budget)
 
 
 def create_embedding_model(auth=None):
     embed_model = None
 
     if EMBED_MODEL_TYPE == "OCI":
+        from ads.llm import GenerativeAIEmbeddings
+
         embed_model = GenerativeAIEmbeddings(
             compartment_id=COMPARTMENT_OCID,
             model=EMBED_MODEL,
@@ -131,34 +146,123 @@ def create_embedding_model(auth=None):
             client_kwargs={"service_endpoint": ENDPOINT},
         )
 
+    # questions arriving together are embedded in a single call
+    if ADD_EMBED_BATCHING and embed_model is not None:
+        from embedding_batcher import BatchingEmbeddings
+
+        embed_model = BatchingEmbeddings(
+            embed_model,
+            max_batch_size=EMBED_BATCH_MAX_SIZE,
+            max_wait=EMBED_BATCH_WAIT,
+            timeout=EMBED_BATCH_TIMEOUT,
+        )
+
+    # repeated questions skip the call to the embeddings service
+    if ADD_EMBED_CACHE and embed_model is not None:
+        from embedding_cache import CachedEmbeddings
+
+        embed_model = CachedEmbeddings(
+            embed_model,
+            model_name=EMBED_MODEL,
+            max_size=EMBED_CACHE_MAX_SIZE,
+            persist_path=EMBED_CACHE_PATH,
+            tokenizer=get_tokenizer().encode,
+        )
+
     return embed_model
 
 
-def create_query_engine(token_counter=None, verbose=False):
+def create_query_engine(
+    token_counter=None,
+    verbose=False,
+    streaming=False,
+    async_limits=False,
+    warm_up=False,
+):
+    """
+    streaming: if True, query() returns a StreamingResponse
+    (tokens in response_gen, as generated by the LLM)
+    async_limits: if True, in aquery the calls to the backends are limited
+    (ASYNC_BACKEND_LIMITS), used by acreate_query_engine
+    warm_up: if True, the remote services and the DB pool are warmed
+    (only once in the process)
+    """
     logging.info("calling create_query_engine()...")
 
     print_configuration()
 
-    # load security info needed for OCI
-    oci_config = load_oci_config()
+    if streaming and not streaming_supported():
+        logging.warning(f"Streaming not supported for {GEN_MODEL}, disabled...")
+        streaming = False
+
+    # to report where the startup time goes
+    timer = StageTimer()
 
-    # need to do this way
-    api_keys_config = ads.auth.api_keys(oci_config)
+    # the heavy components are built once per process (see component_registry)
+    with timer.measure("oci_auth"):
+        api_keys_config = get_auth()
 
     # this is to embed the question
-    embed_model = create_embedding_model(auth=api_keys_config)
+    with timer.measure("embed_model"):
+        embed_model = registry.get(
+            "embed_model",
+            lambda: create_embedding_model(auth=api_keys_config),
+            key=(EMBED_MODEL_TYPE, EMBED_MODEL, None),
+        )
 
     # this is the custom class to access Oracle DB as Vectore Store
-    v_store = OracleVectorStore(verbose=False)
+    with timer.measure("vector_store"):
+        v_store = OracleVectorStore(verbose=False)
 
     # this is to access OCI or MISTRAL GenAI service
-    llm = create_llm(auth=api_keys_config)
+    with timer.measure("llm"):
+        llm = registry.get(
+            "llm",
+            lambda: create_llm(auth=api_keys_config),
+            key=(__name__, GEN_MODEL, MAX_TOKENS),
+        )
+
+        # the engine changes the LLM (callback manager, streaming callbacks):
+        # each engine works on its own (shallow) copy
+        llm = engine_copy(llm)
+
+    if async_limits:
+        from async_limits import LimitedEmbeddings, limited_llm
+
+        embed_model = LimitedEmbeddings(embed_model)
+        llm = limited_llm(llm)
 
     # this part has been added to count the total # of tokens
-    cohere_tokenizer = Tokenizer.from_pretrained(TOKENIZER)
+    with timer.measure("tokenizer"):
+        cohere_tokenizer = get_tokenizer()
     token_counter = TokenCountingHandler(tokenizer=cohere_tokenizer.encode)
 
-    callback_manager = CallbackManager([token_counter])
+    # time and tokens of each request (see request_metrics)
+    metrics_handler = RequestMetricsHandler(tokenizer=cohere_tokenizer.encode)
+
+    # Prometheus metrics of all the requests (see pipeline_metrics)
+    handlers = [
+        token_counter,
+        metrics_handler,
+        # with the cache, the calls to the model are counted by CachedEmbeddings
+        MetricsHandler(
+            tokenizer=cohere_tokenizer.encode,
+            embedding_stage="query_request" if ADD_EMBED_CACHE else "query",
+        ),
+    ]
+
+    # spans for embedding, rerank and LLM calls
+    if ADD_PHX_TRACING:
+        # Phoenix and the exporter, before the first request (once per process)
+        with timer.measure("tracing"):
+            get_tracer()
+
+        handlers.append(TracingHandler(tokenizer=cohere_tokenizer.encode))
+
+    callback_manager = CallbackManager(handlers)
+
+    if METRICS_PORT is not None:
+        start_metrics_server(METRICS_PORT)
 
     # integrate OCI/Mistral in llama-index
     service_context = ServiceContext.from_defaults(
@@ -172,17 +276,86 @@ def create_query_engine(token_counter=None, verbose=False):
     # the whole chain (query string -> embed query -> retrieval -> context, query-> GenAI -> response)
     # is wrapped in the query engine
 
+    retriever = create_retriever(index, v_store, service_context, verbose=verbose)
+
     # here we could plug a reranker improving the quality
+    node_postprocessors = []
+    reranker = None
+
     if ADD_RERANKER == True:
-        reranker = create_reranker(auth=api_keys_config)
+        with timer.measure("reranker"):
+            reranker = create_reranker(auth=api_keys_config)
+
+        node_postprocessors.append(reranker)
+
+    # after the reranker: only the TOP_N chunks are compressed
+    if ADD_CONTEXT_COMPRESSION:
+        node_postprocessors.append(create_context_compressor(cohere_tokenizer))
+
+    # same as index.as_query_engine, but in aquery the
+    # OCI reranker doesn't block the event loop
+    query_engine = AsyncRerankQueryEngine.from_args(
+        retriever,
+        service_context=service_context,
+        node_postprocessors=node_postprocessors,
+        streaming=streaming,
+    )
+
+    # answers to similar questions are taken from DB
+    if ADD_SEMANTIC_CACHE:
+        from semantic_cache import SemanticAnswerCache, SemanticCacheQueryEngine
+
+        semantic_cache = registry.get(
+            "semantic_cache",
+            lambda: SemanticAnswerCache(
+                threshold=SEMANTIC_CACHE_THRESHOLD, ttl=SEMANTIC_CACHE_TTL
+            ),
+            key=(SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_TTL),
+        )
 
-        query_engine = index.as_query_engine(
-            similarity_top_k=TOP_K, node_postprocessors=[reranker]
+        query_engine = SemanticCacheQueryEngine(
+            query_engine,
+            embed_model=service_context.embed_model,
+            cache=semantic_cache,
+            verbose=verbose,
         )
-    else:
-        query_engine = index.as_query_engine(similarity_top_k=TOP_K)
+
+    if warm_up:
+        from warmup import warm_up as warm_up_components
+
+        with timer.measure("warm_up"):
+            # the components are shared: the warm-up is done once
+            registry.get(
+                "warm_up",
+                lambda: warm_up_components(
+                    embed_model=embed_model,
+                    vector_store=v_store,
+                    reranker=reranker,
+                    tokenizer=cohere_tokenizer,
+                ),
+                # the two chains have different components (ex: embed model)
+                key="query",
+            )
+
+    timer.report("Query engine startup time")
 
     # to add a blank line in the log
     logging.info("")
 
     return query_engine, token_counter
+
+
+async def acreate_query_engine(verbose=False, streaming=False, warm_up=False):
+    """
+    Async variant of create_query_engine: the engine is built in a worker thread
+    (the heavy components are created once, see component_registry) and in
+    aquery every backend is awaited: embeddings, OracleVectorStore.aquery,
+    reranker and LLM, each one limited by ASYNC_BACKEND_LIMITS
+    """
+    return await asyncio.to_thread(
+        create_query_engine,
+        verbose=verbose,
+        streaming=streaming,
+        async_limits=True,
+        warm_up=warm_up,
+    )
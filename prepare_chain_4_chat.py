@@ -28,52 +28,59 @@ Warnings:
     This module is in development, may change in future versions.
 """
 
-import os
 import logging
+import asyncio
 
-import llama_index
 from llama_index import VectorStoreIndex, ServiceContext
 from llama_index.callbacks import CallbackManager
-from tokenizers import Tokenizer
 from llama_index.callbacks import TokenCountingHandler
-from llama_index.postprocessor.cohere_rerank import CohereRerank
-from llama_index.llms import MistralAI
 from llama_index.memory import ChatMemoryBuffer
 
-import ads
-from ads.llm import GenerativeAIEmbeddings, GenerativeAI
-
-# COHERE_KEY is used for reranker
 # MISTRAL_KEY for LLM
-from config_private import COMPARTMENT_OCID, ENDPOINT, MISTRAL_API_KEY, COHERE_API_KEY
+from config_private import COMPARTMENT_OCID, ENDPOINT, MISTRAL_API_KEY
 
 from config import (
     EMBED_MODEL_TYPE,
     EMBED_MODEL,
-    TOKENIZER,
     GEN_MODEL,
     MAX_TOKENS,
     TEMPERATURE,
     TOP_K,
-    TOP_N,
     ADD_RERANKER,
-    RERANKER_MODEL,
-    RERANKER_ID,
+    ADD_CONTEXT_COMPRESSION,
+    LLM_CONTEXT_WINDOW,
+    CONTEXT_PROMPT_RESERVE,
+    ADD_EMBED_CACHE,
+    EMBED_CACHE_MAX_SIZE,
+    EMBED_CACHE_PATH,
+    ADD_EMBED_BATCHING,
+    EMBED_BATCH_MAX_SIZE,
+    EMBED_BATCH_WAIT,
+    EMBED_BATCH_TIMEOUT,
     CHAT_MODE,
+    CHAT_SPECULATIVE_RETRIEVAL,
+    SPECULATIVE_SIMILARITY_THRESHOLD,
     MEMORY_TOKEN_LIMIT,
+    CHAT_SUMMARY_MEMORY,
+    MEMORY_RECENT_TOKEN_LIMIT,
     ADD_PHX_TRACING,
-    PHX_PORT,
-    PHX_HOST,
+    METRICS_PORT,
 )
 
-from oci_utils import load_oci_config, print_configuration
+from oci_utils import print_configuration
 from oracle_vector_db import OracleVectorStore
-from oci_baai_reranker import OCIBAAIReranker
-from oci_llama_reranker import OCILLamaReranker
-
-# added phx tracing
-if ADD_PHX_TRACING:
-    import phoenix as px
+from timing import StageTimer
+from request_metrics import RequestMetricsHandler
+from pipeline_metrics import MetricsHandler, start_metrics_server
+from tracing import TracingHandler, get_tracer
+from component_registry import registry, engine_copy, get_auth, get_tokenizer
+
+# reranker and retriever are the same in the two chains
+from chain_components import (
+    create_reranker,
+    create_retriever,
+)
+from async_engines import AsyncRerankChatEngine
 
 # Configure logging
 logging.basicConfig(
@@ -84,6 +91,8 @@ logging.basicConfig(
 # This module now expose directly the factory methods for all the single components (llm, etc)
 # the philosophy of the factory methods  is that they're taking all the infos from the config
 # module... so as few parameters as possible
+# Provider modules (ads, MistralAI, Cohere, the OCI rerankers...) are imported
+# inside the factory methods, only when selected in config.py: faster startup
 #
 
 
@@ -121,13 +130,19 @@ def create_llm(auth=None):
     }
 
     if GEN_MODEL == "OCI":
+        from ads.llm import GenerativeAI
+
         llm = GenerativeAI(
             name="cohere.command",
             **common_oci_params,
         )
     if GEN_MODEL == "LLAMA":
+        from ads.llm import GenerativeAI
+
         llm = GenerativeAI(name="meta.llama-2-70b-chat", **common_oci_params)
     if GEN_MODEL == "MISTRAL":
+        from llama_index.llms import MistralAI
+
         llm = MistralAI(
             api_key=MISTRAL_API_KEY,
             model="mistral-medium",
@@ -138,30 +153,17 @@ def create_llm(auth=None):
     return llm
 
 
-def create_reranker(auth=None, verbose=False):
-    model_list = ["COHERE", "OCI_BAAI"]
+def create_context_compressor(tokenizer):
+    from context_compressor import ContextCompressor, compute_token_budget
 
-    if RERANKER_MODEL not in model_list:
-        raise ValueError(
-            f"The value {RERANKER_MODEL} is not supported. Choose a value in {model_list} for the Reranker model."
-        )
-
-    reranker = None
-
-    if RERANKER_MODEL == "COHERE":
-        reranker = CohereRerank(api_key=COHERE_API_KEY, top_n=TOP_N)
-
-    # reranker model deployed as MD in OCI DS
-    if RERANKER_MODEL == "OCI_BAAI":
-        baai_reranker = OCIBAAIReranker(
-            auth=auth, deployment_id=RERANKER_ID, region="eu-frankfurt-1"
-        )
-
-        reranker = OCILLamaReranker(
-            oci_reranker=baai_reranker, top_n=TOP_N, verbose=verbose
-        )
+    # the context and the chat history must fit also in the memory
+    # token limit, otherwise the memory raises an error
+    token_budget = min(
+        compute_token_budget(LLM_CONTEXT_WINDOW, MAX_TOKENS, CONTEXT_PROMPT_RESERVE),
+        max(0, MEMORY_TOKEN_LIMIT - CONTEXT_PROMPT_RESERVE),
+    )
 
-    return reranker
+    return ContextCompressor(tokenizer=tokenizer, token_budget=token_budget)
 
 
 def create_embedding_model(auth=None):
@@ -175,6 +177,8 @@ def create_embedding_model(auth=None):
     embed_model = None
 
     if EMBED_MODEL_TYPE == "OCI":
+        from ads.llm import GenerativeAIEmbeddings
+
         embed_model = GenerativeAIEmbeddings(
             auth=auth,
             compartment_id=COMPARTMENT_OCID,
@@ -187,43 +191,131 @@ def create_embedding_model(auth=None):
             client_kwargs={"service_endpoint": ENDPOINT},
         )
 
+    # questions arriving together are embedded in a single call
+    if ADD_EMBED_BATCHING and embed_model is not None:
+        from embedding_batcher import BatchingEmbeddings
+
+        embed_model = BatchingEmbeddings(
+            embed_model,
+            max_batch_size=EMBED_BATCH_MAX_SIZE,
+            max_wait=EMBED_BATCH_WAIT,
+            timeout=EMBED_BATCH_TIMEOUT,
+        )
+
+    # repeated questions skip the call to the embeddings service
+    # (truncate in the key: vectors of long texts differ)
+    if ADD_EMBED_CACHE and embed_model is not None:
+        from embedding_cache import CachedEmbeddings
+
+        embed_model = CachedEmbeddings(
+            embed_model,
+            model_name=f"{EMBED_MODEL}:END",
+            max_size=EMBED_CACHE_MAX_SIZE,
+            persist_path=EMBED_CACHE_PATH,
+            tokenizer=get_tokenizer().encode,
+        )
+
     return embed_model
 
 
+def setup_process():
+    """
+    The setup done once in the process, not for every chat engine
+    (with ChatSessionManager an engine is built for each session)
+    """
+    # for now the only supported here...
+    print_configuration()
+
+    if ADD_PHX_TRACING:
+        # Phoenix and the exporter (see tracing.py), before the first request
+        get_tracer()
+
+    return True
+
+
 #
 # the entire chain is built here
 #
-def create_chat_engine(token_counter=None, verbose=False):
+def create_chat_engine(
+    token_counter=None, verbose=False, async_limits=False, warm_up=False
+):
+    """
+    The engine supports chat() and, if streaming_supported(), stream_chat()
+    async_limits: if True, in achat the calls to the backends are limited
+    (ASYNC_BACKEND_LIMITS), used by acreate_chat_engine
+    warm_up: if True, the remote services and the DB pool are warmed
+    (only once in the process)
+    """
     logging.info("calling create_chat_engine()...")
 
-    # for now the only supported here...
-    print_configuration()
-
-    if ADD_PHX_TRACING:
-        os.environ["PHOENIX_PORT"] = PHX_PORT
-        os.environ["PHOENIX_HOST"] = PHX_HOST
-        px.launch_app()
-        llama_index.set_global_handler("arize_phoenix")
+    # to report where the startup time goes
+    timer = StageTimer()
 
-    # load security info needed for OCI
-    oci_config = load_oci_config()
+    # configuration and Phoenix: once per process
+    with timer.measure("process_setup"):
+        registry.get("process_setup", setup_process, key=__name__)
 
-    api_keys_config = ads.auth.api_keys(oci_config)
+    # the heavy components are built once per process (see component_registry)
+    with timer.measure("oci_auth"):
+        api_keys_config = get_auth()
 
     # this is to embed the question
-    embed_model = create_embedding_model(auth=api_keys_config)
+    with timer.measure("embed_model"):
+        embed_model = registry.get(
+            "embed_model",
+            lambda: create_embedding_model(auth=api_keys_config),
+            key=(EMBED_MODEL_TYPE, EMBED_MODEL, "END"),
+        )
 
     # this is the custom class to access Oracle DB as Vectore Store
-    v_store = OracleVectorStore(verbose=False)
+    with timer.measure("vector_store"):
+        v_store = OracleVectorStore(verbose=False)
 
     # this is to access OCI or MISTRAL GenAI service
-    llm = create_llm(auth=api_keys_config)
+    with timer.measure("llm"):
+        llm = registry.get(
+            "llm",
+            lambda: create_llm(auth=api_keys_config),
+            key=(__name__, GEN_MODEL, MAX_TOKENS, TEMPERATURE),
+        )
+
+        # the engine changes the LLM (callback manager, streaming callbacks):
+        # each engine works on its own (shallow) copy
+        llm = engine_copy(llm)
+
+    if async_limits:
+        from async_limits import LimitedEmbeddings, limited_llm
+
+        embed_model = LimitedEmbeddings(embed_model)
+        llm = limited_llm(llm)
 
     # this part has been added to count the total # of tokens
-    cohere_tokenizer = Tokenizer.from_pretrained(TOKENIZER)
+    with timer.measure("tokenizer"):
+        cohere_tokenizer = get_tokenizer()
     token_counter = TokenCountingHandler(tokenizer=cohere_tokenizer.encode)
 
-    callback_manager = CallbackManager([token_counter])
+    # time and tokens of each request (see request_metrics)
+    metrics_handler = RequestMetricsHandler(tokenizer=cohere_tokenizer.encode)
+
+    # Prometheus metrics of all the requests (see pipeline_metrics)
+    handlers = [
+        token_counter,
+        metrics_handler,
+        # with the cache, the calls to the model are counted by CachedEmbeddings
+        MetricsHandler(
+            tokenizer=cohere_tokenizer.encode,
+            embedding_stage="query_request" if ADD_EMBED_CACHE else "query",
+        ),
+    ]
+
+    # spans for embedding, rerank and LLM calls
+    if ADD_PHX_TRACING:
+        handlers.append(TracingHandler(tokenizer=cohere_tokenizer.encode))
+
+    callback_manager = CallbackManager(handlers)
+
+    if METRICS_PORT is not None:
+        start_metrics_server(METRICS_PORT)
 
     # integrate OCI/Mistral in llama-index
     service_context = ServiceContext.from_defaults(
@@ -234,33 +326,108 @@ def create_chat_engine(token_counter=None, verbose=False):
         vector_store=v_store, service_context=service_context
     )
 
-    memory = ChatMemoryBuffer.from_defaults(
-        token_limit=MEMORY_TOKEN_LIMIT, tokenizer_fn=cohere_tokenizer.encode
-    )
+    if CHAT_SUMMARY_MEMORY:
+        from summary_memory import SummaryChatMemory
+
+        # the older turns are summarized, the prompt doesn't grow
+        memory = SummaryChatMemory.from_defaults(
+            llm=service_context.llm,
+            token_limit=MEMORY_TOKEN_LIMIT,
+            recent_token_limit=MEMORY_RECENT_TOKEN_LIMIT,
+            tokenizer_fn=cohere_tokenizer.encode,
+        )
+    else:
+        memory = ChatMemoryBuffer.from_defaults(
+            token_limit=MEMORY_TOKEN_LIMIT, tokenizer_fn=cohere_tokenizer.encode
+        )
 
     # the whole chain (query string -> embed query -> retrieval ->
     # reranker -> context, query-> GenAI -> response)
     # is wrapped in the chat engine
 
+    retriever = create_retriever(index, v_store, service_context, verbose=verbose)
+
     # here we could plug a reranker improving the quality
-    node_postprocessors = None
+    node_postprocessors = []
+    reranker = None
 
     if ADD_RERANKER == True:
-        reranker = create_reranker(auth=api_keys_config)
-
-        node_postprocessors = [reranker]
+        with timer.measure("reranker"):
+            reranker = create_reranker(auth=api_keys_config)
+
+        node_postprocessors.append(reranker)
+
+    # after the reranker: only the TOP_N chunks are compressed
+    if ADD_CONTEXT_COMPRESSION:
+        node_postprocessors.append(create_context_compressor(cohere_tokenizer))
+
+    if CHAT_MODE == "condense_plus_context" and CHAT_SPECULATIVE_RETRIEVAL:
+        from speculative_chat import SpeculativeChatEngine
+
+        # retrieval on the raw message runs during the condensation
+        chat_engine = SpeculativeChatEngine.from_defaults(
+            retriever=retriever,
+            service_context=service_context,
+            memory=memory,
+            node_postprocessors=node_postprocessors,
+            verbose=False,
+            embed_model=service_context.embed_model,
+            similarity_threshold=SPECULATIVE_SIMILARITY_THRESHOLD,
+        )
+    elif CHAT_MODE == "condense_plus_context":
+        # same as index.as_chat_engine, but in achat the
+        # OCI reranker doesn't block the event loop
+        chat_engine = AsyncRerankChatEngine.from_defaults(
+            retriever=retriever,
+            service_context=service_context,
+            memory=memory,
+            node_postprocessors=node_postprocessors,
+            verbose=False,
+        )
     else:
-        pass
-
-    chat_engine = index.as_chat_engine(
-        chat_mode=CHAT_MODE,
-        memory=memory,
-        verbose=False,
-        similarity_top_k=TOP_K,
-        node_postprocessors=node_postprocessors,
-    )
+        chat_engine = index.as_chat_engine(
+            chat_mode=CHAT_MODE,
+            memory=memory,
+            verbose=False,
+            similarity_top_k=TOP_K,
+            node_postprocessors=node_postprocessors,
+        )
 
-    # to add a blank line in the log
-    logging.info("")
+    if warm_up:
+        from warmup import warm_up as warm_up_components
+
+        with timer.measure("warm_up"):
+            # the components are shared: the warm-up is done once
+            registry.get(
+                "warm_up",
+                lambda: warm_up_components(
+                    embed_model=embed_model,
+                    vector_store=v_store,
+                    reranker=reranker,
+                    tokenizer=cohere_tokenizer,
+                ),
+                # the two chains have different components (ex: embed model)
+                key="chat",
+            )
+
+    # reported only for the first engine: the next ones (one for each
+    # session) reuse the shared components
+    registry.get(
+        "startup_report",
+        lambda: timer.report("Chat engine startup time"),
+        key=__name__,
+    )
 
     return chat_engine, token_counter
+
+
+async def acreate_chat_engine(verbose=False, warm_up=False):
+    """
+    Async variant of create_chat_engine: the engine is built in a worker thread
+    (the heavy components are created once, see component_registry) and in
+    achat every backend is awaited: embeddings, OracleVectorStore.aquery,
+    reranker and LLM, each one limited by ASYNC_BACKEND_LIMITS
+    """
+    return await asyncio.to_thread(
+        create_chat_engine, verbose=verbose, async_limits=True, warm_up=warm_up
+    )
@@ -0,0 +1,159 @@
+"""
+File name: rag_service.py
+Author: Luigi Saetta
+Date created: 2024-03-13
+Date last modified: 2024-03-13
+Python Version: 3.9
+
+Description:
+    This module provides a headless HTTP service for the RAG chain
+    (the query engine of prepare_chain), so that a UI can be a thin client.
+    The engine is built once at startup and shared by all the requests,
+    served concurrently from a single event loop (aquery):
+    - the questions arriving together are embedded in a single call
+      (ADD_EMBED_BATCHING)
+    - all the requests share the DB connection pool
+    - the calls to each backend are limited (ASYNC_BACKEND_LIMITS)
+
+    Endpoints:
+    - POST /query: {"question": "..."} -> answer, references, elapsed time
+    - GET /health: the process is alive
+    - GET /ready: the engine is built and the DB is reachable
+    - GET /metrics: Prometheus metrics of the pipeline (see pipeline_metrics)
+
+Usage:
+    run with: ./run_rag_service.sh
+    (or: uvicorn rag_service:app --host 0.0.0.0 --port 8000)
+
+License:
+    This code is released under the MIT License.
+
+Notes:
+    This is a part of a set of demo showing how to use Oracle Vector DB,
+    OCI GenAI service, Oracle GenAI Embeddings, to build a RAG solution,
+    where all he data (text + embeddings) are stored in Oracle DB 23c
+
+Warnings:
+    This module is in development, may change in future versions.
+"""
+
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import List
+
+from fastapi import FastAPI, HTTPException, Response
+from pydantic import BaseModel
+
+# to use the acreate_query_engine
+import prepare_chain
+from component_registry import registry
+from oracle_vector_db import ping_db
+from request_metrics import track_request
+from pipeline_metrics import CONTENT_TYPE_LATEST, metrics_text
+
+from config import SERVICE_HOST, SERVICE_PORT, ADD_WARM_UP
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+class QueryRequest(BaseModel):
+    question: str
+
+
+class QueryResponse(BaseModel):
+    answer: str
+    references: List[dict]
+    elapsed: float
+    # time of each stage and tokens of the request
+    metrics: dict
+
+
+# set at startup
+state = {"query_engine": None, "token_counter": None}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    logging.info("Starting RAG service...")
+
+    # the pool and the remote services are warmed before the first request
+    query_engine, token_counter = await prepare_chain.acreate_query_engine(
+        verbose=False, warm_up=ADD_WARM_UP
+    )
+    state["query_engine"] = query_engine
+    state["token_counter"] = token_counter
+
+    logging.info("RAG service ready...")
+
+    yield
+
+    logging.info("Stopping RAG service...")
+
+    # the aiohttp sessions must be closed while the loop is running
+    await registry.aclose()
+
+
+app = FastAPI(title="OCI RAG service", lifespan=lifespan)
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+
+@app.get("/ready")
+async def ready():
+    if state["query_engine"] is None:
+        raise HTTPException(status_code=503, detail="Query engine not ready")
+
+    try:
+        await asyncio.to_thread(ping_db)
+    except Exception as e:
+        logging.error("DB not reachable...")
+        logging.error(e)
+
+        raise HTTPException(status_code=503, detail="DB not reachable")
+
+    return {"status": "ready"}
+
+
+@app.get("/metrics")
+async def metrics():
+    # to be scraped by Prometheus
+    return Response(content=metrics_text(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.post("/query", response_model=QueryResponse)
+async def query(request: QueryRequest):
+    if state["query_engine"] is None:
+        raise HTTPException(status_code=503, detail="Query engine not ready")
+
+    tStart = time.time()
+
+    try:
+        with track_request() as metrics:
+            response = await state["query_engine"].aquery(request.question)
+    except Exception as e:
+        logging.error("An error occurred: " + str(e))
+
+        raise HTTPException(status_code=500, detail=str(e))
+
+    tEla = time.time() - tStart
+    logging.info(f"Elapsed time: {round(tEla, 1)} sec.")
+
+    return QueryResponse(
+        answer=str(response.response),
+        references=[node.metadata for node in response.source_nodes],
+        elapsed=round(tEla, 2),
+        metrics=metrics.as_dict(),
+    )
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host=SERVICE_HOST, port=SERVICE_PORT)
@@ -0,0 +1,224 @@
+"""
+File name: request_metrics.py
+Author: Luigi Saetta
+Date created: 2024-03-13
+Date last modified: 2024-03-13
+Python Version: 3.9
+
+Description:
+    This module provides the metrics of a single request (question):
+    time spent in each stage (embed, vector search, CLOB fetch, rerank,
+    LLM, translation) and tokens used by the LLM.
+    The token_counter of the engines is cumulative (all the questions,
+    all the users), these metrics are only of the current request.
+
+    With Phoenix tracing, the request and its stages are spans too.
+
+    The current request is kept in a context variable: it follows the
+    request in asyncio tasks and in asyncio.to_thread, for a ThreadPoolExecutor
+    use submit_with_context. The llama-index events (embedding, reranking, LLM)
+    are recorded by RequestMetricsHandler, added to the callback manager
+    of the engines, the DB stages by measure_stage in oracle_vector_db.
+
+    If the same stage is executed more times (ex: parallel vector searches)
+    times are summed.
+
+Usage:
+    Import this module into other scripts to use its functions.
+    Example:
+    with track_request() as metrics:
+        response = query_engine.query(question)
+
+    attach_metrics(response, metrics)
+    metrics.as_dict()
+
+License:
+    This code is released under the MIT License.
+
+Notes:
+    This is a part of a set of demo showing how to use Oracle Vector DB,
+    OCI GenAI service, Oracle GenAI Embeddings, to build a RAG solution,
+    where all he data (text + embeddings) are stored in Oracle DB 23c
+
+Warnings:
+    This module is in development, may change in future versions.
+"""
+
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from llama_index.callbacks.base_handler import BaseCallbackHandler
+from llama_index.callbacks.schema import CBEventType
+from llama_index.callbacks.token_counting import get_llm_token_counts
+from llama_index.utilities.token_counting import TokenCounter
+
+from timing import StageTimer
+from tracing import optional_span
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+# the metrics of the request in progress (None outside of track_request)
+_current_request = contextvars.ContextVar("current_request", default=None)
+
+# llama-index events recorded, with the name of the stage
+EVENT_STAGES = {
+    CBEventType.EMBEDDING: "embed",
+    CBEventType.RERANKING: "rerank",
+    CBEventType.LLM: "llm",
+}
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.timer = StageTimer()
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self._lock = threading.Lock()
+
+    def add_tokens(self, prompt_tokens, completion_tokens):
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+    def as_dict(self):
+        return {
+            "stages": {
+                stage: round(elapsed, 3)
+                for stage, elapsed in self.timer.as_dict().items()
+            },
+            "total": round(self.timer.total, 3),
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+        }
+
+    def report(self, title="Request metrics"):
+        self.timer.report(title)
+
+        logging.info(f"  prompt tokens: {self.prompt_tokens}")
+        logging.info(f"  completion tokens: {self.completion_tokens}")
+
+
+def current_request():
+    return _current_request.get()
+
+
+@contextmanager
+def track_request():
+    metrics = RequestMetrics()
+    token = _current_request.set(metrics)
+
+    try:
+        # with tracing, the root span of the request
+        with optional_span("rag_request"):
+            yield metrics
+    finally:
+        _current_request.reset(token)
+
+
+@contextmanager
+def measure_stage(stage):
+    """
+    times the stage in the current request, if any
+    (and, with tracing, it's a span)
+    """
+    metrics = _current_request.get()
+
+    with optional_span(stage):
+        if metrics is None:
+            yield
+            return
+
+        with metrics.timer.measure(stage):
+            yield
+
+
+def submit_with_context(executor, fn, *args, **kwargs):
+    """
+    executor.submit, but fn runs in the context of the caller
+    (a context can be entered by one thread at a time: a copy for each call)
+    """
+    ctx = contextvars.copy_context()
+
+    return executor.submit(ctx.run, fn, *args, **kwargs)
+
+
+def attach_metrics(response, metrics):
+    """
+    adds the metrics to the response (Response or chat response)
+    as attribute request_metrics. For streaming responses, call it at the end
+    of the stream: only then the LLM time and tokens are complete
+    """
+    response.request_metrics = metrics.as_dict()
+
+    return response
+
+
+class RequestMetricsHandler(BaseCallbackHandler):
+    """
+    Records the time of the llama-index events, and the tokens of the LLM,
+    in the current request
+    """
+
+    def __init__(self, tokenizer=None):
+        """
+        tokenizer: function str -> list of tokens, as for TokenCountingHandler
+        """
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+
+        self._token_counter = TokenCounter(tokenizer=tokenizer)
+        # event_id -> (start time, metrics)
+        self._starts = {}
+        self._lock = threading.Lock()
+
+    def on_event_start(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        parent_id: str = "",
+        **kwargs: Any,
+    ) -> str:
+        metrics = _current_request.get()
+
+        if metrics is not None and event_type in EVENT_STAGES:
+            # the end could be called in another thread (ex: streaming)
+            with self._lock:
+                self._starts[event_id] = (time.time(), metrics)
+
+        return event_id
+
+    def on_event_end(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        **kwargs: Any,
+    ) -> None:
+        with self._lock:
+            start = self._starts.pop(event_id, None)
+
+        if start is None:
+            return
+
+        tStart, metrics = start
+        metrics.timer.add(EVENT_STAGES[event_type], time.time() - tStart)
+
+        if event_type == CBEventType.LLM and payload is not None:
+            counts = get_llm_token_counts(self._token_counter, payload)
+            metrics.add_tokens(counts.prompt_token_count, counts.completion_token_count)
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        pass
+
+    def end_trace(
+        self,
+        trace_id: Optional[str] = None,
+        trace_map: Optional[Dict[str, List[str]]] = None,
+    ) -> None:
+        pass
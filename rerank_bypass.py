@@ -0,0 +1,145 @@
+"""
+File name: rerank_bypass.py
+Author: Luigi Saetta
+Date created: 2024-03-11
+Date last modified: 2024-03-11
+Python Version: 3.9
+
+Description:
+    This module provides an adaptive policy to skip the remote rerank
+    when the vector scores are already decisive:
+    - fewer candidates than top_n
+    - the top hit is far ahead of the second (margin)
+    - the distribution of the scores is peaked (normalized entropy)
+    It keeps track of how often the rerank has been skipped and of the
+    (estimated) latency saved
+
+Usage:
+    Import this module into other scripts to use its functions.
+    Example:
+    bypass_policy = RerankBypassPolicy(margin=0.1)
+
+    reranker = OCILLamaReranker(
+        oci_reranker=baai_reranker, top_n=TOP_N, bypass_policy=bypass_policy
+    )
+
+License:
+    This code is released under the MIT License.
+
+Notes:
+    This is a part of a set of demo showing how to use Oracle Vector DB,
+    OCI GenAI service, Oracle GenAI Embeddings, to build a RAG solution,
+    where all he data (text + embeddings) are stored in Oracle DB 23c
+
+Warnings:
+    This module is in development, may change in future versions.
+"""
+
+import math
+import threading
+
+
+def normalized_entropy(similarities, temperature):
+    """
+    Entropy of softmax(similarities / temperature), divided by log(n)
+    0: all the mass on one candidate, 1: uniform
+    """
+    if len(similarities) < 2:
+        return 0.0
+
+    max_sim = max(similarities)
+    weights = [math.exp((sim - max_sim) / temperature) for sim in similarities]
+    tot = sum(weights)
+    probs = [w / tot for w in weights]
+
+    entropy = -sum(p * math.log(p) for p in probs if p > 0)
+
+    return entropy / math.log(len(similarities))
+
+
+class RerankBypassPolicy:
+    def __init__(
+        self,
+        margin=None,
+        max_entropy=None,
+        temperature=0.05,
+        scores_are_distances=True,
+    ):
+        """
+        margin: skip if sim(top1) - sim(top2) >= margin (None: disabled)
+        max_entropy: skip if the normalized entropy of the scores is
+            <= max_entropy (None: disabled)
+        temperature: used in the softmax for the entropy
+        scores_are_distances: OracleVectorStore returns VECTOR_DISTANCE(.., DOT)
+            (lower is better), so the similarity is -score
+        """
+        self.margin = margin
+        self.max_entropy = max_entropy
+        self.temperature = temperature
+        self.scores_are_distances = scores_are_distances
+
+        self._lock = threading.Lock()
+        self.n_reranked = 0
+        self.n_bypassed = 0
+        self.bypassed_by_reason = {}
+        # moving average of the latency of the rerank
+        self.avg_rerank_time = None
+        self.saved_time = 0.0
+
+    def similarities(self, nodes):
+        scores = [node.score if node.score is not None else 0.0 for node in nodes]
+
+        if self.scores_are_distances:
+            return [-score for score in scores]
+
+        return scores
+
+    def should_bypass(self, nodes, top_n):
+        """
+        Returns the reason to skip the rerank, or None if the rerank is needed
+        """
+        if len(nodes) <= top_n:
+            return "few_candidates"
+
+        sims = sorted(self.similarities(nodes), reverse=True)
+
+        if self.margin is not None and sims[0] - sims[1] >= self.margin:
+            return "margin"
+
+        if (
+            self.max_entropy is not None
+            and normalized_entropy(sims, self.temperature) <= self.max_entropy
+        ):
+            return "entropy"
+
+        return None
+
+    def record_rerank(self, elapsed):
+        with self._lock:
+            self.n_reranked += 1
+
+            if self.avg_rerank_time is None:
+                self.avg_rerank_time = elapsed
+            else:
+                self.avg_rerank_time = 0.9 * self.avg_rerank_time + 0.1 * elapsed
+
+    def record_bypass(self, reason):
+        with self._lock:
+            self.n_bypassed += 1
+            self.bypassed_by_reason[reason] = self.bypassed_by_reason.get(reason, 0) + 1
+
+            if self.avg_rerank_time is not None:
+                self.saved_time += self.avg_rerank_time
+
+    def get_stats(self):
+        with self._lock:
+            tot = self.n_reranked + self.n_bypassed
+
+            return {
+                "n_reranked": self.n_reranked,
+                "n_bypassed": self.n_bypassed,
+                "bypass_rate": self.n_bypassed / tot if tot > 0 else 0.0,
+                "bypassed_by_reason": dict(self.bypassed_by_reason),
+                "avg_rerank_time": self.avg_rerank_time,
+                "saved_time": self.saved_time,
+            }
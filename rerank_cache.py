@@ -0,0 +1,221 @@
+"""
+File name: rerank_cache.py
+Author: Luigi Saetta
+Date created: 2024-03-10
+Date last modified: 2024-03-10
+Python Version: 3.9
+
+Description:
+    This module provides a bounded LRU cache for the scores computed
+    by the cross-encoder reranker, keyed by hash(query) + hash(chunk).
+    In chat mode the same (condensed) question often comes back with the same
+    chunks: only the couples not in the cache are sent to the deployment
+
+    If persist_path is set, the cache is saved in background (at most once
+    every save_delay sec., see schedule_save) and at the exit of the process,
+    not at every rerank.
+
+Usage:
+    Import this module into other scripts to use its functions.
+    Example:
+    score_cache = RerankScoreCache(max_size=5000, ttl=3600)
+
+    reranker = OCILLamaReranker(
+        oci_reranker=baai_reranker, top_n=TOP_N, score_cache=score_cache
+    )
+
+License:
+    This code is released under the MIT License.
+
+Notes:
+    This is a part of a set of demo showing how to use Oracle Vector DB,
+    OCI GenAI service, Oracle GenAI Embeddings, to build a RAG solution,
+    where all he data (text + embeddings) are stored in Oracle DB 23c
+
+Warnings:
+    This module is in development, may change in future versions.
+"""
+
+import os
+import json
+import time
+import atexit
+import tempfile
+import threading
+import logging
+from collections import OrderedDict
+
+from oci_utils import hash_text
+from pipeline_metrics import CACHE_HITS, CACHE_MISSES
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+class RerankScoreCache:
+    def __init__(
+        self,
+        max_size=5000,
+        ttl=None,
+        persist_path=None,
+        namespace="",
+        save_delay=10.0,
+    ):
+        """
+        max_size: max num. of scores kept, the least recently used are evicted
+        ttl: time to live of a score in sec. (None: never expires)
+        persist_path: if set, the cache is loaded from and saved to this json file
+        namespace: added to the keys (ex: the reranker model), to avoid using
+            scores computed by a different model
+        save_delay: in sec., the new scores are saved after this delay,
+            together with the ones added in the meantime
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persist_path = persist_path
+        self.namespace = namespace
+        self.save_delay = save_delay
+
+        # key -> (score, time of insertion)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+        # one save at a time, the cache is shared by all the engines
+        self._save_lock = threading.Lock()
+        # the pending background save, if any
+        self._save_timer = None
+
+        self.hits = 0
+        self.misses = 0
+
+        if self.persist_path is not None:
+            if os.path.exists(self.persist_path):
+                self.load()
+
+            # the scores added after the last background save
+            atexit.register(self.save)
+
+    def make_key(self, query, text):
+        return f"{self.namespace}:{hash_text(query)}:{hash_text(text)}"
+
+    def _is_expired(self, inserted_at, now):
+        return self.ttl is not None and now - inserted_at > self.ttl
+
+    def get(self, key):
+        """
+        Returns the score, or None if not in the cache (or expired)
+        """
+        with self._lock:
+            entry = self._cache.get(key)
+
+            if entry is not None and self._is_expired(entry[1], time.time()):
+                del self._cache[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                CACHE_MISSES.labels(cache="rerank_score").inc()
+                return None
+
+            # mark as recently used
+            self._cache.move_to_end(key)
+            self.hits += 1
+            CACHE_HITS.labels(cache="rerank_score").inc()
+
+            return entry[0]
+
+    def put(self, key, score):
+        with self._lock:
+            self._cache[key] = (float(score), time.time())
+            self._cache.move_to_end(key)
+
+            while len(self._cache) > self.max_size:
+                # evict the least recently used
+                self._cache.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+    @property
+    def hit_rate(self):
+        tot = self.hits + self.misses
+
+        return self.hits / tot if tot > 0 else 0.0
+
+    def schedule_save(self):
+        """
+        Save the cache in background, after save_delay sec.
+        (if a save is already pending, nothing to do)
+        """
+        if self.persist_path is None:
+            return
+
+        with self._lock:
+            if self._save_timer is not None:
+                return
+
+            self._save_timer = threading.Timer(self.save_delay, self._timed_save)
+            # doesn't keep the process alive: atexit saves the last scores
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def _timed_save(self):
+        with self._lock:
+            self._save_timer = None
+
+        self.save()
+
+    def save(self):
+        """
+        Save the cache in persist_path (json), writing a temp file
+        to avoid leaving a truncated file
+        """
+        if self.persist_path is None:
+            return
+
+        with self._save_lock:
+            # taken here: an older snapshot must not be written last
+            with self._lock:
+                entries = [[key, score, ts] for key, (score, ts) in self._cache.items()]
+
+            # unique temp file, in the same dir (os.replace must not cross fs)
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.persist_path)),
+                prefix=os.path.basename(self.persist_path),
+                suffix=".tmp",
+            )
+
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(entries, f)
+                os.replace(tmp_path, self.persist_path)
+            except Exception as e:
+                logging.error("Error in RerankScoreCache save...")
+                logging.error(e)
+
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    def load(self):
+        try:
+            with open(self.persist_path, "r") as f:
+                entries = json.load(f)
+        except Exception as e:
+            logging.error("Error in RerankScoreCache load...")
+            logging.error(e)
+            return
+
+        now = time.time()
+
+        with self._lock:
+            # entries are saved from the least to the most recently used
+            for key, score, ts in entries[max(0, len(entries) - self.max_size) :]:
+                if not self._is_expired(ts, now):
+                    self._cache[key] = (score, ts)
+
+        logging.info(f"Loaded {len(self._cache)} rerank scores from cache...")
@@ -0,0 +1,157 @@
+"""
+File name: resilience.py
+Author: Luigi Saetta
+Date created: 2024-03-11
+Date last modified: 2024-03-11
+Python Version: 3.9
+
+Description:
+    This module provides small helpers to protect the chain from
+    a slow or unhealthy remote service (ex: the reranker Model Deployment):
+    - CircuitBreaker: stops calling the service after repeated failures
+    - LatencyTracker: keeps the recent latencies, to compute percentiles
+      (ex: the delay for hedged requests)
+
+Usage:
+    Import this module into other scripts to use its functions.
+    Example:
+    breaker = CircuitBreaker(failure_threshold=5, reset_timeout=30)
+
+    if breaker.allow_request():
+        ...
+        breaker.record_success()
+
+License:
+    This code is released under the MIT License.
+
+Notes:
+    This is a part of a set of demo showing how to use Oracle Vector DB,
+    OCI GenAI service, Oracle GenAI Embeddings, to build a RAG solution,
+    where all he data (text + embeddings) are stored in Oracle DB 23c
+
+Warnings:
+    This module is in development, may change in future versions.
+"""
+
+import time
+import threading
+import logging
+from collections import deque
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, name="service"):
+        """
+        failure_threshold: consecutive failures to open the circuit
+        reset_timeout: sec. to wait, when open, before letting a trial call through
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.name = name
+
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        # in half open only one trial call at a time
+        self._trial_in_flight = False
+
+        self.n_opened = 0
+        self.n_short_circuited = 0
+
+    @property
+    def state(self):
+        return self._state
+
+    def allow_request(self):
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+
+            if self._state == self.OPEN:
+                if time.time() - self._opened_at >= self.reset_timeout:
+                    self._state = self.HALF_OPEN
+                    self._trial_in_flight = False
+                else:
+                    self.n_short_circuited += 1
+                    return False
+
+            # half open
+            if self._trial_in_flight:
+                self.n_short_circuited += 1
+                return False
+
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logging.info(f"Circuit breaker for {self.name} closed...")
+
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+
+            if self._state == self.HALF_OPEN or (
+                self._state == self.CLOSED and self._failures >= self.failure_threshold
+            ):
+                self._state = self.OPEN
+                self._opened_at = time.time()
+                self.n_opened += 1
+
+                logging.warning(
+                    f"Circuit breaker for {self.name} open after {self._failures} failures..."
+                )
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "state": self._state,
+                "consecutive_failures": self._failures,
+                "n_opened": self.n_opened,
+                "n_short_circuited": self.n_short_circuited,
+            }
+
+
+class LatencyTracker:
+    def __init__(self, window=200):
+        """
+        window: num. of most recent latencies kept
+        """
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, elapsed):
+        with self._lock:
+            self._latencies.append(elapsed)
+
+    def __len__(self):
+        return len(self._latencies)
+
+    def percentile(self, p):
+        """
+        p in [0, 100], None if no latency has been recorded
+        """
+        with self._lock:
+            values = sorted(self._latencies)
+
+        if len(values) == 0:
+            return None
+
+        index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+
+        return values[index]
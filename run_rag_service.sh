@@ -0,0 +1 @@
+python rag_service.py
@@ -0,0 +1,412 @@
+"""
+File name: semantic_cache.py
+Author: Luigi Saetta
+Date created: 2024-03-13
+Date last modified: 2024-03-13
+Python Version: 3.9
+
+Description:
+    This module provides a semantic cache of the answers, in front of the
+    RAG query engine. For every answer it stores in the ANSWER_CACHE table
+    (see create_tables.sql) the embedding of the question, the answer and
+    the ids of the chunks used as context.
+    A new question, whose embedding is close enough to a cached one,
+    gets the cached answer without retrieval, rerank and LLM call.
+
+    An entry is invalidated if the chunks it references have changed
+    (or have been removed): a fingerprint of the text of the chunks is saved
+    with the answer and checked at every hit.
+
+    The answers are written in background (one thread), so a stream ends
+    without waiting for the DB.
+
+    The answer depends also on the flags in the question that shape it
+    (ex: the request of a translation, see WORD_TO_TRIGGER_TRANS): they give
+    the variant of the entry, and a hit must have the same variant.
+
+Usage:
+    Import this module into other scripts to use its functions.
+    Example:
+    cache = SemanticAnswerCache(threshold=0.95, ttl=86400)
+
+    query_engine = SemanticCacheQueryEngine(
+        query_engine, embed_model=service_context.embed_model, cache=cache
+    )
+
+License:
+    This code is released under the MIT License.
+
+Notes:
+    This is a part of a set of demo showing how to use Oracle Vector DB,
+    OCI GenAI service, Oracle GenAI Embeddings, to build a RAG solution,
+    where all he data (text + embeddings) are stored in Oracle DB 23c
+
+Warnings:
+    This module is in development, may change in future versions.
+"""
+
+import time
+import json
+import array
+import asyncio
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import oracledb
+
+from llama_index.core.base_query_engine import BaseQueryEngine
+from llama_index.response.schema import Response, StreamingResponse
+from llama_index.schema import NodeWithScore, QueryBundle, TextNode
+
+from config import EMBEDDINGS_BITS, WORD_TO_TRIGGER_TRANS
+from oracle_vector_db import get_db_pool
+from pipeline_metrics import CACHE_HITS, CACHE_MISSES
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+def normalize_question(question):
+    return " ".join(question.lower().split())
+
+
+def answer_variant(question):
+    """
+    the flags in the question that change the answer, not only its topic
+    (a question asking for the translation must not get the plain answer)
+    """
+    if WORD_TO_TRIGGER_TRANS.lower() in question.lower():
+        return f"trans:{WORD_TO_TRIGGER_TRANS.lower()}"
+
+    return "default"
+
+
+def chunks_fingerprint(chunks):
+    """
+    chunks: list of (id, text)
+    the fingerprint changes if any text changes or a chunk is missing
+    """
+    sha = hashlib.sha256()
+
+    for chunk_id, text in sorted(chunks):
+        sha.update(chunk_id.encode("utf-8"))
+        sha.update(text.encode("utf-8"))
+
+    return sha.hexdigest()
+
+
+class SemanticAnswerCache:
+    def __init__(self, threshold=0.95, ttl=None, verbose=False):
+        """
+        threshold: min. similarity (dot product, the embeddings are normalized)
+            between the new and the cached question
+        ttl: in sec., None: entries never expire
+        """
+        self.threshold = threshold
+        self.ttl = ttl
+        self.verbose = verbose
+
+        self._lock = threading.Lock()
+        # the writes, in order, out of the request path
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_invalidated = 0
+
+    def _connect(self):
+        # a connection from the pool, given back at the end of the with
+        return get_db_pool().acquire()
+
+    def _to_array(self, embedding):
+        # 'f' single precision 'd' double precision
+        array_type = "d" if EMBEDDINGS_BITS == 64 else "f"
+
+        return array.array(array_type, embedding)
+
+    def _inc_stat(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _read_chunks(self, cursor, node_ids):
+        """
+        returns, for the node_ids still in DB, the list of (id, text, page, book)
+        """
+        if len(node_ids) == 0:
+            return []
+
+        binds = ", ".join(f":{i + 1}" for i in range(len(node_ids)))
+
+        cursor.execute(
+            f"""select C.ID, C.CHUNK, C.PAGE_NUM, B.NAME
+                from CHUNKS C, BOOKS B
+                where C.BOOK_ID = B.ID and C.ID in ({binds})""",
+            node_ids,
+        )
+
+        return [(row[0], row[1].read(), row[2], row[3]) for row in cursor.fetchall()]
+
+    def lookup(self, embedding, variant="default"):
+        """
+        returns (answer, source_nodes, similarity) or None if miss
+        variant: see answer_variant, only entries with the same are considered
+        """
+        tStart = time.time()
+
+        select = """select ID, ANSWER, NODE_IDS, FINGERPRINT,
+                    ROUND(VECTOR_DISTANCE(VEC, :1, DOT), 3) as d
+                    from ANSWER_CACHE
+                    where VARIANT = :2"""
+        params = [self._to_array(embedding), variant]
+
+        if self.ttl is not None:
+            select += " and CREATED_AT > SYSTIMESTAMP - NUMTODSINTERVAL(:3, 'SECOND')"
+            params.append(self.ttl)
+
+        select += " order by d FETCH FIRST 1 ROWS ONLY"
+
+        try:
+            with self._connect() as connection:
+                with connection.cursor() as cursor:
+                    cursor.execute(select, params)
+                    row = cursor.fetchone()
+
+                    # DOT distance is the negative of the dot product
+                    if row is None or -row[4] < self.threshold:
+                        self._inc_stat("n_misses")
+                        CACHE_MISSES.labels(cache="semantic").inc()
+                        return None
+
+                    entry_id, answer = row[0], row[1].read()
+                    node_ids = json.loads(row[2])
+                    similarity = -row[4]
+
+                    # check that the chunks used for the answer didn't change
+                    chunks = self._read_chunks(cursor, node_ids)
+
+                    fingerprint = chunks_fingerprint([(c[0], c[1]) for c in chunks])
+
+                    if len(chunks) < len(node_ids) or fingerprint != row[3]:
+                        logging.info("Semantic cache: entry invalidated...")
+
+                        cursor.execute(
+                            "delete from ANSWER_CACHE where ID = :1", [entry_id]
+                        )
+                        connection.commit()
+
+                        self._inc_stat("n_invalidated")
+                        self._inc_stat("n_misses")
+                        CACHE_MISSES.labels(cache="semantic").inc()
+                        return None
+
+        except Exception as e:
+            logging.error("Error in SemanticAnswerCache lookup...")
+            logging.error(e)
+
+            self._inc_stat("n_misses")
+            CACHE_MISSES.labels(cache="semantic").inc()
+            return None
+
+        self._inc_stat("n_hits")
+        CACHE_HITS.labels(cache="semantic").inc()
+
+        # same metadata returned by oracle_query, for the references
+        source_nodes = [
+            NodeWithScore(
+                node=TextNode(
+                    id_=c[0],
+                    text=c[1],
+                    metadata={"file_name": c[3], "page_label": c[2]},
+                ),
+                score=None,
+            )
+            for c in chunks
+        ]
+
+        if self.verbose:
+            logging.info(
+                f"Semantic cache hit (similarity {similarity}) in {round(time.time() - tStart, 2)} sec."
+            )
+
+        return answer, source_nodes, similarity
+
+    def put(self, question, embedding, answer, source_nodes):
+        """
+        saves the answer in background, returns the Future of the write
+        """
+        return self._executor.submit(
+            self._write, question, embedding, answer, source_nodes
+        )
+
+    def _write(self, question, embedding, answer, source_nodes):
+        node_ids = [n.node.node_id for n in source_nodes]
+        variant = answer_variant(question)
+
+        entry_id = hashlib.sha256(
+            normalize_question(question).encode("utf-8")
+        ).hexdigest()
+
+        try:
+            with self._connect() as connection:
+                with connection.cursor() as cursor:
+                    # read from DB: the text in the nodes could have been
+                    # changed by the postprocessors
+                    chunks = self._read_chunks(cursor, node_ids)
+                    fingerprint = chunks_fingerprint([(c[0], c[1]) for c in chunks])
+
+                    if len(chunks) < len(node_ids):
+                        # the answer would be invalidated at the first hit
+                        return
+
+                    # the same question could have been answered again
+                    cursor.execute("delete from ANSWER_CACHE where ID = :1", [entry_id])
+
+                    cursor.setinputsizes(
+                        None, oracledb.DB_TYPE_CLOB, oracledb.DB_TYPE_CLOB
+                    )
+                    cursor.execute(
+                        """insert into ANSWER_CACHE
+                        (ID, QUESTION, ANSWER, NODE_IDS, FINGERPRINT, VARIANT, VEC,
+                        CREATED_AT)
+                        values (:1, :2, :3, :4, :5, :6, :7, SYSTIMESTAMP)""",
+                        [
+                            entry_id,
+                            question,
+                            answer,
+                            json.dumps(node_ids),
+                            fingerprint,
+                            variant,
+                            self._to_array(embedding),
+                        ],
+                    )
+
+                connection.commit()
+
+        except Exception as e:
+            logging.error("Error in SemanticAnswerCache put...")
+            logging.error(e)
+
+    def clear(self):
+        with self._connect() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("delete from ANSWER_CACHE")
+
+            connection.commit()
+
+    @property
+    def hit_rate(self):
+        n_total = self.n_hits + self.n_misses
+
+        return self.n_hits / n_total if n_total > 0 else 0.0
+
+    def get_stats(self):
+        return {
+            "n_hits": self.n_hits,
+            "n_misses": self.n_misses,
+            "n_invalidated": self.n_invalidated,
+            "hit_rate": round(self.hit_rate, 3),
+        }
+
+
+class SemanticCacheQueryEngine(BaseQueryEngine):
+    """
+    Wraps a query engine: answers from the cache when possible,
+    otherwise calls the engine and saves the answer
+    """
+
+    def __init__(self, query_engine, embed_model, cache, verbose=False):
+        """
+        embed_model: the llama-index embed model used by the engine
+        """
+        self._query_engine = query_engine
+        self._embed_model = embed_model
+        self._cache = cache
+        self.verbose = verbose
+
+        super().__init__(callback_manager=query_engine.callback_manager)
+
+    def _get_prompt_modules(self):
+        return {"query_engine": self._query_engine}
+
+    def get_metrics(self):
+        return self._cache.get_stats()
+
+    def _cached_response(self, hit):
+        answer, source_nodes, similarity = hit
+
+        return Response(
+            response=answer,
+            source_nodes=source_nodes,
+            metadata={"semantic_cache": True, "similarity": similarity},
+        )
+
+    def _save_response(self, query_bundle, response):
+        """
+        if streaming, the answer is saved when the stream ends
+        """
+        if isinstance(response, StreamingResponse):
+            response_gen = response.response_gen
+
+            def gen():
+                tokens = []
+                for token in response_gen:
+                    tokens.append(token)
+                    yield token
+
+                self._cache.put(
+                    query_bundle.query_str,
+                    query_bundle.embedding,
+                    "".join(tokens),
+                    response.source_nodes,
+                )
+
+            response.response_gen = gen()
+
+        elif response.response:
+            self._cache.put(
+                query_bundle.query_str,
+                query_bundle.embedding,
+                response.response,
+                response.source_nodes,
+            )
+
+        return response
+
+    def _query(self, query_bundle: QueryBundle):
+        # the embedding is computed once: on a miss it is used by the retriever
+        if query_bundle.embedding is None:
+            query_bundle.embedding = self._embed_model.get_query_embedding(
+                query_bundle.query_str
+            )
+
+        hit = self._cache.lookup(
+            query_bundle.embedding, answer_variant(query_bundle.query_str)
+        )
+
+        if hit is not None:
+            return self._cached_response(hit)
+
+        response = self._query_engine.query(query_bundle)
+
+        return self._save_response(query_bundle, response)
+
+    async def _aquery(self, query_bundle: QueryBundle):
+        if query_bundle.embedding is None:
+            query_bundle.embedding = await self._embed_model.aget_query_embedding(
+                query_bundle.query_str
+            )
+
+        hit = await asyncio.to_thread(
+            self._cache.lookup,
+            query_bundle.embedding,
+            answer_variant(query_bundle.query_str),
+        )
+
+        if hit is not None:
+            return self._cached_response(hit)
+
+        response = await self._query_engine.aquery(query_bundle)
+
+        return self._save_response(query_bundle, response)
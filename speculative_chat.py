@@ -0,0 +1,281 @@
+"""
+File name: speculative_chat.py
+Author: Luigi Saetta
+Date created: 2024-03-13
+Date last modified: 2024-03-13
+Python Version: 3.9
+
+Description:
+    This module provides a condense_plus_context chat engine with
+    speculative retrieval: while the LLM condenses the history and the new
+    message in a standalone question, the retrieval (embedding, vector search)
+    is already running on the raw message.
+    If the condensed question is close enough to the raw message
+    (cosine similarity of the embeddings), the speculative nodes are used,
+    otherwise the retrieval is done again for the condensed question
+    (reusing its embedding).
+    The postprocessors (the rerank, the most expensive call) are applied
+    only after, always with the condensed question.
+
+    The price is a wasted vector search for every miss:
+    get_speculation_stats() reports the hit rate and the latency saved.
+
+Usage:
+    Import this module into other scripts to use its functions.
+    Example:
+        chat_engine = SpeculativeChatEngine.from_defaults(
+            retriever=index.as_retriever(similarity_top_k=TOP_K),
+            service_context=service_context,
+            memory=memory,
+            node_postprocessors=[reranker],
+            embed_model=service_context.embed_model,
+            similarity_threshold=0.9,
+        )
+
+License:
+    This code is released under the MIT License.
+
+Notes:
+    This is a part of a set of demo showing how to use Oracle Vector DB,
+    OCI GenAI service, Oracle GenAI Embeddings, to build a RAG solution,
+    where all he data (text + embeddings) are stored in Oracle DB 23c
+
+Warnings:
+    This module is in development, may change in future versions.
+"""
+
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+import numpy as np
+
+from llama_index.llms import ChatMessage
+from llama_index.schema import MetadataMode, NodeWithScore, QueryBundle
+
+from async_engines import AsyncRerankChatEngine, apply_node_postprocessors_async
+from request_metrics import submit_with_context
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+def cosine_similarity(v1, v2):
+    v1, v2 = np.array(v1), np.array(v2)
+    norm = np.linalg.norm(v1) * np.linalg.norm(v2)
+
+    return float(np.dot(v1, v2) / norm) if norm > 0 else 0.0
+
+
+def build_context_str(nodes):
+    return "\n\n".join(
+        [n.node.get_content(metadata_mode=MetadataMode.LLM).strip() for n in nodes]
+    )
+
+
+class SpeculativeChatEngine(AsyncRerankChatEngine):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self._embed_model = None
+        self.similarity_threshold = 0.9
+
+        # condensed question -> speculative context or embedding to reuse
+        self._speculation = {}
+        self._executor = ThreadPoolExecutor(max_workers=2)
+
+        self._lock = threading.Lock()
+        self.n_speculations = 0
+        self.n_hits = 0
+        self.time_saved = 0.0
+
+    @classmethod
+    def from_defaults(
+        cls, *args, embed_model=None, similarity_threshold=0.9, **kwargs
+    ) -> "SpeculativeChatEngine":
+        """
+        embed_model: the llama-index embed model used by the retriever
+        similarity_threshold: min. cosine similarity between the raw message
+            and the condensed question to use the speculative retrieval
+        """
+        chat_engine = super().from_defaults(*args, **kwargs)
+
+        chat_engine._embed_model = embed_model
+        chat_engine.similarity_threshold = similarity_threshold
+
+        return chat_engine
+
+    def _record(self, hit, time_saved):
+        with self._lock:
+            self.n_speculations += 1
+
+            if hit:
+                self.n_hits += 1
+                self.time_saved += time_saved
+
+    def get_speculation_stats(self):
+        with self._lock:
+            return {
+                "n_speculations": self.n_speculations,
+                "n_hits": self.n_hits,
+                "hit_rate": (
+                    round(self.n_hits / self.n_speculations, 3)
+                    if self.n_speculations > 0
+                    else 0.0
+                ),
+                "time_saved": round(self.time_saved, 2),
+            }
+
+    def _should_speculate(self, chat_history):
+        # without history the message is not condensed: nothing to overlap
+        return (
+            self._embed_model is not None
+            and not self._skip_condense
+            and len(chat_history) > 0
+        )
+
+    def _speculative_retrieve(self, message):
+        # only embedding and vector search: the rerank needs the condensed question
+        tStart = time.time()
+
+        embedding = self._embed_model.get_query_embedding(message)
+        nodes = self._retriever.retrieve(QueryBundle(message, embedding=embedding))
+
+        return embedding, nodes, time.time() - tStart
+
+    async def _aspeculative_retrieve(self, message):
+        tStart = time.time()
+
+        embedding = await self._embed_model.aget_query_embedding(message)
+        nodes = await self._retriever.aretrieve(
+            QueryBundle(message, embedding=embedding)
+        )
+
+        return embedding, nodes, time.time() - tStart
+
+    def _resolve(self, condensed, condensed_embedding, speculative, condense_time):
+        """
+        Decides if the speculative retrieval can be used for the condensed question
+        """
+        embedding, nodes, retrieve_time = speculative
+
+        similarity = cosine_similarity(embedding, condensed_embedding)
+        hit = similarity >= self.similarity_threshold
+
+        # the retrieval overlapped with the condensation
+        self._record(hit, min(retrieve_time, condense_time))
+
+        logging.info(
+            f"Speculative retrieval: similarity {round(similarity, 3)}, hit: {hit}..."
+        )
+
+        if hit:
+            self._speculation[condensed] = ("nodes", nodes)
+        else:
+            self._speculation[condensed] = ("embedding", condensed_embedding)
+
+    def _condense_question(
+        self, chat_history: List[ChatMessage], latest_message: str
+    ) -> str:
+        if not self._should_speculate(chat_history):
+            return super()._condense_question(chat_history, latest_message)
+
+        future = submit_with_context(
+            self._executor, self._speculative_retrieve, latest_message
+        )
+
+        tStart = time.time()
+        condensed = super()._condense_question(chat_history, latest_message)
+        condense_time = time.time() - tStart
+
+        condensed_embedding = self._embed_model.get_query_embedding(condensed)
+
+        try:
+            speculative = future.result()
+        except Exception as e:
+            logging.error("Error in speculative retrieval...")
+            logging.error(e)
+
+            self._speculation[condensed] = ("embedding", condensed_embedding)
+            return condensed
+
+        self._resolve(condensed, condensed_embedding, speculative, condense_time)
+
+        return condensed
+
+    async def _acondense_question(
+        self, chat_history: List[ChatMessage], latest_message: str
+    ) -> str:
+        if not self._should_speculate(chat_history):
+            return await super()._acondense_question(chat_history, latest_message)
+
+        task = asyncio.create_task(self._aspeculative_retrieve(latest_message))
+
+        tStart = time.time()
+        condensed = await super()._acondense_question(chat_history, latest_message)
+        condense_time = time.time() - tStart
+
+        condensed_embedding = await self._embed_model.aget_query_embedding(condensed)
+
+        try:
+            speculative = await task
+        except Exception as e:
+            logging.error("Error in speculative retrieval...")
+            logging.error(e)
+
+            self._speculation[condensed] = ("embedding", condensed_embedding)
+            return condensed
+
+        self._resolve(condensed, condensed_embedding, speculative, condense_time)
+
+        return condensed
+
+    def _retrieve_context(self, message: str) -> Tuple[str, List[NodeWithScore]]:
+        """
+        message: the condensed question
+        """
+        entry = self._speculation.pop(message, None)
+
+        if entry is None:
+            return super()._retrieve_context(message)
+
+        kind, value = entry
+
+        if kind == "nodes":
+            nodes = value
+        else:
+            # miss: the embedding of the condensed question is reused
+            nodes = self._retriever.retrieve(QueryBundle(message, embedding=value))
+
+        # the rerank, in both cases against the condensed question
+        for postprocessor in self._node_postprocessors:
+            nodes = postprocessor.postprocess_nodes(
+                nodes, query_bundle=QueryBundle(message)
+            )
+
+        return build_context_str(nodes), nodes
+
+    async def _aretrieve_context(self, message: str) -> Tuple[str, List[NodeWithScore]]:
+        entry = self._speculation.pop(message, None)
+
+        if entry is None:
+            return await super()._aretrieve_context(message)
+
+        kind, value = entry
+
+        if kind == "nodes":
+            nodes = value
+        else:
+            nodes = await self._retriever.aretrieve(
+                QueryBundle(message, embedding=value)
+            )
+
+        nodes = await apply_node_postprocessors_async(
+            self._node_postprocessors, nodes, QueryBundle(message)
+        )
+
+        return build_context_str(nodes), nodes
@@ -0,0 +1,217 @@
+"""
+File name: summary_memory.py
+Author: Luigi Saetta
+Date created: 2024-03-13
+Date last modified: 2024-03-13
+Python Version: 3.9
+
+Description:
+    This module provides a chat memory that keeps the prompt size flat
+    in long conversations: the recent turns (up to recent_token_limit tokens)
+    are kept verbatim, the older ones are folded by the LLM in a running
+    summary, returned as first message of the history.
+    The summary is updated in background after each answer, so it doesn't
+    add latency to the conversation (the next turn uses the summary
+    available at that moment).
+
+    The summarized turns are removed from the memory.
+
+Usage:
+    Import this module into other scripts to use its functions.
+    Example:
+    memory = SummaryChatMemory.from_defaults(
+        llm=service_context.llm,
+        token_limit=MEMORY_TOKEN_LIMIT,
+        recent_token_limit=MEMORY_RECENT_TOKEN_LIMIT,
+        tokenizer_fn=cohere_tokenizer.encode,
+    )
+
+License:
+    This code is released under the MIT License.
+
+Notes:
+    This is a part of a set of demo showing how to use Oracle Vector DB,
+    OCI GenAI service, Oracle GenAI Embeddings, to build a RAG solution,
+    where all he data (text + embeddings) are stored in Oracle DB 23c
+
+Warnings:
+    This module is in development, may change in future versions.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional
+
+from llama_index.bridge.pydantic import Field, PrivateAttr
+from llama_index.llms import ChatMessage, MessageRole
+from llama_index.llms.generic_utils import messages_to_history_str
+from llama_index.memory import ChatMemoryBuffer
+from llama_index.prompts import PromptTemplate
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+SUMMARY_PROMPT = PromptTemplate(
+    "Progressively summarize the conversation between a user and an assistant, "
+    "adding the new lines to the current summary. "
+    "Keep the facts, names and questions useful to continue the conversation. "
+    "Return only the new summary.\n\n"
+    "Current summary:\n{summary}\n\n"
+    "New lines:\n{new_lines}\n\n"
+    "New summary:"
+)
+
+SUMMARY_PREFIX = "Summary of the previous conversation: "
+
+
+class SummaryChatMemory(ChatMemoryBuffer):
+    # the LLM used to summarize
+    llm: Any = Field(default=None, exclude=True)
+    # tokens of the recent turns kept verbatim
+    recent_token_limit: int = 1000
+    summary: str = ""
+    n_summaries: int = 0
+
+    _executor: Any = PrivateAttr()
+    _lock: Any = PrivateAttr()
+
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+
+        # one summarization at a time, in order
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.RLock()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "SummaryChatMemory"
+
+    @classmethod
+    def from_defaults(
+        cls,
+        llm: Any = None,
+        token_limit: int = 3000,
+        recent_token_limit: int = 1000,
+        tokenizer_fn: Optional[Callable[[str], List]] = None,
+        **kwargs: Any,
+    ) -> "SummaryChatMemory":
+        """
+        token_limit: max tokens of the history (summary + recent turns)
+        recent_token_limit: above this, the older turns are summarized
+        """
+        memory_kwargs = {"tokenizer_fn": tokenizer_fn} if tokenizer_fn else {}
+
+        return cls(
+            llm=llm,
+            token_limit=token_limit,
+            recent_token_limit=recent_token_limit,
+            **memory_kwargs,
+        )
+
+    def _count_tokens(self, text):
+        return len(self.tokenizer_fn(text))
+
+    def _num_to_fold(self, messages):
+        """
+        num. of the oldest messages to summarize, so that the remaining ones
+        are within recent_token_limit and start with a user message
+        """
+        tokens = 0
+        n_keep = 0
+
+        for message in reversed(messages):
+            tokens += self._count_tokens(str(message.content))
+
+            if tokens > self.recent_token_limit:
+                break
+
+            n_keep += 1
+
+        n_fold = len(messages) - n_keep
+
+        # the history can't start with an answer
+        while n_fold < len(messages) and messages[n_fold].role != MessageRole.USER:
+            n_fold += 1
+
+        return n_fold
+
+    def _summarize(self):
+        with self._lock:
+            messages = self.get_all()
+            n_fold = self._num_to_fold(messages)
+
+            if n_fold == 0:
+                return
+
+            to_fold = messages[:n_fold]
+            summary = self.summary
+
+        # outside the lock: the chat goes on during the LLM call
+        new_summary = self.llm.complete(
+            SUMMARY_PROMPT.format(
+                summary=summary, new_lines=messages_to_history_str(to_fold)
+            )
+        ).text.strip()
+
+        with self._lock:
+            current = self.get_all()
+
+            # the memory has been reset (or set) in the meantime
+            if current[:n_fold] != to_fold or self.summary != summary:
+                return
+
+            self.summary = new_summary
+            self.n_summaries += 1
+            self.chat_store.set_messages(self.chat_store_key, current[n_fold:])
+
+        logging.info(
+            f"Chat memory: {n_fold} messages summarized in "
+            f"{self._count_tokens(new_summary)} tokens..."
+        )
+
+    def _safe_summarize(self):
+        try:
+            self._summarize()
+        except Exception as e:
+            # the memory still works: the buffer drops the oldest turns
+            logging.error("Error summarizing the chat history...")
+            logging.error(e)
+
+    def get(self, initial_token_count: int = 0, **kwargs: Any) -> List[ChatMessage]:
+        with self._lock:
+            summary = self.summary
+
+            if len(summary) == 0:
+                return super().get(initial_token_count=initial_token_count, **kwargs)
+
+            summary_message = ChatMessage(
+                role=MessageRole.SYSTEM, content=SUMMARY_PREFIX + summary
+            )
+            summary_tokens = self._count_tokens(summary_message.content)
+
+            if initial_token_count + summary_tokens > self.token_limit:
+                # no space for the summary
+                return super().get(initial_token_count=initial_token_count, **kwargs)
+
+            return [summary_message] + super().get(
+                initial_token_count=initial_token_count + summary_tokens, **kwargs
+            )
+
+    def put(self, message: ChatMessage) -> None:
+        with self._lock:
+            super().put(message)
+
+        # after an answer the turn is complete
+        if message.role == MessageRole.ASSISTANT and self.llm is not None:
+            self._executor.submit(self._safe_summarize)
+
+    def set(self, messages: List[ChatMessage]) -> None:
+        with self._lock:
+            super().set(messages)
+
+    def reset(self) -> None:
+        with self._lock:
+            super().reset()
+            self.summary = ""
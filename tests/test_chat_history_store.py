@@ -0,0 +1,114 @@
+"""
+Chat history store: the answers are saved without the references,
+the sources come back in additional_kwargs (DB replaced by a list)
+"""
+
+import io
+
+import pytest
+
+oracledb = pytest.importorskip("oracledb")
+pytest.importorskip("config_private")
+
+from llama_index.llms import ChatMessage, MessageRole
+
+import chat_history_store
+from chat_history_store import SOURCES_KEY, OracleChatHistoryStore
+
+
+class FakeCursor:
+    def __init__(self, table):
+        self.table = table
+        self.result = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def setinputsizes(self, *args):
+        pass
+
+    def executemany(self, sql, rows):
+        self.table.extend(rows)
+
+    def execute(self, sql, params):
+        session_id, n_rows = params
+        rows = [row for row in self.table if row[0] == session_id]
+
+        # order by ID desc, the CLOBs are read
+        self.result = [
+            (role, io.StringIO(content), io.StringIO(sources) if sources else None)
+            for _, role, content, sources in reversed(rows)
+        ][:n_rows]
+
+    def fetchall(self):
+        return self.result
+
+
+class FakePool:
+    def __init__(self):
+        self.table = []
+
+    def acquire(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def cursor(self):
+        return FakeCursor(self.table)
+
+    def commit(self):
+        pass
+
+
+def test_sources_round_trip(monkeypatch):
+    pool = FakePool()
+    monkeypatch.setattr(chat_history_store, "get_db_pool", lambda: pool)
+
+    store = OracleChatHistoryStore()
+    sources = [{"file_name": "book.pdf", "page_label": "3"}]
+
+    store.append(
+        "session",
+        [
+            ChatMessage(role=MessageRole.USER, content="question"),
+            ChatMessage(
+                role=MessageRole.ASSISTANT,
+                content="answer",
+                additional_kwargs={SOURCES_KEY: sources},
+            ),
+        ],
+    )
+    store.append("other", [ChatMessage(role=MessageRole.USER, content="other")])
+
+    messages = store.load("session")
+
+    assert [m.content for m in messages] == ["question", "answer"]
+    assert messages[0].additional_kwargs == {}
+    assert messages[1].additional_kwargs[SOURCES_KEY] == sources
+
+
+def test_last_turns(monkeypatch):
+    pool = FakePool()
+    monkeypatch.setattr(chat_history_store, "get_db_pool", lambda: pool)
+
+    store = OracleChatHistoryStore()
+    store.append(
+        "session",
+        [
+            ChatMessage(role=MessageRole.USER, content="q1"),
+            ChatMessage(role=MessageRole.ASSISTANT, content="a1"),
+            ChatMessage(role=MessageRole.USER, content="q2"),
+            ChatMessage(role=MessageRole.ASSISTANT, content="a2"),
+        ],
+    )
+
+    messages = store.load("session", last_n_turns=1)
+
+    assert [m.content for m in messages] == ["q2", "a2"]
@@ -0,0 +1,110 @@
+"""
+The registry builds each component once per process,
+also when engines are created at the same time
+"""
+
+import time
+import asyncio
+import threading
+
+from component_registry import ComponentRegistry
+
+
+def test_factory_called_once():
+    registry = ComponentRegistry()
+    calls = []
+
+    def factory():
+        calls.append(1)
+        return object()
+
+    first = registry.get("llm", factory, key="model-a")
+
+    assert registry.get("llm", factory, key="model-a") is first
+    assert len(calls) == 1
+
+
+def test_keys_are_separate_components():
+    registry = ComponentRegistry()
+
+    query = registry.get("warm_up", lambda: "query", key="query")
+    chat = registry.get("warm_up", lambda: "chat", key="chat")
+
+    assert (query, chat) == ("query", "chat")
+    assert registry.get("warm_up", lambda: "other", key="chat") == "chat"
+
+
+def test_none_is_cached():
+    registry = ComponentRegistry()
+    calls = []
+
+    def factory():
+        calls.append(1)
+
+    registry.get("process_setup", factory)
+    registry.get("process_setup", factory)
+
+    assert len(calls) == 1
+
+
+def test_concurrent_get_builds_once():
+    registry = ComponentRegistry()
+    calls = []
+    results = []
+
+    def factory():
+        calls.append(1)
+        # slow, so that the other threads wait for it
+        time.sleep(0.1)
+        return object()
+
+    def worker():
+        results.append(registry.get("embed_model", factory))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+
+
+def test_refresh():
+    registry = ComponentRegistry()
+
+    llm = registry.get("llm", object)
+    reranker = registry.get("reranker", object)
+
+    registry.refresh("llm")
+
+    assert registry.names() == ["reranker"]
+    assert registry.get("llm", object) is not llm
+    assert registry.get("reranker", object) is reranker
+
+    registry.refresh()
+
+    assert registry.names() == []
+
+
+def test_aclose_closes_the_components():
+    registry = ComponentRegistry()
+    closed = []
+
+    class Client:
+        async def aclose(self):
+            closed.append(self)
+
+    class Broken:
+        async def aclose(self):
+            raise RuntimeError("already closed")
+
+    client = registry.get("cross_encoder", Client)
+    registry.get("broken", Broken)
+    registry.get("tokenizer", object)
+
+    # an error doesn't stop the others
+    asyncio.run(registry.aclose())
+
+    assert closed == [client]
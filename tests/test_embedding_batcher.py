@@ -0,0 +1,91 @@
+"""
+Micro-batching of the question embeddings: concurrent questions are merged,
+and every question gets its vector or an error
+"""
+
+import time
+import threading
+
+import pytest
+
+pytest.importorskip("langchain_core")
+
+from embedding_batcher import BatchingEmbeddings
+
+
+class SlowEmbeddings:
+    def __init__(self, delay=0.1):
+        self.delay = delay
+        self.batches = []
+
+    def embed_documents(self, texts):
+        self.batches.append(list(texts))
+        time.sleep(self.delay)
+
+        return [[float(len(text))] for text in texts]
+
+
+class ShortEmbeddings:
+    # returns one vector less than requested
+    def embed_documents(self, texts):
+        return [[1.0] for _ in texts[1:]]
+
+
+def run_concurrently(function, args):
+    results = [None] * len(args)
+
+    def worker(i):
+        try:
+            results[i] = function(args[i])
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(args))]
+    for thread in threads:
+        thread.start()
+        # the questions arrive one after the other
+        time.sleep(0.005)
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+def test_vectors_go_to_their_questions():
+    batcher = BatchingEmbeddings(SlowEmbeddings(delay=0.01), max_wait=0.05)
+    texts = ["a", "bb", "ccc", "dddd"]
+
+    assert run_concurrently(batcher.embed_query, texts) == [[1.0], [2.0], [3.0], [4.0]]
+
+
+def test_questions_merged_while_calls_busy():
+    model = SlowEmbeddings(delay=0.2)
+    batcher = BatchingEmbeddings(model, max_wait=0.001, max_calls=1)
+
+    run_concurrently(batcher.embed_query, [str(i) for i in range(10)])
+
+    # the questions arrived while the first call was in progress:
+    # they are embedded together, not in 1-2 texts batches
+    assert len(model.batches) <= 3
+    assert sum(len(batch) for batch in model.batches) == 10
+
+
+def test_short_response_resolves_every_question():
+    batcher = BatchingEmbeddings(ShortEmbeddings(), max_wait=0.05, timeout=5)
+
+    results = run_concurrently(batcher.embed_query, ["a", "b", "c"])
+
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_batcher_continues_after_errors():
+    model = SlowEmbeddings(delay=0.01)
+    batcher = BatchingEmbeddings(ShortEmbeddings(), max_calls=1, timeout=5)
+
+    with pytest.raises(ValueError):
+        batcher.embed_query("a")
+
+    # the slot of the failed call has been released
+    batcher.embed_model = model
+
+    assert batcher.embed_query("abc") == [3.0]
@@ -0,0 +1,78 @@
+"""
+Embedding cache: LRU, persistent tier and metrics of the calls to the model
+(only the misses call the model)
+"""
+
+import pytest
+
+pytest.importorskip("langchain_core")
+pytest.importorskip("prometheus_client")
+
+from embedding_cache import CachedEmbeddings
+from pipeline_metrics import EMBEDDING_CALLS, EMBEDDING_TEXTS
+
+
+class FakeEmbeddings:
+    def __init__(self):
+        self.texts = []
+
+    def embed_query(self, text):
+        self.texts.append(text)
+        return [float(len(text))]
+
+    def embed_documents(self, texts):
+        self.texts.extend(texts)
+        return [[float(len(text))] for text in texts]
+
+
+def remote_calls():
+    return (
+        EMBEDDING_CALLS.labels(stage="query")._value.get(),
+        EMBEDDING_TEXTS.labels(stage="query")._value.get(),
+    )
+
+
+def test_only_misses_call_the_model():
+    model = FakeEmbeddings()
+    cache = CachedEmbeddings(model, model_name="test")
+    calls, texts = remote_calls()
+
+    # the same text, normalized
+    assert cache.embed_query("a question") == cache.embed_query(" a  question ")
+    cache.embed_documents(["a question", "b", "c"])
+
+    assert model.texts == ["a question", "b", "c"]
+    assert remote_calls() == (calls + 2, texts + 3)
+    assert cache.get_stats()["misses"] == 3
+
+
+def test_lru_eviction():
+    model = FakeEmbeddings()
+    cache = CachedEmbeddings(model, model_name="test", max_size=2)
+
+    for text in ["a", "b", "a", "c", "a", "b"]:
+        cache.embed_query(text)
+
+    # b was the least recently used when c was added
+    assert model.texts == ["a", "b", "c", "b"]
+
+
+def test_persistent_tier(tmp_path):
+    path = str(tmp_path / "embeddings.db")
+
+    CachedEmbeddings(
+        FakeEmbeddings(), model_name="test", persist_path=path
+    ).embed_query("a question")
+
+    # a new process: empty memory, vectors in the file
+    model = FakeEmbeddings()
+    cache = CachedEmbeddings(model, model_name="test", persist_path=path)
+
+    assert cache.embed_query("a question") == [10.0]
+    assert model.texts == []
+
+    # another model doesn't use these vectors
+    other = CachedEmbeddings(model, model_name="other", persist_path=path)
+    other.embed_query("a question")
+
+    assert model.texts == ["a question"]
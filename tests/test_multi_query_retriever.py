@@ -0,0 +1,115 @@
+"""
+Parsing of the sub-queries, Reciprocal Rank Fusion of the results
+and the async retrieval (vector searches through aquery)
+"""
+
+import types
+import asyncio
+
+import pytest
+
+from llama_index.callbacks import CallbackManager
+from llama_index.schema import NodeWithScore, QueryBundle, TextNode
+from llama_index.vector_stores.types import VectorStoreQueryResult
+
+import async_limits
+from multi_query_retriever import (
+    MultiQueryRetriever,
+    parse_queries,
+    reciprocal_rank_fusion,
+)
+
+
+def ranked(*ids):
+    # the scores are distances: RRF uses only the ranks
+    return [
+        NodeWithScore(node=TextNode(id_=node_id, text=node_id), score=rank)
+        for rank, node_id in enumerate(ids)
+    ]
+
+
+def test_parse_queries():
+    text = "1. first query\n2) second query\n\n- first query\n* third query\nfourth"
+
+    assert parse_queries(text, 3) == ["first query", "second query", "third query"]
+
+
+def test_parse_queries_empty():
+    assert parse_queries("\n  \n", 3) == []
+
+
+def test_rrf_scores():
+    fused = reciprocal_rank_fusion([ranked("a", "b"), ranked("b", "c")], k=60)
+
+    scores = {n.node.node_id: n.score for n in fused}
+
+    assert scores["b"] == pytest.approx(1 / 62 + 1 / 61)
+    assert scores["a"] == pytest.approx(1 / 61)
+    assert scores["c"] == pytest.approx(1 / 62)
+    # in more lists wins over first in one list
+    assert [n.node.node_id for n in fused] == ["b", "a", "c"]
+
+
+def test_rrf_top_k():
+    fused = reciprocal_rank_fusion(
+        [ranked("a", "b", "c"), ranked("b", "a"), ranked("b")], top_k=2
+    )
+
+    assert [n.node.node_id for n in fused] == ["b", "a"]
+
+
+def test_rrf_no_duplicates():
+    fused = reciprocal_rank_fusion([ranked("a", "b"), ranked("a", "b"), []])
+
+    assert [n.node.node_id for n in fused] == ["a", "b"]
+
+
+def test_rrf_empty():
+    assert reciprocal_rank_fusion([[], []]) == []
+
+
+class FakeVectorStore:
+    def __init__(self):
+        self.n_async_queries = 0
+
+    def query(self, query):
+        raise AssertionError("the async path must use aquery")
+
+    async def aquery(self, query):
+        self.n_async_queries += 1
+        node_id = str(query.query_embedding[0])
+
+        return VectorStoreQueryResult(
+            nodes=[TextNode(id_=node_id, text=node_id)], similarities=[0.0]
+        )
+
+
+class SyncOnlyLLM:
+    def predict(self, prompt, **kwargs):
+        return "first query\nsecond query"
+
+
+class FakeEmbeddings:
+    async def aget_query_embedding(self, query):
+        return [0.0]
+
+    async def aget_text_embedding_batch(self, texts):
+        return [[float(i + 1)] for i in range(len(texts))]
+
+
+def test_aretrieve_uses_aquery(monkeypatch):
+    monkeypatch.setattr(async_limits, "SYNC_ONLY_LLMS", (SyncOnlyLLM,))
+
+    vector_store = FakeVectorStore()
+    service_context = types.SimpleNamespace(
+        llm=SyncOnlyLLM(),
+        embed_model=FakeEmbeddings(),
+        callback_manager=CallbackManager([]),
+    )
+    retriever = MultiQueryRetriever(vector_store, service_context, num_queries=2)
+
+    nodes = asyncio.run(retriever._aretrieve(QueryBundle("question")))
+
+    # the question and the two sub-queries
+    assert vector_store.n_async_queries == 3
+    assert sorted(n.node.node_id for n in nodes) == ["0.0", "1.0", "2.0"]
@@ -0,0 +1,162 @@
+"""
+Payload formats and merge of the micro-batches of OCIBAAIReranker
+(no call to the deployment)
+"""
+
+import json
+import asyncio
+
+import pytest
+
+pytest.importorskip("cloudpickle")
+pytest.importorskip("aiohttp")
+pytest.importorskip("prometheus_client")
+
+from oci_baai_reranker import (
+    COMPACT_FORMAT_TAG,
+    OCIBAAIReranker,
+    decode_compact_payload,
+)
+
+QUERY = "what is panda?"
+TEXTS = ["The giant panda is a bear.", "It is an animal living in China", "hi"]
+
+
+def create_reranker(payload_format="json", batch_size=None):
+    return OCIBAAIReranker(
+        auth={"signer": None},
+        deployment_id="ocid1.datasciencemodeldeployment.test",
+        payload_format=payload_format,
+        batch_size=batch_size,
+    )
+
+
+@pytest.mark.parametrize("payload_format", ["json", "json_gzip"])
+def test_compact_payload_round_trip(payload_format):
+    body = create_reranker(payload_format).build_request_body(QUERY, TEXTS)
+
+    # the body must be serializable as it is sent
+    body = json.loads(json.dumps(body))
+
+    assert decode_compact_payload(body["data"]) == [[QUERY, t] for t in TEXTS]
+
+
+def test_compact_payload_sends_query_once():
+    body = create_reranker("json").build_request_body(QUERY, TEXTS)
+
+    msg = body["data"][0]
+
+    assert msg["format"] == COMPACT_FORMAT_TAG
+    assert msg["query"] == QUERY
+    assert msg["texts"] == TEXTS
+
+
+def test_gzip_payload_is_tagged():
+    body = create_reranker("json_gzip").build_request_body(QUERY, TEXTS)
+
+    assert body["data"][0]["format"] == COMPACT_FORMAT_TAG + "+gzip"
+    assert "payload" in body["data"][0]
+
+
+def test_cloudpickle_payload():
+    body = create_reranker("cloudpickle").build_request_body(QUERY, TEXTS)
+
+    assert body["data_type"] == "numpy.ndarray"
+    assert isinstance(body["data"], str)
+
+
+def test_unknown_payload_format():
+    with pytest.raises(ValueError):
+        create_reranker("xml")
+
+
+def test_merge_batches():
+    reranker = create_reranker(batch_size=2)
+    texts = ["a", "b", "c", "d", "e"]
+    responses = [
+        {"prediction": [0.1, 0.9]},
+        {"prediction": [0.5, 0.2]},
+        # a single text: the model returns a float
+        {"prediction": 0.7},
+    ]
+
+    results = reranker._merge_batches(texts, [0, 2, 4], responses, top_n=3)
+
+    assert [r["text"] for r in results] == ["b", "e", "c"]
+    assert [r["index"] for r in results] == [1, 4, 2]
+    assert not any(r.get("fallback", False) for r in results)
+
+
+def test_merge_batches_failed_batch_uses_fallback():
+    reranker = create_reranker(batch_size=2)
+    texts = ["a", "b", "c", "d"]
+    # second micro-batch failed
+    responses = [{"prediction": [0.1, 0.9]}, []]
+
+    results = reranker._merge_batches(
+        texts, [0, 2], responses, top_n=4, fallback_scores=[0.0, 0.0, 0.8, 0.3]
+    )
+
+    # the texts scored by the reranker come first
+    assert [r["text"] for r in results] == ["b", "a", "c", "d"]
+    assert [r.get("fallback", False) for r in results] == [False, False, True, True]
+
+
+def test_merge_batches_fallback_keeps_vector_order():
+    reranker = create_reranker(batch_size=2)
+    texts = ["a", "b", "c", "d"]
+    responses = [{"prediction": [0.1, 0.9]}, {"prediction": [0.5]}]
+
+    # wrong num. of predictions: the batch is treated as failed
+    results = reranker._merge_batches(texts, [0, 2], responses, top_n=4)
+
+    assert [r["text"] for r in results][2:] == ["c", "d"]
+
+
+def test_merge_batches_all_failed():
+    reranker = create_reranker(batch_size=2)
+
+    assert reranker._merge_batches(["a", "b", "c"], [0, 2], [[], []], top_n=2) == []
+
+
+def test_hedge_delay_before_enough_latencies():
+    reranker = OCIBAAIReranker(
+        auth={"signer": None},
+        deployment_id="ocid1.datasciencemodeldeployment.test",
+        hedge=True,
+        default_hedge_delay=0.8,
+    )
+
+    # no timeout: the default, otherwise the first calls are never hedged
+    assert reranker._get_hedge_delay() == 0.8
+
+    reranker.timeout = 4
+    assert reranker._get_hedge_delay() == 2
+
+    for i in range(20):
+        reranker.latency_tracker.add(i / 10)
+
+    assert reranker._get_hedge_delay() == reranker.latency_tracker.percentile(95)
+
+
+def test_aclose_closes_the_sessions():
+    reranker = create_reranker()
+
+    async def run():
+        session = await reranker._get_async_session()
+
+        # one session for the loop
+        assert await reranker._get_async_session() is session
+
+        await reranker.aclose()
+
+        assert session.closed
+        assert reranker._async_sessions == {}
+
+        # a new one if called again
+        new_session = await reranker._get_async_session()
+        await reranker.aclose()
+
+        return new_session is not session
+
+    assert asyncio.run(run())
@@ -0,0 +1,83 @@
+"""
+OCILLamaReranker: the vector similarities reach the cross-encoder
+as fallback scores for the failed micro-batches
+"""
+
+import asyncio
+
+import pytest
+
+pytest.importorskip("cloudpickle")
+pytest.importorskip("aiohttp")
+pytest.importorskip("prometheus_client")
+
+from llama_index.schema import NodeWithScore, QueryBundle, TextNode
+
+from oci_llama_reranker import OCILLamaReranker
+from rerank_cache import RerankScoreCache
+
+
+class FakeCrossEncoder:
+    """
+    scores the texts by length, records the fallback scores received
+    """
+
+    def __init__(self):
+        self.fallback_scores = []
+
+    def rerank(self, query, texts, top_n=2, fallback_scores=None):
+        self.fallback_scores.append(fallback_scores)
+
+        data = [
+            {"text": text, "index": i, "relevance_score": float(len(text))}
+            for i, text in enumerate(texts)
+        ]
+
+        return sorted(data, key=lambda x: x["relevance_score"], reverse=True)[:top_n]
+
+
+def to_nodes(scores):
+    return [
+        NodeWithScore(node=TextNode(id_=str(i), text="x" * (i + 1)), score=score)
+        for i, score in enumerate(scores)
+    ]
+
+
+def test_distances_become_similarities():
+    cross_encoder = FakeCrossEncoder()
+    reranker = OCILLamaReranker(oci_reranker=cross_encoder, top_n=2)
+
+    nodes = reranker.postprocess_nodes(
+        to_nodes([-0.9, -0.8, None]), QueryBundle("a question")
+    )
+
+    assert [node.node.node_id for node in nodes] == ["2", "1"]
+    assert cross_encoder.fallback_scores == [[0.9, 0.8, -0.0]]
+
+
+def test_rrf_scores_passed_as_they_are():
+    cross_encoder = FakeCrossEncoder()
+    reranker = OCILLamaReranker(
+        oci_reranker=cross_encoder, top_n=2, scores_are_distances=False
+    )
+
+    # no async client: rerank is called in a thread
+    asyncio.run(
+        reranker.apostprocess_nodes(to_nodes([0.05, 0.03]), QueryBundle("a question"))
+    )
+
+    assert cross_encoder.fallback_scores == [[0.05, 0.03]]
+
+
+def test_only_missing_fallback_scores_with_cache():
+    cross_encoder = FakeCrossEncoder()
+    cache = RerankScoreCache()
+    reranker = OCILLamaReranker(oci_reranker=cross_encoder, top_n=2, score_cache=cache)
+    nodes = to_nodes([-0.9, -0.8, -0.7])
+
+    cache.put(cache.make_key("a question", "xx"), 5.0)
+
+    reranker.postprocess_nodes(nodes, QueryBundle("a question"))
+
+    # the second text has a cached score, it's not sent
+    assert cross_encoder.fallback_scores == [[0.9, 0.7]]
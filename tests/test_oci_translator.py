@@ -0,0 +1,58 @@
+"""
+Split of the long texts in the pieces sent to the translation service
+"""
+
+import pytest
+
+pytest.importorskip("oci")
+pytest.importorskip("config_private")
+
+from oci_translator import join_pieces, split_text
+
+TEXT = "first line\nsecond line with some words\nthird"
+
+
+def test_short_text_is_not_split():
+    pieces, separators = split_text(TEXT, max_chars=100)
+
+    assert pieces == [TEXT]
+    assert separators == []
+    assert join_pieces(pieces, separators) == TEXT
+
+
+def test_split_at_new_lines():
+    pieces, separators = split_text(TEXT, max_chars=30)
+
+    assert pieces == ["first line", "second line with some words", "third"]
+    assert separators == ["\n", "\n"]
+    assert join_pieces(pieces, separators) == TEXT
+
+
+def test_split_at_spaces():
+    text = "one two three four five"
+
+    pieces, separators = split_text(text, max_chars=10)
+
+    assert all(len(piece) <= 10 for piece in pieces)
+    assert set(separators) == {" "}
+    assert join_pieces(pieces, separators) == text
+
+
+def test_hard_cut():
+    text = "x" * 25
+
+    pieces, separators = split_text(text, max_chars=10)
+
+    assert pieces == ["x" * 10, "x" * 10, "x" * 5]
+    assert separators == ["", ""]
+    assert join_pieces(pieces, separators) == text
+
+
+@pytest.mark.parametrize("max_chars", [5, 7, 12, 40])
+def test_round_trip(max_chars):
+    text = "Oracle DB 23c\nstores the text and the embeddings.\n\nA new paragraph " * 3
+
+    pieces, separators = split_text(text, max_chars=max_chars)
+
+    assert all(len(piece) <= max_chars for piece in pieces)
+    assert join_pieces(pieces, separators) == text
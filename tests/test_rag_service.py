@@ -0,0 +1,73 @@
+"""
+Concurrency of the RAG service: requests must not wait for each other
+while the LLM (sync only, as LangChainLLM) is generating
+"""
+
+import time
+import asyncio
+
+import pytest
+
+pytest.importorskip("fastapi")
+httpx = pytest.importorskip("httpx")
+# rag_service builds the chain: the secrets must be there
+pytest.importorskip("config_private")
+
+from llama_index.llms import CompletionResponse, CustomLLM, LLMMetadata
+from llama_index.llms.base import llm_completion_callback
+from llama_index.response.schema import Response
+
+import async_limits
+import rag_service
+
+LLM_DELAY = 0.5
+
+
+class SlowSyncLLM(CustomLLM):
+    @property
+    def metadata(self):
+        return LLMMetadata()
+
+    @llm_completion_callback()
+    def complete(self, prompt, formatted=False, **kwargs):
+        time.sleep(LLM_DELAY)
+        return CompletionResponse(text="answer")
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt, formatted=False, **kwargs):
+        raise NotImplementedError
+
+
+class FakeEngine:
+    def __init__(self, llm):
+        self.llm = llm
+
+    async def aquery(self, question):
+        completion = await self.llm.acomplete(question)
+
+        return Response(response=completion.text, source_nodes=[])
+
+
+def test_overlapping_requests(monkeypatch):
+    monkeypatch.setattr(async_limits, "SYNC_ONLY_LLMS", (SlowSyncLLM,))
+    monkeypatch.setitem(
+        rag_service.state,
+        "query_engine",
+        FakeEngine(async_limits.LimitedLLM(SlowSyncLLM())),
+    )
+
+    async def run():
+        transport = httpx.ASGITransport(app=rag_service.app)
+
+        async with httpx.AsyncClient(transport=transport, base_url="http://t") as c:
+            return await asyncio.gather(
+                *[c.post("/query", json={"question": f"q{i}"}) for i in range(2)]
+            )
+
+    tStart = time.time()
+    responses = asyncio.run(run())
+    tEla = time.time() - tStart
+
+    assert [r.status_code for r in responses] == [200, 200]
+    # served together, not one after the other
+    assert tEla < 2 * LLM_DELAY
@@ -0,0 +1,92 @@
+"""
+Rerank bypass: normalized entropy of the scores and the decision to skip
+"""
+
+import math
+
+import pytest
+
+from llama_index.schema import NodeWithScore, TextNode
+
+from rerank_bypass import RerankBypassPolicy, normalized_entropy
+
+
+def to_nodes(scores):
+    return [
+        NodeWithScore(node=TextNode(id_=str(i), text=f"chunk {i}"), score=score)
+        for i, score in enumerate(scores)
+    ]
+
+
+def test_entropy_bounds():
+    assert normalized_entropy([0.5], temperature=0.05) == 0.0
+    assert normalized_entropy([0.5, 0.5, 0.5], temperature=0.05) == pytest.approx(1.0)
+    # one candidate far ahead: almost all the mass on it
+    assert normalized_entropy([0.9, 0.1, 0.1], temperature=0.05) < 0.01
+
+
+def test_entropy_temperature():
+    sims = [0.8, 0.7, 0.6]
+
+    # a higher temperature flattens the distribution
+    assert normalized_entropy(sims, temperature=0.01) < normalized_entropy(
+        sims, temperature=1.0
+    )
+    assert not math.isnan(normalized_entropy([100.0, -100.0], temperature=0.01))
+
+
+def test_few_candidates():
+    policy = RerankBypassPolicy()
+
+    assert policy.should_bypass(to_nodes([-0.5, -0.4]), top_n=3) == "few_candidates"
+
+
+def test_margin_on_distances():
+    policy = RerankBypassPolicy(margin=0.1)
+
+    # DOT distances: the similarity is -score
+    assert policy.should_bypass(to_nodes([-0.9, -0.7, -0.65]), top_n=1) == "margin"
+    assert policy.should_bypass(to_nodes([-0.9, -0.85, -0.6]), top_n=1) is None
+
+
+def test_margin_on_similarities():
+    policy = RerankBypassPolicy(margin=0.1, scores_are_distances=False)
+
+    assert policy.should_bypass(to_nodes([0.9, 0.7, 0.65]), top_n=1) == "margin"
+    # as distances the best would be 0.65, close to 0.7
+    assert (
+        RerankBypassPolicy(margin=0.1).should_bypass(
+            to_nodes([0.9, 0.7, 0.65]), top_n=1
+        )
+        is None
+    )
+
+
+def test_entropy_bypass():
+    policy = RerankBypassPolicy(max_entropy=0.2, temperature=0.05)
+
+    assert policy.should_bypass(to_nodes([-0.9, -0.5, -0.5, -0.4]), top_n=2) == (
+        "entropy"
+    )
+    assert policy.should_bypass(to_nodes([-0.6, -0.59, -0.58, -0.57]), top_n=2) is None
+
+
+def test_disabled_by_default():
+    policy = RerankBypassPolicy()
+
+    assert policy.should_bypass(to_nodes([-0.9, -0.1, -0.1]), top_n=1) is None
+
+
+def test_stats():
+    policy = RerankBypassPolicy()
+
+    policy.record_rerank(1.0)
+    policy.record_bypass("margin")
+    policy.record_bypass("margin")
+
+    stats = policy.get_stats()
+
+    assert stats["n_reranked"] == 1
+    assert stats["bypass_rate"] == pytest.approx(2 / 3)
+    assert stats["bypassed_by_reason"] == {"margin": 2}
+    assert stats["saved_time"] == pytest.approx(2.0)
@@ -0,0 +1,123 @@
+"""
+Rerank score cache: LRU eviction, TTL and persistence
+"""
+
+import os
+import json
+import time
+import threading
+
+import pytest
+
+pytest.importorskip("prometheus_client")
+
+from rerank_cache import RerankScoreCache
+
+
+def test_get_and_put():
+    cache = RerankScoreCache(namespace="model")
+    key = cache.make_key("a question", "a chunk")
+
+    assert key.startswith("model:")
+    assert cache.get(key) is None
+
+    cache.put(key, 0.7)
+
+    assert cache.get(key) == 0.7
+    assert cache.hit_rate == 0.5
+
+
+def test_lru_eviction():
+    cache = RerankScoreCache(max_size=2)
+
+    cache.put("a", 1)
+    cache.put("b", 2)
+    # a is now the most recently used
+    cache.get("a")
+    cache.put("c", 3)
+
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_ttl_expiry():
+    cache = RerankScoreCache(ttl=0.05)
+    cache.put("a", 1)
+
+    assert cache.get("a") == 1
+
+    time.sleep(0.1)
+
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_save_load_round_trip(tmp_path):
+    path = str(tmp_path / "scores.json")
+
+    cache = RerankScoreCache(persist_path=path)
+    for i in range(5):
+        cache.put(f"k{i}", i / 10)
+    cache.save()
+
+    # a smaller cache keeps the most recently used
+    loaded = RerankScoreCache(max_size=3, persist_path=path)
+
+    assert len(loaded) == 3
+    assert loaded.get("k1") is None
+    assert [loaded.get(f"k{i}") for i in range(2, 5)] == [0.2, 0.3, 0.4]
+    # no temp file left
+    assert os.listdir(tmp_path) == ["scores.json"]
+
+
+def test_load_skips_expired(tmp_path):
+    path = str(tmp_path / "scores.json")
+
+    with open(path, "w") as f:
+        json.dump([["old", 0.1, time.time() - 100], ["new", 0.2, time.time()]], f)
+
+    cache = RerankScoreCache(ttl=10, persist_path=path)
+
+    assert cache.get("old") is None
+    assert cache.get("new") == 0.2
+
+
+def test_concurrent_saves(tmp_path):
+    path = str(tmp_path / "scores.json")
+    cache = RerankScoreCache(persist_path=path)
+
+    def worker(n):
+        for i in range(20):
+            cache.put(f"{n}:{i}", i)
+            cache.save()
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with open(path) as f:
+        assert len(json.load(f)) == 80
+
+    assert os.listdir(tmp_path) == ["scores.json"]
+
+
+def test_scheduled_save_is_debounced(tmp_path):
+    path = str(tmp_path / "scores.json")
+    cache = RerankScoreCache(persist_path=path, save_delay=0.1)
+
+    cache.put("a", 1)
+    cache.schedule_save()
+    cache.put("b", 2)
+    # already pending: saved with the first one
+    cache.schedule_save()
+
+    assert not os.path.exists(path)
+
+    time.sleep(0.3)
+
+    with open(path) as f:
+        assert [entry[0] for entry in json.load(f)] == ["a", "b"]
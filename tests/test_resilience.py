@@ -0,0 +1,97 @@
+"""
+States of the circuit breaker and percentiles of the latency tracker
+"""
+
+import time
+
+from resilience import CircuitBreaker, LatencyTracker
+
+
+def open_breaker(breaker):
+    for _ in range(breaker.failure_threshold):
+        assert breaker.allow_request()
+        breaker.record_failure()
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    assert not breaker.allow_request()
+    assert breaker.get_stats()["n_short_circuited"] == 1
+    assert breaker.get_stats()["n_opened"] == 1
+
+
+def test_success_resets_the_failures():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.get_stats()["consecutive_failures"] == 1
+
+
+def test_half_open_lets_one_trial_through():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    open_breaker(breaker)
+
+    time.sleep(0.1)
+
+    assert breaker.allow_request()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # the trial is in flight
+    assert not breaker.allow_request()
+
+    breaker.record_success()
+
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow_request()
+
+
+def test_failed_trial_opens_again():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    open_breaker(breaker)
+
+    time.sleep(0.1)
+
+    assert breaker.allow_request()
+    breaker.record_failure()
+
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow_request()
+    assert breaker.get_stats()["n_opened"] == 2
+
+
+def test_latency_percentiles():
+    tracker = LatencyTracker(window=101)
+
+    assert tracker.percentile(95) is None
+
+    # added out of order
+    for i in reversed(range(101)):
+        tracker.add(float(i))
+
+    assert len(tracker) == 101
+    assert tracker.percentile(0) == 0.0
+    assert tracker.percentile(50) == 50.0
+    assert tracker.percentile(95) == 95.0
+    assert tracker.percentile(100) == 100.0
+
+
+def test_latency_window():
+    tracker = LatencyTracker(window=3)
+
+    for elapsed in [10.0, 1.0, 2.0, 3.0]:
+        tracker.add(elapsed)
+
+    # the oldest latency is out of the window
+    assert len(tracker) == 3
+    assert tracker.percentile(100) == 3.0
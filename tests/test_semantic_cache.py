@@ -0,0 +1,96 @@
+"""
+Semantic cache: variant and key of the entries, fingerprint of the chunks,
+answers saved out of the request path
+"""
+
+import time
+import threading
+
+import pytest
+
+pytest.importorskip("oracledb")
+pytest.importorskip("config_private")
+
+from llama_index.response.schema import StreamingResponse
+from llama_index.schema import QueryBundle
+
+from config import WORD_TO_TRIGGER_TRANS
+from semantic_cache import (
+    SemanticAnswerCache,
+    SemanticCacheQueryEngine,
+    answer_variant,
+    chunks_fingerprint,
+    normalize_question,
+)
+
+
+def test_normalize_question():
+    assert normalize_question("  What is\ta  VECTOR?\n") == "what is a vector?"
+
+
+def test_answer_variant():
+    assert answer_variant("what is a vector?") == "default"
+
+    question = f"what is a vector? {WORD_TO_TRIGGER_TRANS.upper()}"
+
+    assert answer_variant(question) == f"trans:{WORD_TO_TRIGGER_TRANS.lower()}"
+
+
+def test_chunks_fingerprint():
+    chunks = [("a", "first chunk"), ("b", "second chunk")]
+
+    # the order of the chunks doesn't matter
+    assert chunks_fingerprint(chunks) == chunks_fingerprint(chunks[::-1])
+    # a changed text or a missing chunk changes it
+    assert chunks_fingerprint(chunks) != chunks_fingerprint(
+        [("a", "first chunk"), ("b", "second chunk, edited")]
+    )
+    assert chunks_fingerprint(chunks) != chunks_fingerprint(chunks[:1])
+
+
+class SlowCache(SemanticAnswerCache):
+    def __init__(self):
+        super().__init__()
+        self.saved = []
+        self.written = threading.Event()
+
+    def _write(self, question, embedding, answer, source_nodes):
+        time.sleep(0.2)
+        self.saved.append((question, answer))
+        self.written.set()
+
+
+class StreamingEngine:
+    callback_manager = None
+
+    def query(self, query_bundle):
+        return StreamingResponse(response_gen=iter(["an ", "answer"]))
+
+
+def test_stream_ends_before_the_write(monkeypatch):
+    cache = SlowCache()
+    monkeypatch.setattr(cache, "lookup", lambda *args: None)
+
+    engine = SemanticCacheQueryEngine(StreamingEngine(), embed_model=None, cache=cache)
+    response = engine.query(QueryBundle("a question", embedding=[1.0]))
+
+    tStart = time.time()
+    assert "".join(response.response_gen) == "an answer"
+    assert time.time() - tStart < 0.1
+
+    assert cache.written.wait(timeout=2)
+    assert cache.saved == [("a question", "an answer")]
+
+
+def test_put_errors_are_logged(monkeypatch):
+    cache = SemanticAnswerCache()
+
+    def no_db():
+        raise RuntimeError("no DB")
+
+    monkeypatch.setattr(cache, "_connect", no_db)
+
+    # the write fails in background, the caller isn't affected
+    future = cache.put("a question", [1.0], "an answer", [])
+
+    assert future.result(timeout=2) is None
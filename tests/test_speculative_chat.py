@@ -0,0 +1,122 @@
+"""
+Speculative retrieval: hit/miss decision, stats and postprocessors
+applied only with the condensed question
+"""
+
+import asyncio
+
+import pytest
+
+from llama_index import ServiceContext
+from llama_index.core.base_retriever import BaseRetriever
+from llama_index.llms import MockLLM
+from llama_index.postprocessor.types import BaseNodePostprocessor
+from llama_index.schema import NodeWithScore, TextNode
+from llama_index.token_counter.mock_embed_model import MockEmbedding
+
+from speculative_chat import SpeculativeChatEngine
+
+NODES = [NodeWithScore(node=TextNode(id_="a", text="a chunk"), score=0.1)]
+
+
+class FakeRetriever(BaseRetriever):
+    def __init__(self):
+        super().__init__()
+        self.queries = []
+
+    def _retrieve(self, query_bundle):
+        self.queries.append((query_bundle.query_str, query_bundle.embedding))
+        return list(NODES)
+
+
+class RecordingReranker(BaseNodePostprocessor):
+    queries: list = []
+
+    def _postprocess_nodes(self, nodes, query_bundle=None):
+        self.queries.append(query_bundle.query_str)
+        return nodes
+
+
+def create_engine():
+    service_context = ServiceContext.from_defaults(
+        llm=MockLLM(), embed_model=MockEmbedding(embed_dim=2)
+    )
+    retriever = FakeRetriever()
+    reranker = RecordingReranker(queries=[])
+
+    engine = SpeculativeChatEngine.from_defaults(
+        retriever=retriever,
+        service_context=service_context,
+        node_postprocessors=[reranker],
+        embed_model=service_context.embed_model,
+        similarity_threshold=0.9,
+    )
+
+    return engine, retriever, reranker
+
+
+def test_record_stats():
+    engine, _, _ = create_engine()
+
+    engine._record(True, 0.5)
+    engine._record(False, 0.3)
+
+    assert engine.get_speculation_stats() == {
+        "n_speculations": 2,
+        "n_hits": 1,
+        "hit_rate": 0.5,
+        "time_saved": 0.5,
+    }
+
+
+def test_resolve_hit():
+    engine, _, _ = create_engine()
+
+    # retrieval longer than the condensation: saved only the overlap
+    engine._resolve("condensed", [1.0, 0.0], ([1.0, 0.1], NODES, 0.3), 0.2)
+
+    assert engine._speculation["condensed"] == ("nodes", NODES)
+    assert engine.get_speculation_stats()["time_saved"] == pytest.approx(0.2)
+
+
+def test_resolve_miss():
+    engine, _, _ = create_engine()
+
+    engine._resolve("condensed", [0.0, 1.0], ([1.0, 0.0], NODES, 0.3), 0.2)
+
+    assert engine._speculation["condensed"] == ("embedding", [0.0, 1.0])
+    assert engine.get_speculation_stats()["n_hits"] == 0
+
+
+def test_speculation_doesnt_rerank():
+    engine, retriever, reranker = create_engine()
+
+    embedding, nodes, _ = engine._speculative_retrieve("and the second one?")
+
+    assert nodes == NODES
+    assert retriever.queries == [("and the second one?", embedding)]
+    assert reranker.queries == []
+
+
+def test_hit_reranked_with_condensed_question():
+    engine, retriever, reranker = create_engine()
+    engine._speculation["condensed"] = ("nodes", NODES)
+
+    context, nodes = engine._retrieve_context("condensed")
+
+    assert nodes == NODES
+    assert "a chunk" in context
+    # no new vector search
+    assert retriever.queries == []
+    assert reranker.queries == ["condensed"]
+
+
+def test_miss_reuses_the_condensed_embedding():
+    engine, retriever, reranker = create_engine()
+    engine._speculation["condensed"] = ("embedding", [0.0, 1.0])
+
+    asyncio.run(engine._aretrieve_context("condensed"))
+
+    assert retriever.queries == [("condensed", [0.0, 1.0])]
+    assert reranker.queries == ["condensed"]
+    assert "condensed" not in engine._speculation
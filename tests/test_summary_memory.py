@@ -0,0 +1,97 @@
+"""
+Choice of the turns to summarize and use of the summary in the history
+(the tokens are the words of the messages)
+"""
+
+import types
+
+from llama_index.llms import ChatMessage, MessageRole
+
+from summary_memory import SUMMARY_PREFIX, SummaryChatMemory
+
+
+def user(content):
+    return ChatMessage(role=MessageRole.USER, content=content)
+
+
+def assistant(content):
+    return ChatMessage(role=MessageRole.ASSISTANT, content=content)
+
+
+class FakeLLM:
+    def __init__(self):
+        self.prompts = []
+
+    def complete(self, prompt):
+        self.prompts.append(prompt)
+
+        return types.SimpleNamespace(text=" the summary ")
+
+
+def create_memory(recent_token_limit, llm=None, token_limit=1000):
+    return SummaryChatMemory.from_defaults(
+        llm=llm,
+        token_limit=token_limit,
+        recent_token_limit=recent_token_limit,
+        tokenizer_fn=str.split,
+    )
+
+
+# 2 + 3 + 2 + 3 tokens
+MESSAGES = [
+    user("first question"),
+    assistant("the first answer"),
+    user("second question"),
+    assistant("the second answer"),
+]
+
+
+def test_nothing_to_fold_within_limit():
+    assert create_memory(10)._num_to_fold(MESSAGES) == 0
+
+
+def test_fold_oldest_turns():
+    # the last 2 messages (5 tokens) are kept
+    assert create_memory(5)._num_to_fold(MESSAGES) == 2
+
+
+def test_kept_history_starts_with_user():
+    # only the last answer fits: the whole turn is folded
+    assert create_memory(4)._num_to_fold(MESSAGES) == 4
+
+
+def test_fold_all_if_last_message_too_long():
+    assert create_memory(1)._num_to_fold(MESSAGES) == 4
+
+
+def test_summarize_folds_the_turns():
+    llm = FakeLLM()
+    memory = create_memory(5, llm=llm)
+    memory.set(MESSAGES)
+
+    memory._summarize()
+
+    assert memory.summary == "the summary"
+    assert memory.n_summaries == 1
+    assert memory.get_all() == MESSAGES[2:]
+    assert "first question" in llm.prompts[0]
+
+
+def test_get_adds_the_summary():
+    memory = create_memory(5)
+    memory.set(MESSAGES[2:])
+    memory.summary = "the summary"
+
+    history = memory.get()
+
+    assert history[0].role == MessageRole.SYSTEM
+    assert history[0].content == SUMMARY_PREFIX + "the summary"
+    assert history[1:] == MESSAGES[2:]
+
+
+def test_get_without_space_for_the_summary():
+    memory = create_memory(5, token_limit=6)
+    memory.set(MESSAGES[2:])
+    memory.summary = "a summary much longer than the token limit"
+
+    assert memory.get() == MESSAGES[2:]
@@ -0,0 +1,145 @@
+"""
+OpenInference attributes of the spans of the llama-index events
+"""
+
+import pytest
+
+from llama_index.callbacks.schema import CBEventType, EventPayload
+from llama_index.llms import (
+    ChatMessage,
+    ChatResponse,
+    CompletionResponse,
+    MessageRole,
+)
+from llama_index.schema import NodeWithScore, TextNode
+from llama_index.utilities.token_counting import TokenCounter
+
+import tracing
+from tracing import TracingHandler, end_attributes, start_attributes
+
+MESSAGES = [
+    ChatMessage(role=MessageRole.SYSTEM, content="Use the context"),
+    ChatMessage(role=MessageRole.USER, content="what is a vector?"),
+]
+RESPONSE = ChatResponse(
+    message=ChatMessage(role=MessageRole.ASSISTANT, content="an array of numbers")
+)
+NODES = [
+    NodeWithScore(node=TextNode(id_="a", text="first chunk"), score=0.9),
+    NodeWithScore(node=TextNode(id_="b", text="second chunk"), score=None),
+]
+
+
+def test_llm_chat_attributes():
+    attributes = start_attributes(
+        CBEventType.LLM,
+        {
+            EventPayload.MESSAGES: MESSAGES,
+            EventPayload.SERIALIZED: {"model": "cohere.command"},
+        },
+    )
+
+    assert attributes["llm.model_name"] == "cohere.command"
+    assert "what is a vector?" in attributes["input.value"]
+    assert attributes["llm.input_messages.1.message.role"] == "user"
+    assert attributes["llm.input_messages.1.message.content"] == "what is a vector?"
+
+    attributes = end_attributes(
+        CBEventType.LLM,
+        {EventPayload.MESSAGES: MESSAGES, EventPayload.RESPONSE: RESPONSE},
+        token_counter=TokenCounter(tokenizer=str.split),
+    )
+
+    assert attributes["output.value"] == "an array of numbers"
+    assert attributes["llm.output_messages.0.message.role"] == "assistant"
+    assert attributes["llm.token_count.completion"] > 0
+    assert attributes["llm.token_count.total"] == (
+        attributes["llm.token_count.prompt"] + attributes["llm.token_count.completion"]
+    )
+
+
+def test_llm_completion_attributes():
+    start = start_attributes(CBEventType.LLM, {EventPayload.PROMPT: "a prompt"})
+    end = end_attributes(
+        CBEventType.LLM,
+        {
+            EventPayload.PROMPT: "a prompt",
+            EventPayload.COMPLETION: CompletionResponse(text="the completion"),
+        },
+    )
+
+    assert start["input.value"] == "a prompt"
+    assert start["llm.prompts"] == ["a prompt"]
+    assert end["output.value"] == "the completion"
+    # no tokenizer: no token counts
+    assert "llm.token_count.total" not in end
+
+
+def test_rerank_attributes():
+    start = start_attributes(
+        CBEventType.RERANKING,
+        {
+            EventPayload.NODES: NODES,
+            EventPayload.MODEL_NAME: "bge-reranker-large",
+            EventPayload.QUERY_STR: "a question",
+            EventPayload.TOP_K: 1,
+        },
+    )
+    end = end_attributes(CBEventType.RERANKING, {EventPayload.NODES: NODES[:1]})
+
+    assert start["reranker.query"] == "a question"
+    assert start["reranker.model_name"] == "bge-reranker-large"
+    assert start["reranker.top_k"] == 1
+    assert start["reranker.input_documents.0.document.content"] == "first chunk"
+    assert start["reranker.input_documents.0.document.score"] == 0.9
+    assert "reranker.input_documents.1.document.score" not in start
+    assert end["reranker.output_documents.0.document.id"] == "a"
+    assert "reranker.output_documents.1.document.id" not in end
+
+
+def test_embedding_attributes():
+    start = start_attributes(
+        CBEventType.EMBEDDING,
+        {EventPayload.SERIALIZED: {"model_name": "cohere.embed-english-v3.0"}},
+    )
+    end = end_attributes(
+        CBEventType.EMBEDDING,
+        {EventPayload.CHUNKS: ["a question"], EventPayload.EMBEDDINGS: [[0.1]]},
+    )
+
+    assert start["embedding.model_name"] == "cohere.embed-english-v3.0"
+    assert end == {"embedding.embeddings.0.embedding.text": "a question"}
+
+
+def test_handler_sets_the_attributes(monkeypatch):
+    pytest.importorskip("opentelemetry.sdk")
+
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import (
+        InMemorySpanExporter,
+    )
+
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+
+    monkeypatch.setattr(tracing, "ADD_PHX_TRACING", True)
+    monkeypatch.setattr(tracing, "_tracer", provider.get_tracer(__name__))
+
+    handler = TracingHandler(tokenizer=str.split)
+    handler.on_event_start(
+        CBEventType.LLM, {EventPayload.MESSAGES: MESSAGES}, event_id="1"
+    )
+    handler.on_event_end(
+        CBEventType.LLM,
+        {EventPayload.MESSAGES: MESSAGES, EventPayload.RESPONSE: RESPONSE},
+        event_id="1",
+    )
+
+    (span,) = exporter.get_finished_spans()
+
+    assert span.name == "llm"
+    assert span.attributes["openinference.span.kind"] == "LLM"
+    assert span.attributes["output.value"] == "an array of numbers"
+    assert span.attributes["llm.token_count.prompt"] > 0
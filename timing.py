@@ -0,0 +1,79 @@
+"""
+File name: timing.py
+Author: Luigi Saetta
+Date created: 2024-03-12
+Date last modified: 2024-03-12
+Python Version: 3.9
+
+Description:
+    This module provides a simple timer to measure the time spent
+    in the different steps (ex: creation of the components of the chain)
+    and to log a report
+
+Usage:
+    Import this module into other scripts to use its functions.
+    Example:
+    timer = StageTimer()
+
+    with timer.measure("llm"):
+        llm = create_llm(auth=api_keys_config)
+
+    timer.report("Startup time")
+
+License:
+    This code is released under the MIT License.
+
+Notes:
+    This is a part of a set of demo showing how to use Oracle Vector DB,
+    OCI GenAI service, Oracle GenAI Embeddings, to build a RAG solution,
+    where all he data (text + embeddings) are stored in Oracle DB 23c
+
+Warnings:
+    This module is in development, may change in future versions.
+"""
+
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+class StageTimer:
+    def __init__(self):
+        # stage name -> elapsed time (sec.), in order of execution
+        self.timings = {}
+        self._lock = threading.Lock()
+        self._start = time.time()
+
+    @contextmanager
+    def measure(self, stage):
+        tStart = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - tStart)
+
+    def add(self, stage, elapsed):
+        # if a stage is executed more times, times are summed
+        with self._lock:
+            self.timings[stage] = self.timings.get(stage, 0.0) + elapsed
+
+    @property
+    def total(self):
+        return time.time() - self._start
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self.timings)
+
+    def report(self, title="Timings"):
+        logging.info(f"{title}:")
+
+        for stage, elapsed in self.as_dict().items():
+            logging.info(f"  {stage}: {round(elapsed, 2)} sec.")
+
+        logging.info(f"  total: {round(self.total, 2)} sec.")
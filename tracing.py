@@ -0,0 +1,359 @@
+"""
+File name: tracing.py
+Author: Luigi Saetta
+Date created: 2024-03-13
+Date last modified: 2024-03-13
+Python Version: 3.9
+
+Description:
+    This module provides the Phoenix (OpenTelemetry) tracing of the chain,
+    with a negligible overhead in the hot path:
+    - spans are exported in background, in batches, by a BatchSpanProcessor
+      with a bounded queue (if the collector is slow, spans are dropped,
+      requests are never slowed down)
+    - head sampling: only PHX_SAMPLING_RATE of the requests is traced
+      (the decision is taken on the root span, children follow it)
+    - the endpoint of the collector is configurable (PHX_ENDPOINT)
+    - the Phoenix app, if PHX_LAUNCH_APP, is launched once, with the tracer
+
+    Spans: one for each request (see request_metrics.track_request), with
+    children for the stages (SQL execute, CLOB reads, ...) and, through
+    TracingHandler, for the llama-index events (embedding, rerank, LLM).
+    The spans of the events have the OpenInference attributes shown by
+    Phoenix: prompt and completion, model, token counts, rerank documents.
+    If ADD_PHX_TRACING is False, nothing is imported and spans are no-op.
+
+Usage:
+    Import this module into other scripts to use its functions.
+    Example:
+    with optional_span("sql_execute"):
+        cursor.execute(select, [array_query])
+
+License:
+    This code is released under the MIT License.
+
+Notes:
+    This is a part of a set of demo showing how to use Oracle Vector DB,
+    OCI GenAI service, Oracle GenAI Embeddings, to build a RAG solution,
+    where all he data (text + embeddings) are stored in Oracle DB 23c
+
+Warnings:
+    This module is in development, may change in future versions.
+"""
+
+import os
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from llama_index.callbacks.base_handler import BaseCallbackHandler
+from llama_index.callbacks.schema import CBEventType, EventPayload
+from llama_index.callbacks.token_counting import get_llm_token_counts
+from llama_index.utilities.token_counting import TokenCounter
+
+from config import (
+    ADD_PHX_TRACING,
+    PHX_HOST,
+    PHX_PORT,
+    PHX_LAUNCH_APP,
+    PHX_ENDPOINT,
+    PHX_SAMPLING_RATE,
+    PHX_MAX_QUEUE_SIZE,
+    PHX_EXPORT_BATCH_SIZE,
+    PHX_SCHEDULE_DELAY_MS,
+)
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+OPENINFERENCE_SPAN_KIND = "openinference.span.kind"
+
+# llama-index events traced: name and kind of the span
+EVENT_SPANS = {
+    CBEventType.EMBEDDING: ("embedding", "EMBEDDING"),
+    CBEventType.RERANKING: ("rerank", "RERANKER"),
+    CBEventType.LLM: ("llm", "LLM"),
+}
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def _model_name(payload):
+    # the serialized component (to_dict), the name of the field depends on it
+    serialized = payload.get(EventPayload.SERIALIZED) or {}
+
+    for key in ("model", "model_name", "class_name"):
+        if serialized.get(key):
+            return str(serialized[key])
+
+    return None
+
+
+def _message_attributes(prefix, messages):
+    attributes = {}
+
+    for i, message in enumerate(messages):
+        attributes[f"{prefix}.{i}.message.role"] = message.role.value
+        attributes[f"{prefix}.{i}.message.content"] = str(message.content or "")
+
+    return attributes
+
+
+def _document_attributes(prefix, nodes):
+    attributes = {}
+
+    for i, node in enumerate(nodes):
+        attributes[f"{prefix}.{i}.document.id"] = node.node.node_id
+        attributes[f"{prefix}.{i}.document.content"] = node.node.get_content()
+
+        if node.score is not None:
+            attributes[f"{prefix}.{i}.document.score"] = float(node.score)
+
+    return attributes
+
+
+def start_attributes(event_type, payload):
+    """
+    OpenInference attributes from the payload of the start of an event
+    """
+    attributes = {}
+    model_name = _model_name(payload)
+
+    if event_type == CBEventType.LLM:
+        if model_name is not None:
+            attributes["llm.model_name"] = model_name
+
+        if EventPayload.MESSAGES in payload:
+            messages = payload[EventPayload.MESSAGES]
+
+            attributes["input.value"] = "\n".join(str(m) for m in messages)
+            attributes.update(_message_attributes("llm.input_messages", messages))
+        elif EventPayload.PROMPT in payload:
+            attributes["input.value"] = payload[EventPayload.PROMPT]
+            attributes["llm.prompts"] = [payload[EventPayload.PROMPT]]
+
+    elif event_type == CBEventType.EMBEDDING:
+        if model_name is not None:
+            attributes["embedding.model_name"] = model_name
+
+    elif event_type == CBEventType.RERANKING:
+        query = payload.get(EventPayload.QUERY_STR)
+
+        if query is not None:
+            attributes["input.value"] = query
+            attributes["reranker.query"] = query
+        if payload.get(EventPayload.MODEL_NAME) is not None:
+            attributes["reranker.model_name"] = str(payload[EventPayload.MODEL_NAME])
+        if payload.get(EventPayload.TOP_K) is not None:
+            attributes["reranker.top_k"] = int(payload[EventPayload.TOP_K])
+
+        attributes.update(
+            _document_attributes(
+                "reranker.input_documents", payload.get(EventPayload.NODES, [])
+            )
+        )
+
+    return attributes
+
+
+def end_attributes(event_type, payload, token_counter=None):
+    """
+    OpenInference attributes from the payload of the end of an event
+    token_counter: TokenCounter, for the tokens of the LLM calls
+    """
+    attributes = {}
+
+    if event_type == CBEventType.LLM:
+        if EventPayload.RESPONSE in payload:
+            message = payload[EventPayload.RESPONSE].message
+
+            attributes["output.value"] = str(message.content or "")
+            attributes.update(_message_attributes("llm.output_messages", [message]))
+        elif EventPayload.COMPLETION in payload:
+            attributes["output.value"] = payload[EventPayload.COMPLETION].text
+
+        if token_counter is not None:
+            counts = get_llm_token_counts(token_counter, payload)
+
+            attributes["llm.token_count.prompt"] = counts.prompt_token_count
+            attributes["llm.token_count.completion"] = counts.completion_token_count
+            attributes["llm.token_count.total"] = counts.total_token_count
+
+    elif event_type == CBEventType.EMBEDDING:
+        # the texts only, the vectors would make the spans too big
+        for i, text in enumerate(payload.get(EventPayload.CHUNKS, [])):
+            attributes[f"embedding.embeddings.{i}.embedding.text"] = text
+
+    elif event_type == CBEventType.RERANKING:
+        attributes.update(
+            _document_attributes(
+                "reranker.output_documents", payload.get(EventPayload.NODES, [])
+            )
+        )
+
+    return attributes
+
+
+def launch_phoenix():
+    import phoenix as px
+
+    logging.info(f"Launching Phoenix on {PHX_HOST}:{PHX_PORT}...")
+
+    os.environ["PHOENIX_PORT"] = PHX_PORT
+    os.environ["PHOENIX_HOST"] = PHX_HOST
+    px.launch_app()
+
+
+def get_tracer():
+    """
+    The tracer, created the first time (None if tracing is disabled).
+    All the spans go through it: sampling and batching apply to all
+    """
+    global _tracer
+
+    if not ADD_PHX_TRACING:
+        return None
+
+    with _tracer_lock:
+        if _tracer is None:
+            from opentelemetry import trace as trace_api
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+                OTLPSpanExporter,
+            )
+            from opentelemetry.sdk import trace as trace_sdk
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor
+            from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+
+            if PHX_LAUNCH_APP:
+                launch_phoenix()
+
+            logging.info(
+                f"Phoenix tracing to {PHX_ENDPOINT}, sampling rate {PHX_SAMPLING_RATE}..."
+            )
+
+            tracer_provider = trace_sdk.TracerProvider(
+                sampler=ParentBased(TraceIdRatioBased(PHX_SAMPLING_RATE))
+            )
+            # spans are exported in background
+            tracer_provider.add_span_processor(
+                BatchSpanProcessor(
+                    OTLPSpanExporter(PHX_ENDPOINT),
+                    max_queue_size=PHX_MAX_QUEUE_SIZE,
+                    max_export_batch_size=PHX_EXPORT_BATCH_SIZE,
+                    schedule_delay_millis=PHX_SCHEDULE_DELAY_MS,
+                )
+            )
+            trace_api.set_tracer_provider(tracer_provider)
+
+            _tracer = trace_api.get_tracer(__name__)
+
+    return _tracer
+
+
+@contextmanager
+def optional_span(name, kind="CHAIN", attributes=None):
+    """
+    a span child of the current one, if tracing is enabled
+    """
+    tracer = get_tracer()
+
+    if tracer is None:
+        # provide a neutral context if no context is required
+        yield None
+        return
+
+    with tracer.start_as_current_span(name=name) as span:
+        # to set the span kind (avoid unknown)
+        span.set_attribute(OPENINFERENCE_SPAN_KIND, kind)
+
+        for key, value in (attributes or {}).items():
+            span.set_attribute(key, value)
+
+        yield span
+
+
+class TracingHandler(BaseCallbackHandler):
+    """
+    A span for each llama-index event (embedding, rerank, LLM),
+    child of the span current when the event starts
+    """
+
+    def __init__(self, tokenizer=None):
+        """
+        tokenizer: function str -> list of tokens, for the token counts
+            of the LLM spans (as for TokenCountingHandler)
+        """
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+
+        self._token_counter = TokenCounter(tokenizer=tokenizer)
+
+        # event_id -> (event_type, span)
+        self._spans = {}
+        self._lock = threading.Lock()
+
+    def on_event_start(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        parent_id: str = "",
+        **kwargs: Any,
+    ) -> str:
+        tracer = get_tracer()
+
+        if tracer is not None and event_type in EVENT_SPANS:
+            name, kind = EVENT_SPANS[event_type]
+
+            span = tracer.start_span(name, attributes={OPENINFERENCE_SPAN_KIND: kind})
+
+            if span.is_recording():
+                # not sampled: nothing to compute
+                self._set_attributes(span, start_attributes, event_type, payload)
+
+            # the end could be called in another thread (ex: streaming)
+            with self._lock:
+                self._spans[event_id] = span
+
+        return event_id
+
+    def on_event_end(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        **kwargs: Any,
+    ) -> None:
+        with self._lock:
+            span = self._spans.pop(event_id, None)
+
+        if span is not None:
+            if span.is_recording():
+                self._set_attributes(
+                    span,
+                    end_attributes,
+                    event_type,
+                    payload,
+                    token_counter=self._token_counter,
+                )
+
+            span.end()
+
+    def _set_attributes(self, span, get_attributes, event_type, payload, **kwargs):
+        # tracing must never break the request
+        try:
+            span.set_attributes(get_attributes(event_type, payload or {}, **kwargs))
+        except Exception as e:
+            logging.warning(f"Tracing: attributes of {event_type} not set: {e}")
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        pass
+
+    def end_trace(
+        self,
+        trace_id: Optional[str] = None,
+        trace_map: Optional[Dict[str, List[str]]] = None,
+    ) -> None:
+        pass
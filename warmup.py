@@ -0,0 +1,112 @@
+"""
+File name: warmup.py
+Author: Luigi Saetta
+Date created: 2024-03-13
+Date last modified: 2024-03-13
+Python Version: 3.9
+
+Description:
+    This module provides the warm-up of the components of the chain,
+    so that the first user after a deploy doesn't pay for the cold starts:
+    connections of the DB pool, tokenizer, embeddings service,
+    vector query (SQL parse) and reranker (the deployment could be scaled down).
+    The tasks run in parallel, the time of each one is reported.
+
+Usage:
+    Import this module into other scripts to use its functions.
+    Example:
+    timings = warm_up(
+        embed_model=embed_model,
+        vector_store=v_store,
+        reranker=reranker,
+        tokenizer=cohere_tokenizer,
+    )
+
+License:
+    This code is released under the MIT License.
+
+Notes:
+    This is a part of a set of demo showing how to use Oracle Vector DB,
+    OCI GenAI service, Oracle GenAI Embeddings, to build a RAG solution,
+    where all he data (text + embeddings) are stored in Oracle DB 23c
+
+Warnings:
+    This module is in development, may change in future versions.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from llama_index.schema import NodeWithScore, QueryBundle, TextNode
+from llama_index.vector_stores.types import VectorStoreQuery
+
+from oracle_vector_db import ping_db
+from timing import StageTimer
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+WARM_UP_TEXT = "warm up"
+
+
+def warm_up_rerank(reranker):
+    if getattr(reranker, "oci_reranker", None) is not None:
+        # directly the cross-encoder: the cache and the stats are not touched
+        reranker.oci_reranker.rerank(WARM_UP_TEXT, [WARM_UP_TEXT], top_n=1)
+    else:
+        reranker.postprocess_nodes(
+            [NodeWithScore(node=TextNode(text=WARM_UP_TEXT), score=0.0)],
+            query_bundle=QueryBundle(WARM_UP_TEXT),
+        )
+
+
+def warm_up(
+    embed_model=None, vector_store=None, reranker=None, tokenizer=None, max_workers=4
+):
+    """
+    embed_model: LangChain embeddings
+    vector_store: OracleVectorStore
+    reranker: the reranker postprocessor
+    returns: component -> warm-up time (sec.)
+    Errors are only logged: the components will be warmed by the first request
+    """
+    timer = StageTimer()
+
+    def run(name, func):
+        try:
+            with timer.measure(name):
+                func()
+        except Exception as e:
+            logging.error(f"Error in warm-up of {name}...")
+            logging.error(e)
+
+    def embed_and_query():
+        embedding = []
+        run("embed", lambda: embedding.extend(embed_model.embed_query(WARM_UP_TEXT)))
+
+        if vector_store is not None and len(embedding) > 0:
+            run(
+                "vector_query",
+                lambda: vector_store.query(
+                    VectorStoreQuery(query_embedding=embedding, similarity_top_k=1)
+                ),
+            )
+
+    tasks = [lambda: run("db_pool", ping_db)]
+
+    if tokenizer is not None:
+        tasks.append(lambda: run("tokenizer", lambda: tokenizer.encode(WARM_UP_TEXT)))
+    if embed_model is not None:
+        # the vector query needs the embedding
+        tasks.append(embed_and_query)
+    if reranker is not None:
+        tasks.append(lambda: run("rerank", lambda: warm_up_rerank(reranker)))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for future in [executor.submit(task) for task in tasks]:
+            future.result()
+
+    timer.report("Warm-up time")
+
+    return timer.as_dict()